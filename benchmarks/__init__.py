@@ -0,0 +1,2 @@
+"""Benchmarks for the steering panel's hot paths, run against a simulated machine.
+Run them with 'python -m benchmarks.run' from the top of the repository."""
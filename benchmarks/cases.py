@@ -0,0 +1,189 @@
+"""cases.py - Benchmarks for the steering panel's hot paths.
+
+Every benchmark runs against synthetic data: a SimulatedMachine (see the simulation
+package) with a generated lattice of the requested number of BPMs, filled out with
+correctors to MODEL_ELEMENTS elements, so the model and TWISS tables are full sized.
+simulation.install() must have been called before this module is imported (run.py
+does this), so that the steering modules pick up the simulated backends.
+"""
+
+import os
+import sys
+import importlib
+import numpy as np
+import simulation
+from simulation.backends import TableValue
+from .harness import benchmark, SkipBenchmark
+
+STEERING_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steering')
+if STEERING_DIR not in sys.path:
+    sys.path.insert(0, STEERING_DIR)
+
+#The default numbers of BPMs to run at.
+BPM_SIZES = (300, 1000, 3000)
+#The number of elements in the synthetic model and TWISS tables.
+MODEL_ELEMENTS = 5000
+#BPMs per synthetic sector, so sector ticks look like the real machine's.
+BPMS_PER_SECTOR = 50
+
+def synthetic_lattice(n_bpms, n_elements=MODEL_ELEMENTS):
+    """Make a lattice with n_bpms BPMs, and enough correctors (half X, half Y) to have
+    n_elements devices in total, spread evenly over a kilometer."""
+    n_cors = max((n_elements - n_bpms)//2, 1)
+    bpms = [("BPMS:S{:02d}:{}".format(i//BPMS_PER_SECTOR, 100 + i % BPMS_PER_SECTOR), z) for (i, z) in enumerate(np.linspace(1.0, 1000.0, n_bpms))]
+    xcors = [("XCOR:SIM:{}".format(i), z) for (i, z) in enumerate(np.linspace(0.0, 999.0, n_cors))]
+    ycors = [("YCOR:SIM:{}".format(i), z) for (i, z) in enumerate(np.linspace(0.5, 999.5, n_cors))]
+    return simulation.Lattice(bpms, xcors, ycors)
+
+_machines = {}
+
+def use_machine(n_bpms):
+    """Serve a simulated machine with n_bpms BPMs (re-using one from an earlier benchmark
+    if possible), and reload the model so it matches the machine's lattice."""
+    machine = _machines.get(n_bpms)
+    if machine is None:
+        machine = simulation.SimulatedMachine(lattice=synthetic_lattice(n_bpms), seed=n_bpms)
+        machine.step()
+        _machines[n_bpms] = machine
+    if simulation.machine() is not machine:
+        simulation.install(machine)
+        from utilities import model, model_list
+        model.get_machine_model(refresh=True)
+        model_list.shared_table(refresh=True)
+    return machine
+
+def steering_module(name):
+    """Import a module from the steering panel, or skip if it can't be (usually, no PyQt)."""
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        raise SkipBenchmark("Can't import {}: {}".format(name, e))
+
+_qt_app = None
+
+def qt_app():
+    """Get a QApplication, making one on the offscreen platform if there isn't one already."""
+    global _qt_app
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5.QtWidgets import QApplication
+    except ImportError as e:
+        raise SkipBenchmark("No PyQt5: {}".format(e))
+    _qt_app = QApplication.instance()
+    if _qt_app is None:
+        _qt_app = QApplication(['benchmarks'])
+    return _qt_app
+
+_live_orbits = {}
+
+def live_orbit(machine):
+    """Get a live Orbit connected to every BPM in the machine.  There is one per machine,
+    so that monitors don't pile up on the machine's PVs from one benchmark to the next.
+    Its connection pipeline doesn't wait between steps, since the simulated PVs connect
+    immediately."""
+    orbit = steering_module('orbit')
+    live = _live_orbits.get(id(machine))
+    if live is None:
+        class BenchmarkOrbit(orbit.Orbit):
+            poll_interval = 0
+        live = BenchmarkOrbit(auto_connect=False)
+        live.set_bpms(machine.bpm_names)
+        _live_orbits[id(machine)] = live
+    if not live.connected:
+        live.connect()
+    return live
+
+def static_orbit(machine, seed=0):
+    """Make a static orbit of noisy readings of the machine's current orbit."""
+    orbit = steering_module('orbit')
+    rng = np.random.RandomState(seed)
+    n = len(machine.bpm_names)
+    d = {'names': machine.bpm_names, 'z': machine.bpm_z, 'tmit': np.full(n, machine.tmit)}
+    for axis in ('x', 'y'):
+        d[axis] = machine.orbit(axis) + rng.normal(0.0, machine.noise, n)
+    for field in ('x_rms', 'y_rms', 'tmit_rms', 'x_severity', 'y_severity', 'tmit_severity'):
+        d[field] = np.zeros(n)
+    return orbit.BaseOrbit.from_dict(d)
+
+@benchmark('Orbit.connect', sizes=BPM_SIZES, repeat=5, warmup=1)
+def orbit_connect(size):
+    machine = use_machine(size)
+    live = live_orbit(machine)
+    def run():
+        live.set_bpms(machine.bpm_names)
+        live.connect()
+    return (run, live.disconnect)
+
+def _redraw(size, batched):
+    machine = use_machine(size)
+    qt_app()
+    orbit_view = steering_module('orbit_view')
+    from PyQt5.QtCore import QTimer
+    live = live_orbit(machine)
+    #A timer which is never started, so the benchmark decides when frames are drawn.
+    view = orbit_view.OrbitView(orbit=live, axis='x', draw_timer=QTimer(), batched=batched)
+    view.resize(1600, 400)
+    view.show()
+    def run():
+        view.redraw_bpms()
+        #Render the whole widget, as a repaint of the window would.
+        view.grab()
+    #Every frame has a new pulse to draw.
+    return (run, machine.step)
+
+@benchmark('OrbitView.redraw_bpms', sizes=BPM_SIZES, frames=True)
+def redraw_bpms(size):
+    return _redraw(size, batched=True)
+
+@benchmark('OrbitView.redraw_bpms[per_line]', sizes=BPM_SIZES, repeat=10, frames=True)
+def redraw_bpms_per_line(size):
+    return _redraw(size, batched=False)
+
+@benchmark('BaseOrbit.fit', sizes=BPM_SIZES)
+def orbit_fit(size):
+    machine = use_machine(size)
+    static = static_orbit(machine)
+    n = len(static)
+    return lambda: static.fit(0, n - 1, n//2)
+
+@benchmark('model.get_rmat', sizes=BPM_SIZES)
+def get_rmat(size):
+    machine = use_machine(size)
+    from utilities import model
+    names = machine.bpm_names
+    return lambda: model.get_rmat(names[0], names)
+
+@benchmark('model.get_zpos', sizes=BPM_SIZES)
+def get_zpos(size):
+    machine = use_machine(size)
+    from utilities import model
+    names = machine.bpm_names
+    return lambda: model.get_zpos(names)
+
+@benchmark('model_list.unwrap_to_np', sizes=(MODEL_ELEMENTS,), scalable=False)
+def unwrap_to_np(size):
+    from utilities import model_list
+    value = TableValue(synthetic_lattice(BPM_SIZES[0], n_elements=size).twiss_columns(), 0.0)
+    return lambda: model_list.unwrap_to_np(value)
+
+@benchmark('DiffBPM accessors', sizes=BPM_SIZES)
+def diff_bpm_accessors(size):
+    machine = use_machine(size)
+    orbit = steering_module('orbit')
+    diff = orbit.DiffOrbit(static_orbit(machine, seed=1), static_orbit(machine, seed=2))
+    def run():
+        for bpm in diff:
+            (bpm.x, bpm.y, bpm.tmit)
+    return run
+
+@benchmark('Orbit.to_static', sizes=BPM_SIZES)
+def to_static(size):
+    machine = use_machine(size)
+    live = live_orbit(machine)
+    return (live.to_static, machine.step)
+
+@benchmark('Orbit.to_dict', sizes=BPM_SIZES)
+def to_dict(size):
+    machine = use_machine(size)
+    live = live_orbit(machine)
+    return (lambda: live.to_dict(use_buffers=False), machine.step)
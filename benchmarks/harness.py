@@ -0,0 +1,235 @@
+"""harness.py - Timing, allocation tracking, and result files for the benchmarks.
+
+A benchmark is a function registered with @benchmark.  It is called once per size
+to set up its data, and returns the callable to time (or a tuple of the callable and
+a 'prepare' callable, which is run untimed before every timed call).  It can raise
+SkipBenchmark if something it needs (PyQt, say) isn't available.
+
+Results are plain dictionaries, so a run can be saved as JSON and compared with a
+later one.
+"""
+
+import gc
+import json
+import time
+import platform
+import subprocess
+from collections import OrderedDict
+import numpy as np
+try:
+    import tracemalloc
+except ImportError:
+    #Python 2.
+    tracemalloc = None
+
+#The JSON format version, bumped whenever the layout of a result file changes.
+RESULTS_VERSION = 1
+PERCENTILES = (50, 90, 99)
+_clock = getattr(time, 'perf_counter', time.time)
+
+class SkipBenchmark(Exception):
+    """Raised by a benchmark which can't run here.  The message says why."""
+    pass
+
+class Benchmark(object):
+    def __init__(self, name, func, sizes, scalable, repeat, warmup, frames):
+        self.name = name
+        self.func = func
+        self.sizes = sizes
+        self.scalable = scalable
+        self.repeat = repeat
+        self.warmup = warmup
+        self.frames = frames
+
+_benchmarks = OrderedDict()
+
+def benchmark(name, sizes=(None,), scalable=True, repeat=20, warmup=2, frames=False):
+    """Register a benchmark.
+
+    Args:
+        name (str): The benchmark's name, usually the name of the code it times.
+        sizes (Optional[tuple]): The sizes to run at.  Each is passed to the benchmark function.
+        scalable (Optional[bool]): Whether the sizes can be overridden when running (see run_all).
+        repeat (Optional[int]): How many timed calls to make at each size.
+        warmup (Optional[int]): How many untimed calls to make first.
+        frames (Optional[bool]): Whether each call is a rendered frame, so a frame rate is reported.
+    """
+    def register(func):
+        _benchmarks[name] = Benchmark(name, func, sizes, scalable, repeat, warmup, frames)
+        return func
+    return register
+
+def benchmarks(pattern=None):
+    """Get the registered benchmarks, optionally only those with pattern in their names."""
+    return [bench for bench in _benchmarks.values() if pattern is None or pattern in bench.name]
+
+def _unpack(case):
+    if isinstance(case, tuple):
+        return case
+    return (case, None)
+
+def measure(run, prepare=None, repeat=20, warmup=2, allocations=True):
+    """Time repeated calls to run().
+
+    Like timeit, garbage collection is switched off while timing.  Allocations are
+    measured on one extra call, with tracemalloc, because tracing slows everything down.
+
+    Args:
+        run (callable): The code to time.
+        prepare (Optional[callable]): Called (untimed) before every call to run.
+        repeat (Optional[int]): The number of timed calls.
+        warmup (Optional[int]): The number of untimed calls made first.
+        allocations (Optional[bool]): Whether to measure allocations.
+    Returns:
+        dict: Latency statistics in milliseconds (mean, min, max, and p50/p90/p99), and
+            the peak and net memory allocated by one call, in kB (None without tracemalloc).
+    """
+    for i in range(warmup):
+        if prepare is not None:
+            prepare()
+        run()
+    times = np.zeros(repeat)
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            if prepare is not None:
+                prepare()
+            start = _clock()
+            run()
+            times[i] = _clock() - start
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    times *= 1000.0
+    result = OrderedDict()
+    result['repeat'] = repeat
+    result['mean_ms'] = float(np.mean(times))
+    result['min_ms'] = float(np.min(times))
+    for p in PERCENTILES:
+        result['p{}_ms'.format(p)] = float(np.percentile(times, p))
+    result['max_ms'] = float(np.max(times))
+    result['alloc_peak_kb'] = None
+    result['alloc_net_kb'] = None
+    if allocations and tracemalloc is not None:
+        if prepare is not None:
+            prepare()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            (current, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['alloc_peak_kb'] = peak/1024.0
+        result['alloc_net_kb'] = current/1024.0
+    return result
+
+def run_benchmark(bench, size, repeat=None, allocations=True):
+    """Set up and measure one benchmark at one size.  Returns a result dictionary, with
+    'skipped' set to the reason if the benchmark couldn't run."""
+    result = OrderedDict([('name', bench.name), ('size', size)])
+    try:
+        (run, prepare) = _unpack(bench.func(size))
+    except SkipBenchmark as e:
+        result['skipped'] = str(e)
+        return result
+    result.update(measure(run, prepare=prepare, repeat=repeat if repeat is not None else bench.repeat, warmup=bench.warmup, allocations=allocations))
+    if bench.frames:
+        result['fps'] = 1000.0/result['mean_ms'] if result['mean_ms'] > 0 else None
+    return result
+
+def run_all(pattern=None, sizes=None, repeat=None, allocations=True, progress=None):
+    """Run every registered benchmark (or those matching pattern).
+
+    Args:
+        pattern (Optional[str]): Only run benchmarks with this in their name.
+        sizes (Optional[list]): Run at these sizes instead of each benchmark's own.
+            Benchmarks registered with scalable=False ignore this.
+        repeat (Optional[int]): Overrides each benchmark's number of timed calls.
+        allocations (Optional[bool]): Whether to measure allocations.
+        progress (Optional[callable]): Called with each result as it finishes.
+    Returns:
+        list: The result dictionaries.
+    """
+    results = []
+    for bench in benchmarks(pattern):
+        bench_sizes = sizes if sizes is not None and bench.scalable else bench.sizes
+        for size in bench_sizes:
+            result = run_benchmark(bench, size, repeat=repeat, allocations=allocations)
+            results.append(result)
+            if progress is not None:
+                progress(result)
+    return results
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    """Describe where the benchmarks ran, for the results file."""
+    return OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('git_revision', _git_revision()),
+                        ('python', platform.python_version()), ('numpy', np.__version__),
+                        ('platform', platform.platform()), ('machine', platform.node())])
+
+def save(results, path):
+    """Save results (from run_all) as JSON, along with a description of the environment."""
+    with open(path, 'w') as f:
+        json.dump(OrderedDict([('version', RESULTS_VERSION), ('environment', environment()), ('results', results)]), f, indent=2)
+
+def load(path):
+    """Load results saved by save().  Returns the list of result dictionaries."""
+    with open(path) as f:
+        saved = json.load(f)
+    if saved.get('version') != RESULTS_VERSION:
+        raise ValueError("{} is a version {} results file, expected version {}.".format(path, saved.get('version'), RESULTS_VERSION))
+    return saved['results']
+
+def compare(baseline, current, metric='p50_ms', threshold=0.1):
+    """Compare two sets of results, matching them by name and size.
+
+    Args:
+        baseline (list): The results to compare against.
+        current (list): The new results.
+        metric (Optional[str]): The statistic to compare.
+        threshold (Optional[float]): The fractional slowdown which counts as a regression.
+    Returns:
+        list of dict: One entry per benchmark run in both, with the name, size, both
+            values, their ratio (current/baseline), and whether it is a regression.
+    """
+    baseline_values = dict(((r['name'], r['size']), r.get(metric)) for r in baseline)
+    comparison = []
+    for r in current:
+        before = baseline_values.get((r['name'], r['size']))
+        after = r.get(metric)
+        if before is None or after is None:
+            continue
+        ratio = after/before if before > 0 else None
+        comparison.append(OrderedDict([('name', r['name']), ('size', r['size']), ('baseline', before), ('current', after),
+                                       ('ratio', ratio), ('regression', ratio is not None and ratio > 1.0 + threshold)]))
+    return comparison
+
+def format_results(results):
+    """Format results as a text table."""
+    lines = ["{:<40} {:>6} {:>10} {:>10} {:>10} {:>10} {:>12} {:>8}".format('benchmark', 'size', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'peak kB', 'fps')]
+    for r in results:
+        size = '' if r['size'] is None else str(r['size'])
+        if 'skipped' in r:
+            lines.append("{:<40} {:>6} skipped: {}".format(r['name'], size, r['skipped']))
+            continue
+        peak = '' if r['alloc_peak_kb'] is None else "{:.1f}".format(r['alloc_peak_kb'])
+        fps = "{:.1f}".format(r['fps']) if r.get('fps') is not None else ''
+        lines.append("{:<40} {:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12} {:>8}".format(r['name'], size, r['p50_ms'], r['p90_ms'], r['p99_ms'], r['max_ms'], peak, fps))
+    return "\n".join(lines)
+
+def format_comparison(comparison):
+    lines = ["{:<40} {:>6} {:>12} {:>12} {:>8}".format('benchmark', 'size', 'baseline', 'current', 'ratio')]
+    for c in comparison:
+        size = '' if c['size'] is None else str(c['size'])
+        ratio = "{:.2f}".format(c['ratio']) if c['ratio'] is not None else ''
+        flag = "  REGRESSION" if c['regression'] else ''
+        lines.append("{:<40} {:>6} {:>12.3f} {:>12.3f} {:>8}{}".format(c['name'], size, c['baseline'], c['current'], ratio, flag))
+    return "\n".join(lines)
@@ -0,0 +1,50 @@
+"""run.py - Run the benchmarks, print a table of results, and optionally save them as
+JSON and compare them with an earlier run.
+
+    python -m benchmarks.run --output before.json
+    (make changes)
+    python -m benchmarks.run --output after.json --compare before.json
+"""
+
+import sys
+import argparse
+import simulation
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the steering panel's hot paths against a simulated machine.")
+    parser.add_argument('--only', help="Only run benchmarks with this in their name.")
+    parser.add_argument('--sizes', help="Comma separated BPM counts to run at, instead of each benchmark's defaults.")
+    parser.add_argument('--repeat', type=int, help="The number of timed calls per benchmark and size.")
+    parser.add_argument('--no-allocations', action='store_true', help="Don't measure allocations.")
+    parser.add_argument('--output', help="Save the results to this JSON file.")
+    parser.add_argument('--compare', help="Compare the results with those in this JSON file.")
+    parser.add_argument('--metric', default='p50_ms', help="The statistic to compare (default p50_ms).")
+    parser.add_argument('--threshold', type=float, default=0.1, help="The fractional slowdown which counts as a regression (default 0.1).")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    #The simulated backends have to be in place before anything imports the real ones.
+    simulation.install()
+    from . import harness
+    from . import cases
+    sizes = [int(size) for size in args.sizes.split(',')] if args.sizes else None
+    def progress(result):
+        print(harness.format_results([result]).splitlines()[1])
+        sys.stdout.flush()
+    results = harness.run_all(pattern=args.only, sizes=sizes, repeat=args.repeat, allocations=not args.no_allocations, progress=progress)
+    print("")
+    print(harness.format_results(results))
+    if args.output:
+        harness.save(results, args.output)
+        print("Saved results to {}".format(args.output))
+    if args.compare:
+        comparison = harness.compare(harness.load(args.compare), results, metric=args.metric, threshold=args.threshold)
+        print("")
+        print(harness.format_comparison(comparison))
+        if any([c['regression'] for c in comparison]):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,8 +7,7 @@ from qtpy.QtCore import QSize, Qt
 from utilities import model_list
 
 def dev_list(start_marker, end_marker):
-    l = model_list.model_list(start_element=start_marker, end_element=end_marker)
-    bpm_dev_list = [i['device_name'] for i in l if i['device_name'].startswith('BPM')]
+    bpm_dev_list = model_list.shared_table().devices('BPM', start_marker, end_marker, unique=False)
     devlist = [{"device": devname} for devname in bpm_dev_list]
     return devlist
 
@@ -1,5 +1,4 @@
 import os
-from collections import OrderedDict
 from pydm import Display
 from pydm.widgets import PyDMTemplateRepeater, PyDMTabWidget
 from pydm.utilities import establish_widget_connections, close_widget_connections
@@ -8,10 +7,7 @@ from qtpy.QtCore import QSize, Slot
 from utilities import model_list
 
 def dev_list(start_marker, end_marker, magtype):
-    l = model_list.model_list(start_element=start_marker, end_element=end_marker)
-    mag_dev_list = [i['device_name'] for i in l if i['device_name'].startswith(magtype)]
-    #De-duplicate this list using an ordered dict.
-    mag_dev_list = list(OrderedDict.fromkeys(mag_dev_list))
+    mag_dev_list = model_list.shared_table().devices(magtype, start_marker, end_marker)
     devlist = [{"device_name": devname} for devname in mag_dev_list]
     return devlist
 
@@ -1,5 +1,4 @@
 import os
-from collections import OrderedDict
 from pydm import Display
 from pydm.widgets import PyDMTemplateRepeater
 from qtpy.QtWidgets import QVBoxLayout, QScrollArea
@@ -7,10 +6,7 @@ from qtpy.QtCore import QSize
 from utilities import model_list
 
 def dev_list(start_marker, end_marker):
-    l = model_list.model_list(start_element=start_marker, end_element=end_marker)
-    klystron_dev_list = [i['device_name'] for i in l if i['device_name'].startswith('KLYS')]
-    #De-duplicate this list using an ordered dict.
-    klystron_dev_list = list(OrderedDict.fromkeys(klystron_dev_list))
+    klystron_dev_list = model_list.shared_table().devices('KLYS', start_marker, end_marker)
     devlist = [{"device": devname} for devname in klystron_dev_list]
     return devlist
 
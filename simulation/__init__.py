@@ -0,0 +1,6 @@
+"""An in-process simulated machine, for running and profiling the steering panel and
+the utilities away from the accelerator.  See backends.install()."""
+
+from .lattice import Lattice
+from .machine import SimulatedMachine, Record
+from .backends import install, uninstall, machine
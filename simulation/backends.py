@@ -0,0 +1,455 @@
+"""backends.py - Stand-ins for the control system libraries, served by a SimulatedMachine.
+
+The steering panel and the utilities import pyca and psp (orbits and magnets),
+pyepics (EDEFs, BSA and bulk gets), p4p (the TWISS table) and pvaccess (the model
+service) directly.  install() puts modules with the same names and the parts of the
+same APIs into sys.modules, so the code runs unchanged against the simulation:
+
+    import simulation
+    machine = simulation.install()
+    machine.start()
+    import orbit  #Now talks to the simulated machine.
+
+install() has to run before the modules which use the libraries are imported, because
+they bind the libraries (and, for p4p, open a context) at import time.
+
+Callbacks are called synchronously on whichever thread changed the value: the machine's
+pulse thread for readings, or the writer's thread for puts.
+"""
+
+import os
+import sys
+import time
+import types
+import tempfile
+import numpy as np
+from .machine import SimulatedMachine
+
+try:
+    TimeoutError
+except NameError:
+    #Python 2.
+    class TimeoutError(Exception):
+        pass
+
+#The machine served by the installed modules.
+_machine = None
+#The modules which were replaced by install(), to be restored by uninstall().
+_saved_modules = None
+
+def machine():
+    """Get the machine the installed modules are serving, or None if install() hasn't been called."""
+    return _machine
+
+def _record(name):
+    if _machine is None:
+        raise RuntimeError("No simulated machine installed.  Call simulation.install() first.")
+    return _machine.record(name)
+
+def _split_timestamp(timestamp):
+    seconds = int(timestamp)
+    return (seconds, int(round((timestamp - seconds)*1.0e9)))
+
+def _format(value, count=None, as_string=False):
+    if isinstance(value, np.ndarray):
+        if count is not None:
+            value = value[:count]
+        return value.copy()
+    if as_string:
+        return str(value)
+    return value
+
+#
+# pyca and psp.Pv
+#
+
+class PycaException(Exception):
+    pass
+
+CS_NEVER_CONN = 0
+CS_CONN = 2
+
+class Pv(object):
+    """A psp.Pv.  data holds the latest value, severity, status and timestamp."""
+    def __init__(self, name, initialize=False, count=None, **kw):
+        self.name = name
+        self.data = {}
+        self._state = CS_NEVER_CONN
+        self._monitoring = False
+        self._watching_connection = False
+        self._monitor_callbacks = {}
+        self._connection_callbacks = {}
+        self._next_callback_id = 0
+        if initialize:
+            self.connect(timeout=1.0)
+            self.get(ctrl=False, timeout=1.0)
+
+    def connect(self, timeout=None):
+        record = _record(self.name)
+        if record is not None and not self._watching_connection:
+            _machine.subscribe_connection(self.name, self._connection_changed)
+            self._watching_connection = True
+        self._state = CS_CONN if record is not None and record.connected else CS_NEVER_CONN
+        if self._state != CS_CONN and timeout is not None and timeout >= 0:
+            raise PycaException("Connection to {} timed out.".format(self.name))
+
+    def state(self):
+        return self._state
+
+    def disconnect(self):
+        if self._monitoring:
+            self.unsubscribe()
+        if self._watching_connection:
+            _machine.unsubscribe_connection(self.name, self._connection_changed)
+            self._watching_connection = False
+        self._state = CS_NEVER_CONN
+
+    def _connection_changed(self, connected):
+        self._state = CS_CONN if connected else CS_NEVER_CONN
+        for callback in list(self._connection_callbacks.values()):
+            callback(connected)
+        if connected and self._monitoring:
+            #Channel Access restores monitors on reconnect, with the current value.
+            self._value_changed(_record(self.name))
+
+    def _copy(self, record):
+        (secs, nsec) = _split_timestamp(record.timestamp)
+        self.data.update({'value': _format(record.value), 'severity': record.severity, 'status': record.status, 'secs': secs, 'nsec': nsec})
+
+    def _value_changed(self, record):
+        self._copy(record)
+        for callback in list(self._monitor_callbacks.values()):
+            callback(None)
+
+    def get(self, ctrl=False, timeout=None, **kw):
+        if self._state != CS_CONN:
+            raise PycaException("{} is not connected.".format(self.name))
+        self._copy(_record(self.name))
+        return self.data['value']
+
+    def put(self, value, timeout=None, **kw):
+        if self._state != CS_CONN or not _machine.put(self.name, value):
+            raise PycaException("Put to {} failed.".format(self.name))
+
+    @property
+    def value(self):
+        return self.data.get('value')
+
+    def monitor(self, mask=None, ctrl=False, count=None):
+        if self._state != CS_CONN:
+            raise PycaException("{} is not connected.".format(self.name))
+        if not self._monitoring:
+            _machine.subscribe(self.name, self._value_changed)
+            self._monitoring = True
+        self._value_changed(_record(self.name))
+
+    def unsubscribe(self):
+        if self._monitoring:
+            _machine.unsubscribe(self.name, self._value_changed)
+            self._monitoring = False
+
+    def add_monitor_callback(self, callback):
+        self._next_callback_id += 1
+        self._monitor_callbacks[self._next_callback_id] = callback
+        return self._next_callback_id
+
+    def del_monitor_callback(self, id):
+        self._monitor_callbacks.pop(id, None)
+
+    def add_connection_callback(self, callback):
+        self._next_callback_id += 1
+        self._connection_callbacks[self._next_callback_id] = callback
+        return self._next_callback_id
+
+    def del_connection_callback(self, id):
+        self._connection_callbacks.pop(id, None)
+
+def pend_event(timeout):
+    #Callbacks are delivered as they happen, so there is nothing to wait for but time.
+    time.sleep(max(timeout, 0.0))
+
+def _no_op(*args, **kw):
+    pass
+
+#
+# pyepics (epics and epics.ca)
+#
+
+class ChannelAccessException(Exception):
+    pass
+
+class Channel(object):
+    """A channel ID, as returned by epics.ca.create_channel."""
+    def __init__(self, name):
+        self.name = name
+        self.cleared = False
+
+def create_channel(pvname, connect=False, auto_cb=True, callback=None):
+    return Channel(pvname)
+
+def isConnected(chid):
+    record = _record(chid.name)
+    return not chid.cleared and record is not None and record.connected
+
+def connect_channel(chid, timeout=None, verbose=False):
+    return isConnected(chid)
+
+def ca_get(chid, count=None, as_string=False, wait=True, timeout=None, **kw):
+    if not isConnected(chid):
+        return None
+    if not wait:
+        return None
+    return _format(_record(chid.name).value, count, as_string)
+
+def get_complete(chid, count=None, as_string=False, timeout=None, **kw):
+    if not isConnected(chid):
+        return None
+    return _format(_record(chid.name).value, count, as_string)
+
+def ca_put(chid, value, wait=False, timeout=30, callback=None, callback_data=None):
+    if not isConnected(chid) or not _machine.put(chid.name, value):
+        raise ChannelAccessException("Put to {} failed.".format(chid.name))
+    if callback is not None:
+        callback(pvname=chid.name, data=callback_data)
+    return 1
+
+def poll(evt=1.0e-4, iot=1.0):
+    time.sleep(max(evt, 0.0))
+
+def clear_channel(chid):
+    chid.cleared = True
+
+class PV(object):
+    """An epics.PV.  Callbacks get the same keyword arguments pyepics gives them, and are
+    called once with the current value when the PV connects."""
+    def __init__(self, pvname, callback=None, form='native', auto_monitor=None, connection_callback=None, connection_timeout=None, **kw):
+        self.pvname = pvname
+        self.form = form
+        self.callbacks = {}
+        self.connection_callbacks = []
+        self._next_index = 0
+        self._record = _record(pvname)
+        if connection_callback is not None:
+            self.connection_callbacks.append(connection_callback)
+        if callback is not None:
+            for cb in (callback if isinstance(callback, (list, tuple)) else [callback]):
+                self.add_callback(cb)
+        if self._record is not None:
+            _machine.subscribe(pvname, self._run_callbacks)
+            _machine.subscribe_connection(pvname, self._connection_changed)
+            if self._record.connected:
+                self._run_callbacks(self._record)
+
+    @property
+    def connected(self):
+        return self._record is not None and self._record.connected
+
+    def wait_for_connection(self, timeout=None):
+        return self.connected
+
+    def _connection_changed(self, connected):
+        for callback in list(self.connection_callbacks):
+            callback(pvname=self.pvname, conn=connected, pv=self)
+
+    def _run_callbacks(self, record):
+        (posixseconds, nanoseconds) = _split_timestamp(record.timestamp)
+        value = _format(record.value)
+        for (index, callback) in list(self.callbacks.items()):
+            callback(pvname=self.pvname, value=value, char_value=str(value), status=record.status,
+                     severity=record.severity, timestamp=record.timestamp, posixseconds=posixseconds,
+                     nanoseconds=nanoseconds, cb_info=(index, self))
+
+    def add_callback(self, callback=None, index=None, run_now=False, with_ctrlvars=True, **kw):
+        if index is None:
+            self._next_index += 1
+            index = self._next_index
+        self.callbacks[index] = callback
+        if run_now and self.connected:
+            self._run_callbacks(self._record)
+        return index
+
+    def remove_callback(self, index=None):
+        self.callbacks.pop(index, None)
+
+    def clear_callbacks(self):
+        self.callbacks = {}
+
+    def disconnect(self):
+        if self._record is not None:
+            _machine.unsubscribe(self.pvname, self._run_callbacks)
+            _machine.unsubscribe_connection(self.pvname, self._connection_changed)
+        self.callbacks = {}
+
+    def get(self, count=None, as_string=False, timeout=None, use_monitor=True, **kw):
+        if not self.connected:
+            return None
+        return _format(self._record.value, count, as_string)
+
+    def put(self, value, wait=False, timeout=30.0, use_complete=False, callback=None, callback_data=None):
+        if not self.connected or not _machine.put(self.pvname, value):
+            return None
+        if callback is not None:
+            callback(pvname=self.pvname, data=callback_data)
+        return 1
+
+    def get_ctrlvars(self, timeout=5.0, warn=True):
+        if not self.connected:
+            return None
+        lower = self._record.lower_limit
+        upper = self._record.upper_limit
+        return {'lower_ctrl_limit': lower if lower is not None else 0, 'upper_ctrl_limit': upper if upper is not None else 0}
+
+    @property
+    def value(self):
+        return self.get()
+
+    @property
+    def severity(self):
+        return self._record.severity if self.connected else None
+
+    @property
+    def status(self):
+        return self._record.status if self.connected else None
+
+    @property
+    def timestamp(self):
+        return self._record.timestamp if self.connected else None
+
+def caget(pvname, as_string=False, count=None, timeout=None, use_monitor=False, form='native', **kw):
+    record = _record(pvname)
+    if record is None or not record.connected:
+        return None
+    return _format(record.value, count, as_string)
+
+def caput(pvname, value, wait=False, timeout=60.0, **kw):
+    if not _machine.put(pvname, value):
+        return None
+    return 1
+
+#
+# p4p and pvaccess
+#
+
+class TimeStamp(object):
+    def __init__(self, timestamp):
+        (self.secondsPastEpoch, self.nanoseconds) = _split_timestamp(timestamp)
+
+class TableValue(object):
+    """A p4p Value holding an NTTable: value.items() gives the columns in order."""
+    def __init__(self, columns, timestamp):
+        self.value = columns
+        self.timeStamp = TimeStamp(timestamp)
+
+class Context(object):
+    """A p4p.client.thread.Context.  Serves the BMAD TWISS tables."""
+    def __init__(self, provider='pva', **kw):
+        self.provider = provider
+
+    def get(self, name, request=None, timeout=5.0, throw=True):
+        if _machine is not None and name.startswith("BMAD:") and name.endswith(":TWISS"):
+            return TableValue(_machine.twiss_table(), _machine.model_timestamp)
+        error = TimeoutError("Timeout getting {}".format(name))
+        if throw:
+            raise error
+        return error
+
+    def close(self):
+        pass
+
+class NTTable(object):
+    def __init__(self, columns=[], **kw):
+        self.columns = columns
+
+class PvObject(object):
+    """A pvaccess.PvObject: a structure, whose contents can be set and read as a dict."""
+    def __init__(self, structure, type_id=None, value=None):
+        self.structure = structure
+        self.type_id = type_id
+        self._value = dict(value) if value is not None else {}
+
+    def set(self, value):
+        self._value.update(value)
+
+    def get(self):
+        return dict(self._value)
+
+    def getStructure(self):
+        return self.get()
+
+    def __getitem__(self, key):
+        return self._value[key]
+
+class RpcClient(object):
+    """A pvaccess.RpcClient.  Serves the model service's full machine R matrices."""
+    def __init__(self, channel_name):
+        self.channel_name = channel_name
+
+    def invoke(self, request, timeout=None):
+        return PvObject(None, value=_machine.model_response(self.channel_name))
+
+#
+# Installing the modules.
+#
+
+def _module(name, **contents):
+    module = types.ModuleType(name)
+    module.__dict__.update(contents)
+    module.SIMULATED = True
+    return module
+
+def _make_modules():
+    modules = {}
+    modules['pyca'] = _module('pyca', DBE_VALUE=1, DBE_LOG=2, DBE_ALARM=4, pend_event=pend_event, pend_io=_no_op,
+                              flush_io=_no_op, attach_context=_no_op, pyexc=PycaException, caexc=PycaException)
+    modules['psp.Pv'] = _module('psp.Pv', Pv=Pv)
+    modules['psp'] = _module('psp', Pv=modules['psp.Pv'])
+    modules['epics.ca'] = _module('epics.ca', create_channel=create_channel, isConnected=isConnected, connect_channel=connect_channel,
+                                  get=ca_get, get_complete=get_complete, put=ca_put, poll=poll, pend_event=pend_event, pend_io=_no_op,
+                                  flush_io=_no_op, clear_channel=clear_channel, use_initial_context=_no_op,
+                                  ChannelAccessException=ChannelAccessException)
+    modules['epics'] = _module('epics', PV=PV, caget=caget, caput=caput, ca=modules['epics.ca'])
+    modules['p4p.client.thread'] = _module('p4p.client.thread', Context=Context)
+    modules['p4p.client'] = _module('p4p.client', thread=modules['p4p.client.thread'])
+    modules['p4p.nt'] = _module('p4p.nt', NTTable=NTTable)
+    modules['p4p'] = _module('p4p', client=modules['p4p.client'], nt=modules['p4p.nt'])
+    modules['pvaccess'] = _module('pvaccess', PvObject=PvObject, RpcClient=RpcClient, STRING='STRING', DOUBLE='DOUBLE', INT='INT')
+    return modules
+
+def install(machine=None, **kwargs):
+    """Serve a simulated machine through stand-ins for pyca, psp, epics, p4p and pvaccess.
+
+    Also points MATLABDATAFILES at an LCLS-looking path (so get_system() finds SYS0),
+    and the model cache at a temporary directory, unless they are already set.
+
+    Args:
+        machine (Optional[SimulatedMachine]): The machine to serve.  If None, one is made from kwargs.
+        kwargs: Passed to SimulatedMachine if machine is None.
+    Returns:
+        SimulatedMachine: The machine being served.  It isn't started: call its start() or step().
+    """
+    global _machine, _saved_modules
+    if machine is None:
+        machine = SimulatedMachine(**kwargs)
+    os.environ.setdefault('MATLABDATAFILES', '/simulated/lcls/matlab/data')
+    os.environ.setdefault('SIMUI_CACHE_DIR', tempfile.mkdtemp(prefix='simui-simulation-'))
+    modules = _make_modules()
+    if _saved_modules is None:
+        _saved_modules = dict((name, sys.modules.get(name)) for name in modules)
+    sys.modules.update(modules)
+    _machine = machine
+    return machine
+
+def uninstall():
+    """Stop the installed machine, and put back the modules install() replaced.  Modules
+    which imported the stand-ins keep using them."""
+    global _machine, _saved_modules
+    if _machine is not None:
+        _machine.stop()
+    if _saved_modules is not None:
+        for (name, module) in _saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    _machine = None
+    _saved_modules = None
@@ -0,0 +1,140 @@
+"""lattice.py - A simple linear lattice for the simulated machine.
+
+The optics are deliberately idealized: a constant beta function and a constant
+phase advance per meter in each plane, and an optional constant dispersion.  That
+is enough to give every device a realistic-looking, invertible R matrix (so orbit
+fits and orbit response calculations behave as they do on the real machine),
+without needing a real lattice file.
+"""
+
+import os
+import json
+import pickle
+import numpy as np
+from collections import OrderedDict
+
+#Where the steering panel keeps its device lists.
+STEERING_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steering')
+
+class Lattice(object):
+    """The devices in the simulated machine, and the optics between them.
+
+    Args:
+        bpms (list of (str, float)): BPM names and Z positions, in meters.
+        xcors (list of (str, float)): Horizontal corrector names and Z positions.
+        ycors (list of (str, float)): Vertical corrector names and Z positions.
+        beta (Optional[float]): The beta function (in both planes), in meters.
+        mu_x (Optional[float]): The horizontal phase advance, in radians per meter.
+        mu_y (Optional[float]): The vertical phase advance, in radians per meter.
+        eta (Optional[float]): The horizontal dispersion, in meters.
+        p_start (Optional[float]): The beam momentum at the start of the lattice, in eV/c.
+        p_end (Optional[float]): The beam momentum at the end of the lattice, in eV/c.
+    """
+    def __init__(self, bpms, xcors, ycors, beta=40.0, mu_x=0.031, mu_y=0.029, eta=0.0, p_start=0.135e9, p_end=13.6e9):
+        self.bpms = [(str(name), float(z)) for (name, z) in bpms]
+        self.xcors = [(str(name), float(z)) for (name, z) in xcors]
+        self.ycors = [(str(name), float(z)) for (name, z) in ycors]
+        self.beta = beta
+        self.mu_x = mu_x
+        self.mu_y = mu_y
+        self.eta = eta
+        self.p_start = p_start
+        self.p_end = p_end
+        devices = self.bpms + self.xcors + self.ycors
+        self.zmin = min([z for (name, z) in devices])
+        self.zmax = max([z for (name, z) in devices])
+
+    @classmethod
+    def default(cls, **kwargs):
+        """Make a lattice with the steering panel's BPMs and correctors.  The correctors
+        keep their Z positions.  The BPM list has no Z positions, so the BPMs are spread
+        evenly (in list order) over the same span."""
+        with open(os.path.join(STEERING_DIR, 'bpm_names.pkl'), 'rb') as f:
+            bpm_names = pickle.load(f)
+        bpm_names = [name.decode('utf-8') if isinstance(name, bytes) else name for name in bpm_names]
+        (xcors, ycors) = [cls._load_correctors(os.path.join(STEERING_DIR, filename)) for filename in ('xcor_list.json', 'ycor_list.json')]
+        z = [z for (name, z) in xcors + ycors]
+        bpm_z = np.linspace(min(z) + 0.5, max(z) + 0.5, len(bpm_names))
+        return cls(list(zip(bpm_names, bpm_z)), xcors, ycors, **kwargs)
+
+    @staticmethod
+    def _load_correctors(path):
+        with open(path) as f:
+            return [(mag['device_name'], mag['z_pos']) for mag in json.load(f)]
+
+    def devices(self):
+        """Get every device as (name, z), sorted by Z."""
+        return sorted(self.bpms + self.xcors + self.ycors, key=lambda device: device[1])
+
+    def p0c(self, z):
+        """Get the beam momentum (in eV/c) at each Z position.  It rises linearly along the lattice."""
+        frac = (np.asarray(z, dtype=float) - self.zmin)/max(self.zmax - self.zmin, 1.0)
+        return self.p_start + frac*(self.p_end - self.p_start)
+
+    def r_mats(self, z):
+        """Get the R matrix from the start of the lattice to each Z position, as an Nx6x6 array."""
+        s = np.asarray(z, dtype=float) - self.zmin
+        mats = np.tile(np.eye(6), (len(s), 1, 1))
+        for (i, mu) in ((0, self.mu_x), (2, self.mu_y)):
+            psi = mu*s
+            mats[:, i, i] = np.cos(psi)
+            mats[:, i, i+1] = self.beta*np.sin(psi)
+            mats[:, i+1, i] = -np.sin(psi)/self.beta
+            mats[:, i+1, i+1] = np.cos(psi)
+        mats[:, 0, 5] = self.eta*np.sin(self.mu_x*s)
+        return mats
+
+    def response(self, bpm_z, cor_z, plane):
+        """Get the orbit response (mm at each BPM per radian of kick at each corrector),
+        as an (n_bpms x n_correctors) array.  Consistent with r_mats()."""
+        bpm_z = np.asarray(bpm_z, dtype=float)[:, np.newaxis]
+        cor_z = np.asarray(cor_z, dtype=float)[np.newaxis, :]
+        mu = self.mu_x if plane == 'x' else self.mu_y
+        #With a constant beta, R12 from a to b is beta*sin(mu*(z_b - z_a)).
+        return np.where(bpm_z > cor_z, 1000.0*self.beta*np.sin(mu*(bpm_z - cor_z)), 0.0)
+
+    def model_columns(self):
+        """Get the full machine model, as the column dictionary the model service returns."""
+        devices = self.devices()
+        names = [name for (name, z) in devices]
+        z = np.array([z for (name, z) in devices])
+        mats = self.r_mats(z)
+        columns = OrderedDict()
+        columns['ORDINAL'] = np.arange(len(devices), dtype=np.int32)
+        columns['ELEMENT_NAME'] = [name.replace(':', '_') for name in names]
+        columns['EPICS_CHANNEL_ACCESS_NAME'] = names
+        columns['POSITION_INDEX'] = ['MIDDLE']*len(devices)
+        columns['Z_POSITION'] = z
+        for i in range(6):
+            for j in range(6):
+                columns['R{}{}'.format(i+1, j+1)] = mats[:, i, j]
+        return columns
+
+    def twiss_columns(self):
+        """Get the TWISS table, as an ordered column dictionary in the layout of the BMAD TWISS PV."""
+        devices = self.devices()
+        names = [name for (name, z) in devices]
+        z = np.array([z for (name, z) in devices])
+        s = z - self.zmin
+        mats = self.r_mats(z)
+        n = len(devices)
+        columns = OrderedDict()
+        columns['element'] = [name.replace(':', '_') for name in names]
+        columns['device_name'] = names
+        columns['s'] = s
+        columns['length'] = np.zeros(n)
+        columns['p0c'] = self.p0c(z)
+        columns['alpha_x'] = np.zeros(n)
+        columns['beta_x'] = np.full(n, self.beta)
+        columns['eta_x'] = mats[:, 0, 5]
+        columns['etap_x'] = np.zeros(n)
+        columns['psi_x'] = self.mu_x*s
+        columns['alpha_y'] = np.zeros(n)
+        columns['beta_y'] = np.full(n, self.beta)
+        columns['eta_y'] = np.zeros(n)
+        columns['etap_y'] = np.zeros(n)
+        columns['psi_y'] = self.mu_y*s
+        for i in range(6):
+            for j in range(6):
+                columns['r{}{}'.format(i+1, j+1)] = mats[:, i, j]
+        return columns
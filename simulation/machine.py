@@ -0,0 +1,475 @@
+"""machine.py - An in-process simulated accelerator, served as a set of process variables.
+
+The machine holds a record for every PV the steering panel and the utilities use: BPM
+X/Y/TMIT/Z readings, corrector BCTRL/BACT, the event definition (EDEF) system, and
+beam synchronous acquisition (BSA) buffers.  Each beam pulse (step()) produces a new
+orbit from the lattice, the corrector settings and some noise, updates the BPM
+records, and feeds every running EDEF.  The fake control system modules in
+simulation.backends read and write these records, so code written against pyca,
+psp, pyepics, p4p and pvaccess runs unchanged against the simulation.
+"""
+
+import re
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from .lattice import Lattice
+
+#Converts an integrated field in kG-m to a kick in radians, at a momentum in GeV/c.
+KICK_PER_KGM = 0.0299792458
+NUM_EDEFS = 15
+NUM_MASK_BITS = 160
+#EPICS alarm severities.
+NO_ALARM = 0
+MAJOR_ALARM = 2
+#Names for the first few EDEF mask bits.  The rest are just "BIT{n}".
+MASK_BIT_NAMES = ('TS1', 'TS2', 'TS3', 'TS4', 'TS5', 'TS6', 'POCKCEL_PERM', 'BEAMFULL', 'DUMP_2_9', 'NO_GUN_PERM')
+MAX_PULSE_ID = 0x1FFFF
+
+class Record(object):
+    """One simulated PV: a value, with alarm severity, status and timestamp.
+    If getter is set, the value is computed each time it is read (for BSA buffers)."""
+    def __init__(self, name, value, lower_limit=None, upper_limit=None, getter=None, writable=True):
+        self.name = name
+        self._value = value
+        self.severity = NO_ALARM
+        self.status = 0
+        self.timestamp = time.time()
+        self.lower_limit = lower_limit
+        self.upper_limit = upper_limit
+        self.getter = getter
+        self.writable = writable
+        self.connected = True
+        self.subscribers = []
+        self.connection_subscribers = []
+
+    @property
+    def value(self):
+        if self.getter is not None:
+            return self.getter()
+        return self._value
+
+    @value.setter
+    def value(self, new_value):
+        self._value = new_value
+
+class EdefState(object):
+    """The state of one event definition, including its BSA buffers."""
+    def __init__(self, num, num_columns, length):
+        self.num = num
+        self.shape = (length, num_columns)
+        #The buffers are made the first time they are needed: with thousands of BPMs,
+        #every edef's buffers together would take gigabytes.
+        self.data = None
+        self.rms = None
+        #Per-pulse records ("{pv}{num}") which exist, as (column, record).
+        self.pulse_records = []
+        self.reset()
+
+    def buffers(self):
+        """Get the (data, rms) buffers, making them if needed."""
+        if self.data is None:
+            self.data = np.zeros(self.shape)
+            self.rms = np.zeros(self.shape)
+        return (self.data, self.rms)
+
+    def column(self, column, rms=False):
+        """Get a copy of one column of the data (or RMS) buffer."""
+        if self.data is None:
+            return np.zeros(self.shape[0])
+        return (self.rms if rms else self.data)[:, column].copy()
+
+    def reset(self):
+        if self.data is not None:
+            self.data[:] = 0.0
+            self.rms[:] = 0.0
+        self._sum = None
+        self._sum_sq = None
+        self._shots = 0
+
+    def accumulate(self, row, avg):
+        """Add one pulse.  Returns the (mean, rms) rows once avg pulses have been added, otherwise None."""
+        if self._shots == 0:
+            self._sum = np.zeros_like(row)
+            self._sum_sq = np.zeros_like(row)
+        self._sum += row
+        self._sum_sq += row*row
+        self._shots += 1
+        if self._shots < avg:
+            return None
+        mean = self._sum/self._shots
+        rms = np.sqrt(np.maximum(self._sum_sq/self._shots - mean*mean, 0.0))
+        #The pulse ID of a measurement is the ID of its last pulse.
+        mean[0] = row[0]
+        rms[0] = 0.0
+        self._shots = 0
+        return (mean, rms)
+
+class SimulatedMachine(object):
+    """A simulated accelerator.
+
+    Args:
+        lattice (Optional[Lattice]): The devices and optics.  Defaults to Lattice.default().
+        sys (Optional[str]): The timing system name used in EDEF PV names.
+        ioc_location (Optional[str]): The location of the EDEF reservation IOC.
+        rate (Optional[float]): The beam rate in Hz, used by start().
+        noise (Optional[float]): The RMS BPM position noise, in mm.
+        tmit (Optional[float]): The bunch charge, in electrons.
+        tmit_jitter (Optional[float]): The relative RMS jitter of the bunch charge.
+        orbit_amplitude (Optional[float]): The size of the incoming orbit error, in mm.
+        bsa_length (Optional[int]): The length of the BSA buffers.
+        seed (Optional[int]): A seed for the random numbers, for reproducible runs.
+    """
+    def __init__(self, lattice=None, sys='SYS0', ioc_location='IN20', rate=120.0, noise=0.005, tmit=1.5e9, tmit_jitter=0.01, orbit_amplitude=0.2, bsa_length=2800, seed=None):
+        self.lattice = lattice if lattice is not None else Lattice.default()
+        self.sys = sys
+        self.ioc_location = ioc_location
+        self.rate = rate
+        self.noise = noise
+        self.tmit = tmit
+        self.tmit_jitter = tmit_jitter
+        self.bsa_length = bsa_length
+        self.beam_on = True
+        self.pulse_id = 0
+        self.pulses = 0
+        #When the model was 'last changed', for the model tables' timestamps.
+        self.model_timestamp = time.time()
+        self._rng = np.random.RandomState(seed)
+        self._lock = threading.RLock()
+        self._records = {}
+        self._thread = None
+        self._running = False
+        self._build_devices(orbit_amplitude)
+        self._build_edefs()
+        self._patterns = [
+            (re.compile(r'^(?P<pv>.+?)(?P<suffix>RMSHST|HST)(?P<num>\d+)$'), self._make_buffer_record),
+            (re.compile(r'^EDEF:{sys}:(?P<num>\d+):(?P<kind>INCM|EXCM)(?P<bit>\d+)(?P<desc>\.DESC)?$'.format(sys=re.escape(sys))), self._make_mask_record),
+            (re.compile(r'^(?P<pv>.+?)(?P<num>\d+)$'), self._make_pulse_record),
+        ]
+
+    def _build_devices(self, orbit_amplitude):
+        self.bpm_names = [name for (name, z) in self.lattice.bpms]
+        self.bpm_z = np.array([z for (name, z) in self.lattice.bpms])
+        self.magnet_names = {}
+        self._kick_per_kgm = {}
+        self._response = {}
+        self._bctrl = {}
+        for (plane, cors) in (('x', self.lattice.xcors), ('y', self.lattice.ycors)):
+            z = np.array([z for (name, z) in cors])
+            self.magnet_names[plane] = [name for (name, z) in cors]
+            self._kick_per_kgm[plane] = KICK_PER_KGM/(self.lattice.p0c(z)*1.0e-9)
+            self._response[plane] = self.lattice.response(self.bpm_z, z, plane)
+            self._bctrl[plane] = np.zeros(len(cors))
+        #The incoming orbit error is a betatron oscillation from random initial conditions.
+        mats = self.lattice.r_mats(self.bpm_z)
+        self._design = {}
+        for (plane, i) in (('x', 0), ('y', 2)):
+            (pos, ang) = self._rng.normal(0.0, orbit_amplitude, 2)
+            self._design[plane] = mats[:, i, i]*pos + mats[:, i, i+1]*ang/self.lattice.beta
+        self._orbit = {'x': self._design['x'].copy(), 'y': self._design['y'].copy()}
+        for (name, z) in zip(self.bpm_names, self.bpm_z):
+            self._add(Record(name + ":Z", z, writable=False))
+            for axis in ('X', 'Y', 'TMIT'):
+                self._add(Record(name + ":" + axis, 0.0, writable=False))
+        self._magnet_index = {}
+        for plane in ('x', 'y'):
+            for (i, name) in enumerate(self.magnet_names[plane]):
+                self._magnet_index[name] = (plane, i)
+                self._add(Record(name + ":BCTRL", 0.0, lower_limit=-0.02, upper_limit=0.02))
+                self._add(Record(name + ":BACT", 0.0, writable=False))
+        #The BSA PVs, in buffer column order.
+        self.bsa_pvs = ["PATT:{sys}:1:PULSEID".format(sys=self.sys)]
+        for axis in ('X', 'Y', 'TMIT'):
+            self.bsa_pvs.extend([name + ":" + axis for name in self.bpm_names])
+        self._bsa_columns = {pv: i for (i, pv) in enumerate(self.bsa_pvs)}
+
+    def _build_edefs(self):
+        self._edefs = OrderedDict()
+        for num in range(1, NUM_EDEFS+1):
+            self._edefs[num] = EdefState(num, len(self.bsa_pvs), self.bsa_length)
+            prefix = "EDEF:{sys}:{num}:".format(sys=self.sys, num=num)
+            self._add(Record(prefix + "NAME", ""))
+            self._add(Record(prefix + "USERNAME", ""))
+            self._add(Record(prefix + "CTRL", 0))
+            self._add(Record(prefix + "AVGCNT", 1, lower_limit=1, upper_limit=1000))
+            self._add(Record(prefix + "MEASCNT", 1, lower_limit=-1, upper_limit=self.bsa_length))
+            self._add(Record(prefix + "CNT", 0, writable=False))
+            self._add(Record(prefix + "CNTMAX", self.bsa_length, writable=False))
+            self._add(Record(prefix + "FREE", 0))
+        ioc = "IOC:{iocloc}:EV01:".format(iocloc=self.ioc_location)
+        self._add(Record(ioc + "EDEFNAME", ""))
+        self._add(Record(ioc + "EDEFAVAIL", NUM_EDEFS, writable=False))
+
+    def _add(self, record):
+        self._records[record.name] = record
+        return record
+
+    def record(self, name):
+        """Get the record for a PV, or None if the machine has no such PV.  BSA buffer,
+        per-pulse BSA and EDEF mask records are made the first time they are asked for."""
+        with self._lock:
+            try:
+                return self._records[name]
+            except KeyError:
+                pass
+            for (pattern, factory) in self._patterns:
+                match = pattern.match(name)
+                if match is None:
+                    continue
+                record = factory(name, match)
+                if record is not None:
+                    return self._add(record)
+            return None
+
+    def _edef_num(self, num):
+        num = int(num)
+        return num if num in self._edefs else None
+
+    def _make_buffer_record(self, name, match):
+        num = self._edef_num(match.group('num'))
+        column = self._bsa_columns.get(match.group('pv'))
+        if num is None or column is None:
+            return None
+        edef = self._edefs[num]
+        rms = match.group('suffix') == 'RMSHST'
+        return Record(name, None, getter=lambda: edef.column(column, rms), writable=False)
+
+    def _make_pulse_record(self, name, match):
+        num = self._edef_num(match.group('num'))
+        column = self._bsa_columns.get(match.group('pv'))
+        if num is None or column is None:
+            return None
+        record = Record(name, 0.0, writable=False)
+        self._edefs[num].pulse_records.append((column, record))
+        return record
+
+    def _make_mask_record(self, name, match):
+        if self._edef_num(match.group('num')) is None or not (1 <= int(match.group('bit')) <= NUM_MASK_BITS):
+            return None
+        bit = int(match.group('bit'))
+        if match.group('desc'):
+            desc = MASK_BIT_NAMES[bit-1] if bit <= len(MASK_BIT_NAMES) else "BIT{}".format(bit)
+            return Record(name, desc, writable=False)
+        #Masks are stored, but every pulse is included in the simulation.
+        return Record(name, 0)
+
+    def names(self):
+        """Get the names of the records which exist right now (lazily made records are only
+        included once something has asked for them)."""
+        with self._lock:
+            return list(self._records)
+
+    def subscribe(self, name, callback):
+        """Call callback(record) whenever a PV's value changes.  Returns False if there is no such PV."""
+        record = self.record(name)
+        if record is None:
+            return False
+        with self._lock:
+            record.subscribers.append(callback)
+        return True
+
+    def unsubscribe(self, name, callback):
+        record = self.record(name)
+        with self._lock:
+            if record is not None and callback in record.subscribers:
+                record.subscribers.remove(callback)
+
+    def subscribe_connection(self, name, callback):
+        """Call callback(connected) whenever a PV connects or disconnects."""
+        record = self.record(name)
+        if record is None:
+            return False
+        with self._lock:
+            record.connection_subscribers.append(callback)
+        return True
+
+    def unsubscribe_connection(self, name, callback):
+        record = self.record(name)
+        with self._lock:
+            if record is not None and callback in record.connection_subscribers:
+                record.connection_subscribers.remove(callback)
+
+    def set_connected(self, name, connected):
+        """Disconnect (or reconnect) a PV, as if its IOC went away (or came back)."""
+        record = self.record(name)
+        with self._lock:
+            record.connected = connected
+            callbacks = list(record.connection_subscribers)
+        for callback in callbacks:
+            callback(connected)
+
+    def _set(self, record, value, events, severity=NO_ALARM, timestamp=None):
+        """Update a record, and queue its subscribers to be called once the lock is released."""
+        record.value = value
+        record.severity = severity
+        record.timestamp = timestamp if timestamp is not None else time.time()
+        if len(record.subscribers) > 0:
+            events.append((list(record.subscribers), record))
+
+    def _dispatch(self, events):
+        for (callbacks, record) in events:
+            for callback in callbacks:
+                callback(record)
+
+    def put(self, name, value):
+        """Write to a PV, like a CA put.  Returns False if the PV doesn't exist, is
+        disconnected, or can't be written."""
+        record = self.record(name)
+        if record is None or not record.connected or not record.writable:
+            return False
+        events = []
+        with self._lock:
+            if record.lower_limit is not None:
+                value = min(max(value, record.lower_limit), record.upper_limit)
+            self._set(record, value, events)
+            self._handle_put(name, value, events)
+        self._dispatch(events)
+        return True
+
+    def _handle_put(self, name, value, events):
+        if name.endswith(":BCTRL"):
+            (plane, i) = self._magnet_index[name[:-len(":BCTRL")]]
+            self._bctrl[plane][i] = value
+            self._set(self._records[name[:-len(":BCTRL")] + ":BACT"], value, events)
+            self._update_orbit()
+            return
+        if name == "IOC:{iocloc}:EV01:EDEFNAME".format(iocloc=self.ioc_location):
+            self._reserve(value, events)
+            return
+        match = re.match(r'^EDEF:{sys}:(\d+):(CTRL|FREE)$'.format(sys=re.escape(self.sys)), name)
+        if match is None:
+            return
+        num = int(match.group(1))
+        if match.group(2) == "FREE" and value:
+            self._free(num, events)
+        elif match.group(2) == "CTRL" and value:
+            #Starting an acquisition clears the edef's buffers.
+            self._edefs[num].reset()
+            self._set(self._edef_record(num, "CNT"), 0, events)
+
+    def _edef_record(self, num, field):
+        return self._records["EDEF:{sys}:{num}:{field}".format(sys=self.sys, num=num, field=field)]
+
+    def _reserve(self, name, events):
+        for num in self._edefs:
+            if self._edef_record(num, "NAME").value == "":
+                self._set(self._edef_record(num, "NAME"), name, events)
+                self._update_available(events)
+                return num
+        return None
+
+    def _free(self, num, events):
+        self._set(self._edef_record(num, "CTRL"), 0, events)
+        self._set(self._edef_record(num, "NAME"), "", events)
+        self._set(self._edef_record(num, "USERNAME"), "", events)
+        self._set(self._edef_record(num, "FREE"), 0, events)
+        self._edefs[num].reset()
+        self._update_available(events)
+
+    def _update_available(self, events):
+        available = len([num for num in self._edefs if self._edef_record(num, "NAME").value == ""])
+        self._set(self._records["IOC:{iocloc}:EV01:EDEFAVAIL".format(iocloc=self.ioc_location)], available, events)
+
+    def _update_orbit(self):
+        for plane in ('x', 'y'):
+            kicks = self._bctrl[plane]*self._kick_per_kgm[plane]
+            self._orbit[plane] = self._design[plane] + np.dot(self._response[plane], kicks)
+
+    def orbit(self, plane):
+        """Get the noise-free orbit (one value per BPM, in mm) for the current corrector settings."""
+        with self._lock:
+            return self._orbit[plane].copy()
+
+    def step(self, pulses=1):
+        """Simulate some beam pulses."""
+        for i in range(pulses):
+            events = []
+            with self._lock:
+                self._pulse(events)
+            self._dispatch(events)
+
+    def _pulse(self, events):
+        now = time.time()
+        self.pulse_id = (self.pulse_id + 1) % (MAX_PULSE_ID + 1)
+        self.pulses += 1
+        n = len(self.bpm_names)
+        if self.beam_on:
+            x = self._orbit['x'] + self._rng.normal(0.0, self.noise, n)
+            y = self._orbit['y'] + self._rng.normal(0.0, self.noise, n)
+            tmit = self.tmit*(1.0 + self._rng.normal(0.0, self.tmit_jitter, n))
+            severity = NO_ALARM
+        else:
+            x = np.zeros(n)
+            y = np.zeros(n)
+            tmit = np.abs(self._rng.normal(0.0, 1.0e6, n))
+            severity = MAJOR_ALARM
+        for (axis, values) in (('X', x), ('Y', y), ('TMIT', tmit)):
+            for (name, value) in zip(self.bpm_names, values.tolist()):
+                self._set(self._records[name + ":" + axis], value, events, severity=severity, timestamp=now)
+        row = np.concatenate(([self.pulse_id], x, y, tmit))
+        for (num, edef) in self._edefs.items():
+            if self._edef_record(num, "CTRL").value:
+                self._acquire(edef, row, events, now)
+
+    def _acquire(self, edef, row, events, now):
+        num = edef.num
+        measurement = edef.accumulate(row, max(int(self._edef_record(num, "AVGCNT").value), 1))
+        if measurement is None:
+            return
+        (mean, rms) = measurement
+        count = int(self._edef_record(num, "CNT").value)
+        (data_buffer, rms_buffer) = edef.buffers()
+        data_buffer[count % self.bsa_length] = mean
+        rms_buffer[count % self.bsa_length] = rms
+        for (column, record) in edef.pulse_records:
+            self._set(record, mean[column], events, timestamp=now)
+        count += 1
+        self._set(self._edef_record(num, "CNT"), count, events, timestamp=now)
+        n_meas = int(self._edef_record(num, "MEASCNT").value)
+        if n_meas > 0 and count >= n_meas:
+            self._set(self._edef_record(num, "CTRL"), 0, events, timestamp=now)
+
+    def start(self, rate=None):
+        """Run the machine on a background thread, at rate (or self.rate) pulses per second.
+        The rate can be changed while it runs by setting self.rate."""
+        if rate is not None:
+            self.rate = rate
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="SimulatedMachine")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        next_pulse = time.time()
+        while self._running:
+            if self.rate <= 0:
+                time.sleep(0.05)
+                next_pulse = time.time()
+                continue
+            self.step()
+            next_pulse += 1.0/self.rate
+            delay = next_pulse - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                #Don't try to catch up on pulses we fell behind on.
+                next_pulse = time.time()
+
+    def model_response(self, path):
+        """Answer a model service RPC (MODEL:RMATS:{EXTANT|DESIGN}:FULLMACHINE) with a column dictionary."""
+        if not re.match(r'^MODEL:RMATS:(EXTANT|DESIGN):FULLMACHINE$', path):
+            raise KeyError("No model service at {}".format(path))
+        return self.lattice.model_columns()
+
+    def twiss_table(self):
+        """The BMAD TWISS table, as an ordered column dictionary."""
+        return self.lattice.twiss_columns()
@@ -0,0 +1,165 @@
+import time
+from PyQt5.QtCore import QObject, QTimer, QEvent, pyqtSignal, pyqtSlot
+
+class FrameGovernor(QObject):
+    """A drop-in replacement for the QTimer which drives OrbitView redraws, which picks
+    its own interval.
+
+    The governor has the parts of the QTimer API the views use (timeout, start, stop,
+    setInterval, interval and isActive), so it can be passed anywhere a draw timer is
+    expected.  Any number of views can share one governor: they all redraw on the same
+    tick, so the display repaints once per tick instead of once per view.
+
+    After every tick the governor adjusts the interval:
+      * If any view drew a new frame, data is arriving at least as fast as we draw,
+        so the next tick comes sooner.  If every view skipped its frame, the next tick
+        comes later.  This settles at roughly twice the BPM update rate, and drifts
+        down to max_interval when the beam is off.
+      * The interval never goes below render_cost/max_load, so that at most max_load
+        of the GUI thread's time goes to drawing.
+      * If a tick fires more than one interval late (the event loop is busy painting,
+        or the machine is loaded), the interval is doubled.
+    Ticks are single shots, rescheduled after the views have redrawn, so they can't
+    pile up behind a slow frame.
+
+    The governor pauses while every view it drives is hidden or minimized."""
+    timeout = pyqtSignal()
+    #Bounds on the interval, in milliseconds.
+    min_interval = 1000.0/60.0
+    max_interval = 1000.0
+    #How much to change the interval after a fresh or a stale tick.
+    speedup = 0.8
+    slowdown = 1.25
+    #The fraction of time the GUI thread may spend redrawing.
+    max_load = 0.5
+    #The weight of the newest sample in the render cost and lateness averages.
+    smoothing = 0.2
+    def __init__(self, parent=None):
+        super(FrameGovernor, self).__init__(parent=parent)
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._tick)
+        self._interval = self.min_interval
+        self._active = False
+        self._paused = False
+        self._views = []
+        self._last_tick = None
+        self.render_cost = 0.0
+        self.lateness = 0.0
+        self.ticks = 0
+        self.fresh_ticks = 0
+        #Incremented before every tick.  Views pass it to BaseOrbit.snapshot, so they share a snapshot per tick.
+        self.frame = 0
+        self.overruns = 0
+
+    def setInterval(self, msec):
+        """Set the interval to start from.  The governor adjusts it from there."""
+        self._interval = min(max(float(msec), self.min_interval), self.max_interval)
+
+    def interval(self):
+        return int(round(self._interval))
+
+    def isActive(self):
+        return self._active
+
+    @pyqtSlot()
+    def start(self, msec=None):
+        if msec is not None:
+            self.setInterval(msec)
+        self._active = True
+        self._last_tick = None
+        self._schedule()
+
+    @pyqtSlot()
+    def stop(self):
+        self._active = False
+        self._timer.stop()
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def add_view(self, view):
+        """Start driving a view.  Its frame counters tell the governor whether ticks
+        are finding new data, and its visibility decides whether the governor pauses."""
+        if view in self._views:
+            return
+        self._views.append(view)
+        view.installEventFilter(self)
+        self._update_paused()
+
+    def remove_view(self, view):
+        if view not in self._views:
+            return
+        self._views.remove(view)
+        view.removeEventFilter(self)
+        self._update_paused()
+
+    def eventFilter(self, obj, event):
+        if event.type() in (QEvent.Show, QEvent.Hide, QEvent.WindowStateChange):
+            if event.type() == QEvent.Show and obj in self._views:
+                #Minimizing only sends a WindowStateChange to the top level window, so watch that too.
+                obj.window().installEventFilter(self)
+            self._update_paused()
+        return False
+
+    def _showing(self, view):
+        return view.isVisible() and not view.window().isMinimized()
+
+    def _update_paused(self):
+        paused = len(self._views) > 0 and not any([self._showing(view) for view in self._views])
+        if paused == self._paused:
+            return
+        self._paused = paused
+        if paused:
+            self._timer.stop()
+        else:
+            self._last_tick = None
+            self._schedule()
+
+    def _schedule(self):
+        if self._active and not self._paused:
+            self._timer.start(int(round(self._interval)))
+
+    def _frames_drawn(self):
+        return sum([getattr(view, 'frames_drawn', 0) for view in self._views])
+
+    def rate(self):
+        """The current tick rate, in Hz."""
+        return 1000.0/self._interval
+
+    @pyqtSlot()
+    def _tick(self):
+        now = time.time()
+        late = 0.0
+        if self._last_tick is not None:
+            late = max(1000.0*(now - self._last_tick) - self._interval, 0.0)
+        self._last_tick = now
+        drawn_before = self._frames_drawn()
+        self.frame += 1
+        self.timeout.emit()
+        cost = 1000.0*(time.time() - now)
+        #Without any views to ask, assume every tick drew something new.
+        fresh = len(self._views) == 0 or self._frames_drawn() > drawn_before
+        self.ticks += 1
+        if fresh:
+            self.fresh_ticks += 1
+            #Only frames which actually drew say anything about render cost.
+            self.render_cost += self.smoothing*(cost - self.render_cost)
+        self.lateness += self.smoothing*(late - self.lateness)
+        if late > self._interval:
+            self.overruns += 1
+            interval = 2.0*self._interval
+        elif fresh:
+            interval = self.speedup*self._interval
+        else:
+            interval = self.slowdown*self._interval
+        interval = max(interval, self.render_cost/self.max_load)
+        self._interval = min(max(interval, self.min_interval), self.max_interval)
+        self._schedule()
+
+    def stats(self):
+        """Get a dictionary of the governor's current state, for profiling."""
+        return {'interval_ms': self._interval, 'rate_hz': self.rate(), 'render_cost_ms': self.render_cost,
+                'lateness_ms': self.lateness, 'ticks': self.ticks, 'fresh_ticks': self.fresh_ticks,
+                'overruns': self.overruns, 'paused': self._paused}
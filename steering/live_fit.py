@@ -0,0 +1,171 @@
+import threading
+import time
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+from orbit import NoValidBPMDataException
+import utilities.trajectory_fit as trajectory_fit
+
+class LiveFitter(QObject):
+    """Continuously fits a trajectory to a live orbit, on a background thread.
+
+    On every tick of its timer (usually the display's frame governor), the fitter takes
+    a snapshot of the orbit.  If the orbit has changed since the last snapshot, the
+    snapshot goes into a single 'latest request' slot, and a worker thread
+    fits whatever is in the slot.  A request which is replaced before the worker gets to
+    it is dropped, so the fit never falls behind the orbit, however slow it is.
+
+    Each finished fit is stored in the orbit's fit_data (so OrbitViews with display_fit
+    enabled draw it), and emitted with fitUpdated.  A fit with no usable BPMs is
+    published as None.  Fits requested before the last stop() or set_region() are
+    never published.
+
+    Parameters
+    ----------
+    orbit : BaseOrbit
+        The orbit to fit.
+    start, end, fit_point : BaseBPM or int
+        The fit region and fit point, as for BaseOrbit.fit.
+    timer : Optional[QTimer or FrameGovernor]
+        The timer to update on.  Sharing the views' frame governor lets the fitter use
+        the same snapshot as the views.
+    fit_options :
+        fit_xpos, fit_xang, etc., as for BaseOrbit.fit.
+    """
+    fitUpdated = pyqtSignal(object)
+    #Emitted by the worker thread, and delivered on the GUI thread.
+    _fitFinished = pyqtSignal(object, float, int)
+    def __init__(self, orbit, start, end, fit_point, timer=None, parent=None, **fit_options):
+        super(LiveFitter, self).__init__(parent=parent)
+        self.orbit = orbit
+        self.fitter = trajectory_fit.TrajectoryFitter()
+        self._fit_args = (start, end, fit_point)
+        self._fit_options = fit_options
+        self._condition = threading.Condition()
+        self._request = None
+        self._thread = None
+        self._running = False
+        self._last_seq = None
+        #Bumped whenever fits in progress become stale, so their results are dropped.
+        self._generation = 0
+        self._fitFinished.connect(self._publish)
+        self.timer = None
+        self.last_error = None
+        self.reset_stats()
+        if timer is not None:
+            self.set_timer(timer)
+
+    def set_timer(self, new_timer):
+        if self.timer is not None:
+            self.timer.timeout.disconnect(self.update)
+        self.timer = new_timer
+        if self.timer is not None:
+            self.timer.timeout.connect(self.update)
+
+    def reset_stats(self):
+        self.requests = 0
+        self.fits = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency = None
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+
+    def set_region(self, start, end, fit_point, **fit_options):
+        """Change the fit region, fit point, and (optionally) fit options."""
+        self._fit_args = (start, end, fit_point)
+        self._fit_options.update(fit_options)
+        self._last_seq = None
+        with self._condition:
+            self._generation += 1
+            self._request = None
+
+    def is_running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._last_seq = None
+        self._thread = threading.Thread(target=self._run, name="LiveFitter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._request = None
+            self._generation += 1
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @pyqtSlot()
+    def update(self):
+        """Snapshot the orbit and queue a fit, if the orbit has changed.  Call this from the GUI thread."""
+        if not self._running:
+            return
+        snapshot = self.orbit.snapshot(frame=getattr(self.timer, 'frame', None))
+        if snapshot.seq is not None and snapshot.seq == self._last_seq:
+            return
+        self._last_seq = snapshot.seq
+        #The fit indices and R matrices come from the orbit (and maybe the model), so they are prepared here.
+        (start_index, end_index, fit_point_index, z0) = self.orbit._fit_indices(*self._fit_args)
+        enabled = self.orbit._fit_options(True, True, True, True, True, True, True, self._fit_options)
+        Rs = self.orbit.rmats_for_fit(fit_point_index)
+        with self._condition:
+            request = (snapshot, Rs, start_index, end_index, z0, enabled, time.time(), self._generation)
+            if self._request is not None:
+                self.dropped += 1
+            self._request = request
+            self.requests += 1
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and self._request is None:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                (snapshot, Rs, start, end, z0, enabled, requested, generation) = self._request
+                self._request = None
+            try:
+                result = self.fitter.fit(Rs, snapshot['z'], snapshot['x'], snapshot['y'], snapshot['x_rms'], snapshot['y_rms'], snapshot['tmit_severity'], start, end, z0, enabled)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+                continue
+            self._fitFinished.emit(result, requested, generation)
+
+    @pyqtSlot(object, float, int)
+    def _publish(self, result, requested, generation):
+        #The signal is queued, so this fit may have been requested before a stop() or set_region().
+        if not self._running or generation != self._generation:
+            return
+        latency = time.time() - requested
+        self.fits += 1
+        self.latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self._total_latency += latency
+        if result is None:
+            self.last_error = NoValidBPMDataException("No BPMS with sufficient TMIT for fit.")
+        self.orbit.fit_data = result
+        self.fitUpdated.emit(result)
+
+    def stats(self):
+        """Get a dictionary of fit counts and latencies (from snapshot to publication, in seconds), for tuning."""
+        return {'requests': self.requests, 'fits': self.fits, 'dropped': self.dropped, 'errors': self.errors,
+                'latency': self.latency, 'max_latency': self.max_latency,
+                'mean_latency': self._total_latency/self.fits if self.fits > 0 else None}
+
+def format_fit(result):
+    """Format the kicks and dE/E from a fit result for a readout."""
+    if result is None:
+        return "No fit"
+    def fmt(key, units):
+        value = result.get(key)
+        if value is None:
+            return "{}: --".format(key)
+        return "{}: {:.3f} {}".format(key, value, units)
+    return "   ".join([fmt('xkick', 'mrad'), fmt('ykick', 'mrad'), fmt('dE/E', 'x10^-3')])
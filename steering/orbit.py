@@ -1,37 +1,195 @@
 from utilities.edef import EventDefinition
-from PyQt5.QtCore import QObject, pyqtSignal
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 import pyca
 from psp.Pv import Pv
 import time
 import numpy as np
 import pickle
 from operator import attrgetter
-import utilities.matlog
-from utilities.batch_get import batch_get
+import utilities.matlog as matlog
+import utilities.perf as perf
 import math
 import subprocess
 import re
 import os
 import json
+import itertools
 from datetime import datetime
 MODEL_AVAILABLE = False
 try:
     import utilities.model as model
-    import utilities.fit
+    import utilities.trajectory_fit as trajectory_fit
     MODEL_AVAILABLE = True
 except ImportError:
     MODEL_AVAILABLE = False
 
 """A collection of classes to represent a linac orbit"""
+#The EPICS alarm severity for a reading which can't be trusted (or a disconnected PV).
+INVALID_SEVERITY = 3
+
+class OrbitStore(object):
+    """Columnar storage for the readings of a set of BPMs.
+    Each quantity (z, x, y, tmit, RMS, severity and status) lives in its own contiguous
+    numpy array, with one row per BPM.  BPM objects hold a reference to a store and a row
+    number, so whole-orbit operations are array slices, and per-BPM access still works.
+    Every write to a row stamps it with a new sequence number, so readers can tell
+    whether (and which) rows changed since they last looked."""
+    fields = ('z', 'x', 'y', 'tmit', 'x_rms', 'y_rms', 'tmit_rms', 'x_severity', 'y_severity', 'tmit_severity', 'x_status', 'y_status', 'tmit_status')
+    flag_fields = ('is_energy_bpm',)
+
+    @classmethod
+    def from_columns(cls, names, columns):
+        """Build a store from a list of names and a dictionary of per-field sequences.
+        Fields missing from the dictionary are filled with NaN (or False for flags)."""
+        store = cls(capacity=len(names))
+        store.names = list(names)
+        for field, values in columns.items():
+            store._columns[field][:len(names)] = np.asarray(values, dtype=store._columns[field].dtype).reshape(-1)
+        return store
+
+    def __init__(self, capacity=0):
+        self.names = []
+        self._columns = {}
+        self._seq_counter = itertools.count(1)
+        #The sequence number of the most recent write, and of the most recent write to each row.
+        self.seq = 0
+        self._row_seq = np.zeros(capacity, dtype=np.int64)
+        for field in self.fields:
+            self._columns[field] = np.full(capacity, np.nan)
+        for field in self.flag_fields:
+            self._columns[field] = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def capacity(self):
+        return len(self._columns['z'])
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2*self.capacity, 8)
+        n = len(self)
+        for field, col in self._columns.items():
+            if col.dtype == bool:
+                new_col = np.zeros(capacity, dtype=bool)
+            else:
+                new_col = np.full(capacity, np.nan)
+            new_col[:n] = col[:n]
+            self._columns[field] = new_col
+        new_row_seq = np.zeros(capacity, dtype=np.int64)
+        new_row_seq[:n] = self._row_seq[:n]
+        self._row_seq = new_row_seq
+
+    def append(self, name, **values):
+        """Add a row for a BPM, and return the new row number."""
+        row = len(self.names)
+        if row >= self.capacity:
+            self._grow(row + 1)
+        self.names.append(name)
+        for field, value in values.items():
+            self.set(field, row, value)
+        return row
+
+    def get(self, field, row):
+        return self._columns[field][row]
+
+    def set(self, field, row, value):
+        col = self._columns[field]
+        if value is None:
+            value = False if col.dtype == bool else np.nan
+        col[row] = value
+        self.touch(row)
+
+    def touch(self, row):
+        """Mark a row as changed.  This is called from monitor callbacks, so it only
+        uses operations which are atomic under the GIL."""
+        seq = next(self._seq_counter)
+        self._row_seq[row] = seq
+        self.seq = seq
+
+    def changed_rows(self, since):
+        """Get the numbers of the rows which have been written since sequence number since."""
+        return np.nonzero(self._row_seq[:len(self.names)] > since)[0]
+
+    def row(self, row):
+        """Get all the values for a single row, as a dictionary keyed by field name."""
+        return {field: col[row] for field, col in self._columns.items()}
+
+    def column(self, field):
+        """Get a view of the values of a field for every row.  The view is not a copy,
+        so it will change if the store is updated."""
+        return self._columns[field][:len(self.names)]
+
+    def has_field(self, field):
+        return field in self._columns
+
+    def take(self, rows):
+        """Make a new store with copies of the given rows, in the given order."""
+        rows = np.asarray(rows, dtype=int)
+        store = OrbitStore(capacity=len(rows))
+        store.names = [self.names[i] for i in rows]
+        for field, col in self._columns.items():
+            store._columns[field][:] = col[:len(self.names)][rows]
+        return store
+
+class OrbitSnapshot(dict):
+    """The readings of every BPM in an orbit at one moment: a dictionary of field name
+    to a numpy array with one value per BPM (see BaseOrbit.snapshot).
+
+    Attributes
+    ----------
+    seq
+        The orbit's seq when the snapshot was taken.
+    frame
+        The frame the snapshot was taken for, if any."""
+    def __init__(self, values, seq=None, frame=None):
+        super(OrbitSnapshot, self).__init__(values)
+        self.seq = seq
+        self.frame = frame
+
 class BaseBPM(object):
     """Abstract base class for a Beam Position Monitor.
-    Each BPM has an X, Y, and TMIT value, and a Z Position."""
+    Each BPM has an X, Y, and TMIT value, and a Z Position.
+    The values for a BPM are stored in a row of an OrbitStore.  A BPM which
+    isn't part of an orbit gets a private, single-row store."""
+    columnar = True
     def __init__(self, name, z_pos=None):
         self.name = name
-        self.z = z_pos
+        self._store = OrbitStore(capacity=1)
+        self._row = self._store.append(name, z=z_pos)
         self.is_energy_bpm = False
 
+    @classmethod
+    def view(cls, store, row):
+        """Make a BPM which is a view onto an existing row of an OrbitStore."""
+        bpm = cls.__new__(cls)
+        bpm.name = store.names[row]
+        bpm._bind(store, row)
+        return bpm
+
+    def _bind(self, store, row):
+        self._store = store
+        self._row = row
+
+    def _row_values(self):
+        return self._store.row(self._row)
+
+    @property
+    def z(self):
+        return self._store.get('z', self._row)
+
+    @z.setter
+    def z(self, new_z):
+        self._store.set('z', self._row, new_z)
+
+    @property
+    def is_energy_bpm(self):
+        return bool(self._store.get('is_energy_bpm', self._row))
+
+    @is_energy_bpm.setter
+    def is_energy_bpm(self, is_energy_bpm):
+        self._store.set('is_energy_bpm', self._row, is_energy_bpm)
+
     @property           
     def x(self):
         raise NotImplementedError
@@ -61,51 +219,40 @@ class StaticBPM(BaseBPM):
     """StaticBPM is a BPM, frozen in time.  An Orbit with Static BPMs is how you make a reference orbit."""
     def __init__(self, name, z_pos=None, x_val=None, y_val=None, tmit_val=None, x_rms=0.0, y_rms=0.0, tmit_rms=0.0, x_severity=None, y_severity=None, tmit_severity=None, x_status=None, y_status=None, tmit_status=None, is_energy_bpm=False):
         super(StaticBPM, self).__init__(name, z_pos=z_pos)
-        self._x = x_val
-        self._y = y_val
-        self._tmit = tmit_val
-        self._x_rms = x_rms
-        self._y_rms = y_rms
-        self._tmit_rms = tmit_rms
-        self._x_sevr = x_severity
-        self._y_sevr = y_severity
-        self._tmit_sevr = tmit_severity
-        self._x_status = x_status
-        self._y_status = y_status
-        self._tmit_status = tmit_status
+        values = {'x': x_val, 'y': y_val, 'tmit': tmit_val, 'x_rms': x_rms, 'y_rms': y_rms, 'tmit_rms': tmit_rms,
+                  'x_severity': x_severity, 'y_severity': y_severity, 'tmit_severity': tmit_severity,
+                  'x_status': x_status, 'y_status': y_status, 'tmit_status': tmit_status}
+        for field, value in values.items():
+            self._store.set(field, self._row, value)
         self.is_energy_bpm = is_energy_bpm
     
     @BaseBPM.x.getter
     def x(self):
-        return self._x
+        return self._store.get('x', self._row)
 
     @BaseBPM.y.getter
     def y(self):
-        return self._y
+        return self._store.get('y', self._row)
         
     @BaseBPM.tmit.getter    
     def tmit(self):
-        return self._tmit
+        return self._store.get('tmit', self._row)
 
     @property
     def x_rms(self):
-        return self._x_rms
+        return self._store.get('x_rms', self._row)
         
     @property
     def y_rms(self):
-        return self._y_rms
+        return self._store.get('y_rms', self._row)
         
     @property
     def tmit_rms(self):
-        return self._tmit_rms
+        return self._store.get('tmit_rms', self._row)
 
     def severity(self, axis):
-        if axis == "x":
-            return self._x_sevr
-        if axis == "y":
-            return self._y_sevr
-        if axis == "tmit":
-            return self._tmit_sevr
+        if axis in ("x", "y", "tmit"):
+            return self._store.get(axis + '_severity', self._row)
         raise Exception("Axis parameter not valid")
     
     @property
@@ -121,12 +268,8 @@ class StaticBPM(BaseBPM):
         return self.severity('tmit')
 
     def status(self, axis):
-        if axis == "x":
-            return self._x_status
-        if axis == "y":
-            return self._y_status
-        if axis == "tmit":
-            return self._tmit_status
+        if axis in ("x", "y", "tmit"):
+            return self._store.get(axis + '_status', self._row)
         raise Exception("Axis parameter not valid")
     
     @property
@@ -148,6 +291,9 @@ class BPM(BaseBPM):
     """BPM is a BPM value backed by EPICS PVs for X, Y, TMIT, and Z Position."""
     def __init__(self, name, edef=None):
         super(BPM, self).__init__(name)
+        #Live BPMs don't have RMS data.
+        for field in ('x_rms', 'y_rms', 'tmit_rms'):
+            self._store.set(field, self._row, 0.0)
         self.edef = None
         self.edef_suffix = ''
         self.set_edef(edef)
@@ -155,10 +301,39 @@ class BPM(BaseBPM):
         self.x_pv_obj = None
         self.y_pv_obj = None
         self.tmit_pv_obj = None
+        self.monitoring = False
     
     @classmethod
     def pv_count(cls):
         return 4
+
+    def create_pvs(self):
+        """Make the X, Y and TMIT PV objects, and start connecting them (without waiting)."""
+        self.x_pv_obj = Pv(self.x_pv())
+        self.y_pv_obj = Pv(self.y_pv())
+        self.tmit_pv_obj = Pv(self.tmit_pv())
+        for pv in self.pv_objects():
+            pv.connect()
+
+    def connected(self):
+        return all([pv is not None and pv.state() == 2 for pv in self.pv_objects()])
+
+    def start_monitoring(self):
+        """Monitor the X, Y and TMIT PVs.  All three must be connected."""
+        for axis, pv in self.axis_pv_objects():
+            pv.add_monitor_callback(self.monitor_callback(axis))
+            pv.add_connection_callback(self.connection_callback(axis))
+            pv.monitor(pyca.DBE_VALUE|pyca.DBE_ALARM)
+        self.monitoring = True
+
+    def stop_monitoring(self):
+        for pv in self.pv_objects():
+            if pv is None:
+                continue
+            if self.monitoring:
+                pv.unsubscribe()
+            pv.disconnect()
+        self.monitoring = False
     
     def set_edef(self, edef):
         if self.edef == edef:
@@ -173,15 +348,15 @@ class BPM(BaseBPM):
         
     @BaseBPM.x.getter           
     def x(self):
-        return self.x_pv_obj.data["value"]
+        return self._store.get('x', self._row)
     
     @BaseBPM.y.getter
     def y(self):
-        return self.y_pv_obj.data["value"]
+        return self._store.get('y', self._row)
     
     @BaseBPM.tmit.getter    
     def tmit(self):
-        return self.tmit_pv_obj.data["value"]
+        return self._store.get('tmit', self._row)
 
     @property
     def x_rms(self):
@@ -198,6 +373,46 @@ class BPM(BaseBPM):
     def pv_objects(self):
         return [self.x_pv_obj, self.y_pv_obj, self.tmit_pv_obj]
 
+    def axis_pv_objects(self):
+        return (('x', self.x_pv_obj), ('y', self.y_pv_obj), ('tmit', self.tmit_pv_obj))
+
+    def update_axis_from_pv(self, axis, pv):
+        """Copy the latest value, severity and status of one PV into this BPM's row of the store."""
+        data = pv.data
+        try:
+            value = data["value"]
+            severity = data["severity"]
+            status = data["status"]
+        except KeyError:
+            #No data has arrived for this PV yet.
+            return
+        self._store.set(axis, self._row, value)
+        self._store.set(axis + '_severity', self._row, severity)
+        self._store.set(axis + '_status', self._row, status)
+
+    def update_from_pvs(self):
+        for axis, pv in self.axis_pv_objects():
+            if pv is not None:
+                self.update_axis_from_pv(axis, pv)
+
+    def monitor_callback(self, axis):
+        """Make a callback for the monitor on one of this BPM's PVs, which keeps the store up to date."""
+        pv = getattr(self, axis + '_pv_obj')
+        def callback(e=None):
+            if e is None:
+                self.update_axis_from_pv(axis, pv)
+        return perf.counted('BPM monitor callbacks', callback)
+
+    def connection_callback(self, axis):
+        """Make a callback for connection changes on one of this BPM's PVs.  While a PV
+        is disconnected its reading is NaN with INVALID severity, so it drops out of
+        plots and fits.  Channel Access restores the monitor when the PV comes back."""
+        def callback(isconnected):
+            if not isconnected:
+                self._store.set(axis, self._row, np.nan)
+                self._store.set(axis + '_severity', self._row, INVALID_SEVERITY)
+        return callback
+
     def z_pv(self):
         return self.name + ":Z"
 
@@ -242,6 +457,7 @@ class BPM(BaseBPM):
             self.x_pv_obj.get()
             self.y_pv_obj.get()
             self.tmit_pv_obj.get()
+            self.update_from_pvs()
         x = self.x
         y = self.y
         tmit = self.tmit
@@ -258,12 +474,8 @@ class BPM(BaseBPM):
         return StaticBPM(self.name, z_pos=self.z, x_val=x, y_val=y, tmit_val=tmit, x_rms=x_rms, y_rms=y_rms, tmit_rms=tmit_rms, x_status=self.status('x'), y_status=self.status('y'), tmit_status=self.status('tmit'), x_severity=self.severity('x'), y_severity=self.severity('y'), tmit_severity=self.severity('tmit'), is_energy_bpm=self.is_energy_bpm)
 
     def status(self, axis):
-        if axis == 'x':
-            return self.x_pv_obj.data["status"]
-        if axis == 'y':
-            return self.y_pv_obj.data["status"]
-        if axis == "tmit":
-            return self.tmit_pv_obj.data["status"]
+        if axis in ('x', 'y', 'tmit'):
+            return self._store.get(axis + '_status', self._row)
         raise Exception("Axis parameter not valid.")
 
     @property
@@ -279,12 +491,8 @@ class BPM(BaseBPM):
         return self.status('tmit')
 
     def severity(self, axis):
-        if axis == 'x':
-            return self.x_pv_obj.data["severity"]
-        if axis == 'y':
-            return self.y_pv_obj.data["severity"]
-        if axis == "tmit":
-            return self.tmit_pv_obj.data["severity"]
+        if axis in ('x', 'y', 'tmit'):
+            return self._store.get(axis + '_severity', self._row)
         raise Exception("Axis parameter not valid.")
     
     @property
@@ -302,7 +510,10 @@ class BPM(BaseBPM):
 class DiffBPM(BaseBPM):
     """Represents the difference between two BPMs.  Usually used
        for making a difference orbit between a live orbit and a
-       static reference orbit."""
+       static reference orbit.
+       DiffBPMs compute their values on access, so they aren't stored in an
+       orbit's columns."""
+    columnar = False
     def __init__(self, bpm_a, bpm_b):
         if bpm_a.name != bpm_b.name:
             raise ValueError("{a} != {b}.  BPMs used to created a DiffBPM must have the same name.".format(a=bpm_a.name, b=bpm_b.name))
@@ -310,12 +521,22 @@ class DiffBPM(BaseBPM):
             self.name = bpm_a.name
         if bpm_a.z != bpm_b.z:
             raise ValueError("For {bpm_name} Z_A = {za}, but Z_B = {zb}. BPMs used to create a DiffBPM must have the same z position.".format(bpm_name=self.name, za=bpm_a.z, zb=bpm_b.z))
-        else:
-            self.z = bpm_a.z
         self.bpm_a = bpm_a
         self.bpm_b = bpm_b
         #self.bpm_b = bpm_b.to_static()
-        self.is_energy_bpm = bpm_a.is_energy_bpm or bpm_b.is_energy_bpm
+
+    def _row_values(self):
+        values = {field: getattr(self, field) for field in OrbitStore.fields}
+        values['is_energy_bpm'] = self.is_energy_bpm
+        return values
+
+    @property
+    def z(self):
+        return self.bpm_a.z
+
+    @property
+    def is_energy_bpm(self):
+        return self.bpm_a.is_energy_bpm or self.bpm_b.is_energy_bpm
 
     @BaseBPM.x.getter           
     def x(self):
@@ -340,7 +561,7 @@ class DiffBPM(BaseBPM):
         except AttributeError:
             b_rms = 0.0
 
-        return math.sqrt(a_rms**2.0 + b_rms**2.0)
+        return math.sqrt(a_rms*a_rms + b_rms*b_rms)
 
     @property
     def y_rms(self):
@@ -354,7 +575,7 @@ class DiffBPM(BaseBPM):
         except AttributeError:
             b_rms = 0.0
 
-        return math.sqrt(a_rms**2.0 + b_rms**2.0)
+        return math.sqrt(a_rms*a_rms + b_rms*b_rms)
     
     @property
     def tmit_rms(self):
@@ -368,7 +589,7 @@ class DiffBPM(BaseBPM):
         except AttributeError:
             b_rms = 0.0
 
-        return math.sqrt(a_rms**2.0 + b_rms**2.0)
+        return math.sqrt(a_rms*a_rms + b_rms*b_rms)
 
     def status(self, axis):
         return max(self.bpm_a.status(axis), self.bpm_b.status(axis))
@@ -388,6 +609,18 @@ class DiffBPM(BaseBPM):
     def tmit_severity(self):
         return self.severity('tmit')
 
+    @property
+    def x_status(self):
+        return self.status('x')
+
+    @property
+    def y_status(self):
+        return self.status('y')
+
+    @property
+    def tmit_status(self):
+        return self.status('tmit')
+
 class DiffTMITBPM(DiffBPM):
     """A DiffTMITBPM works exactly like a DiffBPM, except that its TMIT value
     is calculated as TMIT_A / TMIT_B instead of TMIT_A - TMIT_B."""
@@ -407,15 +640,21 @@ class DiffTMITBPM(DiffBPM):
         except AttributeError:
             b_rms = 0.0
 
-        return math.sqrt((a_rms/self.bpm_a.tmit)**2.0 + (b_rms/self.bpm_b.tmit)**2.0)*self.tmit()
+        a_frac = a_rms/self.bpm_a.tmit
+        b_frac = b_rms/self.bpm_b.tmit
+        return math.sqrt(a_frac*a_frac + b_frac*b_frac)*self.tmit
     
 class BaseOrbit(QObject):
+    #The fields which are saved by to_dict and loaded by from_dict.
+    dict_fields = ('x', 'y', 'tmit', 'z', 'x_rms', 'y_rms', 'tmit_rms', 'x_severity', 'y_severity', 'tmit_severity')
+    #The fields in a snapshot().
+    snapshot_fields = ('z', 'x', 'y', 'tmit', 'x_rms', 'y_rms', 'x_severity', 'y_severity', 'tmit_severity', 'is_energy_bpm')
+
     @classmethod
     def from_dict(cls, d):
         orbit = cls()
-        for (i, name) in enumerate(d['names']):
-            bpm = StaticBPM(str(name).strip(), z_pos=d['z'][i], x_val=d['x'][i], y_val=d['y'][i], tmit_val=d['tmit'][i], x_rms=d['x_rms'][i], y_rms=d['y_rms'][i], tmit_rms=d['tmit_rms'][i], x_severity=d['x_severity'][i], y_severity=d['y_severity'][i], tmit_severity=d['tmit_severity'][i])
-            orbit.append(bpm)
+        names = [str(name).strip() for name in d['names']]
+        orbit.set_columns(names, {field: d[field] for field in cls.dict_fields})
         return orbit
 
     @classmethod
@@ -423,9 +662,8 @@ class BaseOrbit(QObject):
         """Files saved in the matlab format are awful to deal with:  Plain-old lists turn into crazy nested nonsense."""
         d = matlog.load(filepath)
         orbit = cls()
-        for (i, name) in enumerate(d['data']['names'][0][0]):
-            bpm = StaticBPM(str(name).strip(), z_pos=d['data']['z'][0][0][0][i], x_val=d['data']['x'][0][0][0][i], y_val=d['data']['y'][0][0][0][i], tmit_val=d['data']['tmit'][0][0][0][i], x_rms=d['data']['x_rms'][0][0][0][i], y_rms=d['data']['y_rms'][0][0][0][i], tmit_rms=d['data']['tmit_rms'][0][0][0][i], x_severity=d['data']['x_severity'][0][0][0][i], y_severity=d['data']['y_severity'][0][0][0][i], tmit_severity=d['data']['tmit_severity'][0][0][0][i])
-            orbit.append(bpm)
+        names = [str(name).strip() for name in d['data']['names'][0][0]]
+        orbit.set_columns(names, {field: d['data'][field][0][0][0] for field in cls.dict_fields})
         orbit.name = os.path.basename(filepath)
         return orbit
 
@@ -441,14 +679,17 @@ class BaseOrbit(QObject):
         super(BaseOrbit, self).__init__(parent=parent)
         self._bpms = []
         self._bpm_name_dict = {}
+        self._store = OrbitStore()
+        self._columnar = True
+        #Incremented whenever the list of BPMs changes, so that dependent objects (like a DiffOrbit) know to rebuild.
+        self._layout_version = 0
         self._zmin = None
         self._zmax = None
         self._rmat_cache = None
         self._rmats_for_fit = None
-        self._zs_for_fit = None
-        self._saved_fit_start = None
-        self._saved_fit_end = None
         self._saved_fit_point = None
+        self._fitter = None
+        self._snapshot = None
         self.name = name
         self.fit_data = None
     
@@ -462,14 +703,52 @@ class BaseOrbit(QObject):
     @bpms.setter
     def bpms(self, new_bpms):
         self._clear_all_caches()
-        self._bpms = new_bpms
+        self._layout_version += 1
+        self._store = OrbitStore(capacity=len(new_bpms))
+        self._columnar = True
+        self._bpms = []
         self._bpm_name_dict = {}
         for bpm in new_bpms:
+            self._add_to_store(bpm)
+            self._bpms.append(bpm)
             self._bpm_name_dict[bpm.name] = bpm
 
+    def _add_to_store(self, bpm):
+        row = self._store.append(bpm.name, **bpm._row_values())
+        if bpm.columnar:
+            bpm._bind(self._store, row)
+        else:
+            #The stored row is only a snapshot, so values have to be read from the BPM objects themselves.
+            self._columnar = False
+
+    def set_columns(self, names, columns):
+        """Replace the contents of this orbit with static BPMs built directly from columns of data.
+
+        Parameters
+        ----------
+        names : list of str
+            The name of each BPM.
+        columns : dict
+            A dictionary with keys from OrbitStore.fields, with one value per BPM for each.
+        """
+        if len(set(names)) != len(names):
+            raise ValueError('BPM names in an orbit must be unique.')
+        self._adopt_store(OrbitStore.from_columns(names, columns))
+
+    def _adopt_store(self, store):
+        self._clear_all_caches()
+        self._layout_version += 1
+        self._store = store
+        self._columnar = True
+        self._bpms = [StaticBPM.view(store, i) for i in range(len(store))]
+        self._bpm_name_dict = {bpm.name: bpm for bpm in self._bpms}
+
     def append(self, new_bpm):
         if new_bpm.name in self._bpm_name_dict:
             raise ValueError('Orbit already contains a BPM named "{}".  BPM names in an orbit must be unique.'.format(new_bpm.name))
+        self._clear_z_cache()
+        self._layout_version += 1
+        self._add_to_store(new_bpm)
         self._bpm_name_dict[new_bpm.name] = new_bpm
         self._bpms.append(new_bpm)
 
@@ -481,16 +760,23 @@ class BaseOrbit(QObject):
         self._zmax = None
     
     def _clear_all_caches(self):
+        self._snapshot = None
         self._rmat_cache = None
+        self._rmats_for_fit = None
+        self._saved_fit_point = None
         self._clear_z_cache()
     
     def _find_z_min_and_max(self):
-        for bpm in self.bpms:
-            if (self._zmin is None) or bpm.z < self._zmin:
-                self._zmin = bpm.z
-            if (self._zmax is None) or bpm.z > self._zmax:
-                self._zmax = bpm.z
+        self._zmin = self._extreme('z', np.min)
+        self._zmax = self._extreme('z', np.max)
     
+    def _extreme(self, axis, func):
+        vals = self.vals(axis)
+        vals = vals[~np.isnan(vals)]
+        if len(vals) == 0:
+            return None
+        return func(vals)
+
     def zmin(self):
         if self._zmin is None:
             self._find_z_min_and_max()
@@ -502,52 +788,76 @@ class BaseOrbit(QObject):
         return self._zmax
     
     def xmin(self):
-        xmin = None
-        for bpm in self.bpms:
-            if bpm.x < xmin or (xmin is None):
-                xmin = bpm.x
-        return xmin
+        return self._extreme('x', np.min)
     
     def xmax(self):
-        xmax = None
-        for bpm in self.bpms:
-            if bpm.x > xmax or (xmax is None):
-                xmax = bpm.x
-        return xmax
+        return self._extreme('x', np.max)
     
     def ymin(self):
-        ymin = None
-        for bpm in self.bpms:
-            if bpm.y < ymin or (ymin is None):
-                ymin = bpm.y
-        return ymin
+        return self._extreme('y', np.min)
     
     def ymax(self):
-        ymax = None
-        for bpm in self.bpms:
-            if bpm.y > ymax or (ymax is None):
-                ymax = bpm.y
-        return ymax
+        return self._extreme('y', np.max)
     
     def tmitmin(self):
-        tmitmin = None
-        for bpm in self.bpms:
-            if bpm.tmit < tmitmin or (tmitmin is None):
-                tmitmin = bpm.tmit
-        return tmitmin
+        return self._extreme('tmit', np.min)
     
     def tmitmax(self):
-        tmitmax = None
-        for bpm in self.bpms:
-            if bpm.tmit > tmitmax or (tmitmax is None):
-                tmitmax = bpm.tmit
-        return tmitmax
+        return self._extreme('tmit', np.max)
 
     def names(self):
         return [bpm.name for bpm in self.bpms]
 
+    @property
+    def seq(self):
+        """A token which changes whenever any reading (or the list of BPMs) in the orbit
+        changes.  Compare it with a token saved earlier to see if the orbit needs redrawing.
+        It is None for an orbit which can't track changes, which should always be redrawn."""
+        if not self._columnar:
+            return None
+        return (self._layout_version, self._store.seq)
+
+    def snapshot(self, frame=None):
+        """Get copies of the readings views draw from and fits use (see snapshot_fields), taken together.
+
+        The snapshot is cached, and the cached copy is returned while the orbit's seq is
+        unchanged.  If frame is given (any token, a draw timer tick count for example),
+        the cached copy is also returned to every caller asking for the same frame, even
+        if new readings have arrived in the meantime.  That way several views redrawing
+        on the same tick share one snapshot, and all show the same moment.
+
+        Returns
+        -------
+        OrbitSnapshot
+            A dictionary of field name to a numpy array, with one value per BPM."""
+        cached = self._snapshot
+        if cached is not None and frame is not None and cached.frame == frame:
+            return cached
+        seq = self.seq
+        if cached is not None and seq is not None and cached.seq == seq:
+            cached.frame = frame
+            return cached
+        self._snapshot = OrbitSnapshot({field: self.vals(field) for field in self.snapshot_fields}, seq=seq, frame=frame)
+        self._snapshot['is_energy_bpm'] = self._snapshot['is_energy_bpm'].astype(bool)
+        return self._snapshot
+
+    def changed_rows(self, since):
+        """Get the indices (into self.bpms) of the BPMs whose readings changed since the
+        orbit's seq was since.  Returns None if every BPM should be treated as changed."""
+        if since is None or not self._columnar or since[0] != self._layout_version:
+            return None
+        return self._store.changed_rows(since[1])
+
     def vals(self, axis):
-        return [getattr(bpm,axis) for bpm in self.bpms]
+        """Get the values of a BPM property for every BPM in the orbit.
+
+        Returns
+        -------
+        numpy.ndarray
+            A copy of the values, one per BPM, in the same order as self.bpms."""
+        if self._columnar and self._store.has_field(axis):
+            return self._store.column(axis).copy()
+        return np.array([getattr(bpm, axis) for bpm in self.bpms], dtype=float)
 
     def x_vals(self):
         return self.vals('x')
@@ -589,7 +899,8 @@ class BaseOrbit(QObject):
         return self.vals('tmit_status')
 
     def sort_bpms_by_z(self):
-        self.bpms.sort(key=attrgetter('z'))
+        order = np.argsort(self.z_vals(), kind='mergesort')
+        self.bpms = [self._bpms[i] for i in order]
 
     def export_to_json(self, filename):
         raise NotImplementedError
@@ -607,7 +918,7 @@ class BaseOrbit(QObject):
         return self
 
     def to_dict(self):
-        d = {'x': self.vals('x'), 'y': self.vals('y'), 'tmit': self.vals('tmit'), 'z': self.vals('z'), 'x_rms': self.vals('x_rms'), 'y_rms': self.vals('y_rms'), 'tmit_rms': self.vals('tmit_rms'), 'x_severity': self.vals('x_severity'), 'y_severity': self.vals('y_severity'), 'tmit_severity': self.vals('tmit_severity')}
+        d = {field: self.vals(field).tolist() for field in self.dict_fields}
         d['names'] = self.names()
         return d
 
@@ -657,6 +968,14 @@ class BaseOrbit(QObject):
             self._rmat_cache = model.get_rmat(self.names())
         return self._rmat_cache
 
+    def rmats_for_fit(self, fit_point_index):
+        """Get R-Matrices from the fit point to each BPM from the model.
+        The matrices for the most recent fit point are cached."""
+        if self._rmats_for_fit is None or fit_point_index != self._saved_fit_point:
+            self._rmats_for_fit = model.get_rmat(self.bpms[fit_point_index].name, self.names())
+            self._saved_fit_point = fit_point_index
+        return self._rmats_for_fit
+
     def fit(self, start, end, fit_point, fit_xpos=True, fit_xang=True, fit_ypos=True, fit_yang=True, fit_energy_difference=True, fit_xkick=True, fit_ykick=True, opt_dict=None):
         """Fit a trajectory to the orbit's BPM readings, given the R-matrices at each BPM.
         Parameters:
@@ -706,9 +1025,26 @@ class BaseOrbit(QObject):
         ValueError
             If the number of R matrices in Rs does not equal the number of BPMs in the orbit.
         """
-        #This method is really crappy - its an almost line-for-line port of the MATLAB BPM GUI's fitting routine,
-        # which ends up really awkward in numpy.  There are probably performance gains to be had here - unnecessary
-        # copies, unnecessary conversions between numpy arrays and numpy matrices, etc.
+        #The fit itself is done by a TrajectoryFitter, which caches the least-squares solution for
+        #each combination of fit region, fit point, enabled parameters and set of BPMs with good TMIT.
+        #Fitting a new set of readings with an unchanged configuration is just a few matrix-vector products.
+        (start_index, end_index, fit_point_index, z0) = self._fit_indices(start, end, fit_point)
+        enabled = self._fit_options(fit_xpos, fit_xang, fit_ypos, fit_yang, fit_energy_difference, fit_xkick, fit_ykick, opt_dict)
+        Rs = self.rmats_for_fit(fit_point_index)
+        result = self.fitter.fit(Rs, self.z_vals(), self.x_vals(), self.y_vals(), self.x_rms_vals(), self.y_rms_vals(), self.tmit_severity_vals(), start_index, end_index, z0, enabled)
+        if result is None:
+            self.fit_data = None
+            raise NoValidBPMDataException("No BPMS with sufficient TMIT for fit.")
+        self.fit_data = result
+        return self.fit_data
+        
+    @property
+    def fitter(self):
+        if self._fitter is None:
+            self._fitter = trajectory_fit.TrajectoryFitter()
+        return self._fitter
+
+    def _fit_indices(self, start, end, fit_point):
         if MODEL_AVAILABLE == False:
             raise Exception("Model is not available, cannot perform fitting.")
         if isinstance(start, BaseBPM):
@@ -725,96 +1061,51 @@ class BaseOrbit(QObject):
         else:
             fit_point_index = int(fit_point)
             z0 = self.bpms[fit_point_index].z
+        return (start_index, end_index, fit_point_index, z0)
+
+    def _fit_options(self, fit_xpos, fit_xang, fit_ypos, fit_yang, fit_energy_difference, fit_xkick, fit_ykick, opt_dict):
+        if opt_dict is not None:
+            fit_xpos = opt_dict.get('fit_xpos', fit_xpos)
+            fit_xang = opt_dict.get('fit_xang', fit_xang)
+            fit_ypos = opt_dict.get('fit_ypos', fit_ypos)
+            fit_yang = opt_dict.get('fit_yang', fit_yang)
+            fit_energy_difference = opt_dict.get('fit_energy_difference', fit_energy_difference)
+            fit_xkick = opt_dict.get('fit_xkick', fit_xkick)
+            fit_ykick = opt_dict.get('fit_ykick', fit_ykick)
+        return (fit_xpos, fit_xang, fit_ypos, fit_yang, fit_energy_difference, fit_xkick, fit_ykick)
+
+    def fit_shots(self, xs, ys, good, start, end, fit_point, fit_xpos=True, fit_xang=True, fit_ypos=True, fit_yang=True, fit_energy_difference=True, fit_xkick=True, fit_ykick=True, opt_dict=None):
+        """Fit a trajectory to every shot in a set of BPM readings, in one vectorized pass.
+        Shots which share the same set of good BPMs share a single least-squares factorization.
+
+        Parameters:
+        ----------
+        xs : numpy.ndarray
+            An (n_shots x n_bpms) array of X readings, with columns in the same order as self.bpms.
+        ys : numpy.ndarray
+            An (n_shots x n_bpms) array of Y readings.
+        good : numpy.ndarray
+            An (n_shots x n_bpms) boolean array, True where a reading should be used in the fit.
+        start, end, fit_point, fit_xpos, ..., opt_dict :
+            The same as for BaseOrbit.fit.
+
+        Returns
+        -------
+        dict
+            A dictionary with the following keys:
+            'zs': the Z position of each BPM from start to end.
+            'xpos', 'ypos': (n_shots x n_fit_bpms) arrays of fitted trajectories.
+            'xres', 'yres': (n_shots x n_fit_bpms) arrays of residuals (reading - fit).
+            Readings which weren't used in the fit are NaN in all four.
+            'xpos0', 'xang0', 'ypos0', 'yang0', 'dE/E', 'xkick', 'ykick': an array with one
+            fitted value per shot (NaN for shots with no good BPMs), or None if not fit.
+            'dp': A dictionary with all of the above parameter keys, with the fitted errors.
+        """
+        (start_index, end_index, fit_point_index, z0) = self._fit_indices(start, end, fit_point)
+        enabled = self._fit_options(fit_xpos, fit_xang, fit_ypos, fit_yang, fit_energy_difference, fit_xkick, fit_ykick, opt_dict)
+        Rs = self.rmats_for_fit(fit_point_index)
+        return self.fitter.fit_shots(Rs, self.z_vals(), xs, ys, good, start_index, end_index, z0, enabled)
 
-        if start_index == self._saved_fit_start and end_index == self._saved_fit_end and fit_point_index == self._saved_fit_point:
-            Rs = self._rmats_for_fit
-        else:
-            Rs = model.get_rmat(self.bpms[fit_point_index].name, self.names())
-            self._rmats_for_fit = Rs
-            self._saved_fit_start = start_index
-            self._saved_fit_end = end_index
-            self._saved_fit_point = fit_point_index
-        Rs = Rs[start_index:end_index+1]
-        zs = np.array(self.z_vals())[start_index:end_index+1]
-        xs = np.array(self.x_vals())[start_index:end_index+1]
-        ys = np.array(self.y_vals())[start_index:end_index+1]
-        dxs = np.array(self.x_rms_vals())[start_index:end_index+1]
-        #dxs = np.ones(len(zs))/1.0e-3
-        dys = np.array(self.y_rms_vals())[start_index:end_index+1]
-        #dys = np.ones(len(zs))/1.0e-3
-        tmit_sevrs = np.array(self.tmit_severity_vals())[start_index:end_index+1]
-        
-        #Filter out BPMS with bad TMIT severity (usually a good indicator of no beam)
-        tmit_good = np.where(tmit_sevrs == 0)
-        tmit_sevrs = tmit_sevrs[tmit_good]
-        num_bpms = len(tmit_sevrs)
-        if num_bpms == 0:
-            self.fit_data = None
-            raise NoValidBPMDataException("No BPMS with sufficient TMIT for fit.")
-        zs = zs[tmit_good]
-        xs = xs[tmit_good]
-        ys = ys[tmit_good]
-        dxs = dxs[tmit_good]
-        dys = dys[tmit_good]
-        Rs = Rs[tmit_good]
-        if Rs.shape != (num_bpms,6,6):
-            raise ValueError("Number of R matrices in Rs does not equal the number of BPMs in the orbit.")
-        xsf = np.zeros((1, num_bpms))
-        ysf = np.zeros((1, num_bpms))
-
-        #Grab just the R1s and R3s, except for R15 and R35.
-        R1s = Rs[:, 0, [0, 1, 2, 3, 5]]
-        R3s = Rs[:, 2, [0, 1, 2, 3, 5]]
-
-        if not (np.any(np.abs(R1s[:, 4]) > 0.010) or np.any(np.abs(R3s[:,4]) > 0.010)):
-            #Not enough dispersion to fit energy, disabling energy fit.
-            fit_energy_difference = False
-        
-        I = np.where(np.array([fit_xpos, fit_xang, fit_ypos, fit_yang, fit_energy_difference, fit_xkick, fit_ykick]))[0]
-        R1s_kick = R1s.copy()
-        R3s_kick = R3s.copy()
-        R1s_kick[zs <= z0, :] = 0.0
-        R3s_kick[zs <= z0, :] = 0.0
-        R1s_kick = np.mat(R1s_kick)
-        R3s_kick = np.mat(R3s_kick)
-        R1s = np.append(R1s, R1s_kick[:,1], 1)
-        R1s = np.append(R1s, R1s_kick[:,3], 1)
-        R3s = np.append(R3s, R3s_kick[:,1], 1)
-        R3s = np.append(R3s, R3s_kick[:,3], 1)
-        Q = np.append(R1s[:, I], R3s[:, I], 0)
-        S = np.mat(np.append(xs, ys, 0)).transpose()
-        dS = np.mat(np.append(dxs, dys, 0)).transpose()
-        #print(S.shape)
-        if np.all(dS == 0.0):
-            #Fit without any weighting
-            Ssf, dSsf, p1, dp1, chisq, V = fit.fit(Q, S)
-        else:
-            #Fit with weighting
-            Ssf, dSsf, p1, dp1, chisq, V = fit.fit(Q, S, dS)
-        nr, nc = np.shape(V)
-        p = np.array(p1[:,0])
-        #print("p = {}".format(p))
-        dp = np.array(dp1[:])
-        #print("Ssf = {}".format(Ssf))
-        Xsf = np.array(Ssf[0:num_bpms])
-        #print("X vals = {}".format(Xsf))
-        Ysf = np.array(Ssf[num_bpms:])
-        #print("Y vals = {}".format(Ysf))
-        Vs = np.reshape(V, (1,nr*nc))
-        result = {}
-        result['xpos'] = Xsf.flatten()
-        result['ypos'] = Ysf.flatten()
-        result['zs'] = zs
-        result['xpos0'] = p[I==0][0][0] if (I==0).any() else None
-        result['xang0'] = p[I==1][0][0] if (I==1).any() else None
-        result['ypos0'] = p[I==2][0][0] if (I==2).any() else None
-        result['yang0'] = p[I==3][0][0] if (I==3).any() else None
-        result['dE/E'] = p[I==4][0][0] if (I==4).any() else None
-        result['xkick'] = p[I==5][0][0] if (I==5).any() else None
-        result['ykick'] = p[I==6][0][0] if (I==6).any() else None
-        self.fit_data = result
-        return self.fit_data
-        
     @property
     def enable_fitting(self):
         return self._enable_fitting
@@ -825,6 +1116,121 @@ class BaseOrbit(QObject):
 
     #def set_fit_options(self, 
 
+class DiffOrbit(BaseOrbit):
+    """The difference between two orbits, usually a live orbit and a static reference orbit.
+    BPMs are matched by name once, and the row mapping is cached.  Whole-orbit values
+    are computed with a single array operation per call to vals(), using the same math
+    as DiffBPM and DiffTMITBPM.  Per-BPM access (iteration, indexing) still returns
+    DiffBPM objects.  BPMs which are only in one of the two orbits are left out."""
+    def __init__(self, orbit_a, orbit_b, tmit_ratio=False, name=None, parent=None):
+        super(DiffOrbit, self).__init__(name=name, parent=parent)
+        self.orbit_a = orbit_a
+        self.orbit_b = orbit_b
+        self.tmit_ratio = tmit_ratio
+        self._a_rows = None
+        self._b_rows = None
+        self._matched_layouts = None
+        self._columnar = False
+        self._match_bpms()
+
+    def _match_bpms(self):
+        b_rows_by_name = {name: i for (i, name) in enumerate(self.orbit_b.names())}
+        a_rows = []
+        b_rows = []
+        for (i, name) in enumerate(self.orbit_a.names()):
+            if name in b_rows_by_name:
+                a_rows.append(i)
+                b_rows.append(b_rows_by_name[name])
+        diff_class = DiffTMITBPM if self.tmit_ratio else DiffBPM
+        #DiffBPM's constructor checks that the matched BPMs have the same z position.
+        self._bpms = [diff_class(self.orbit_a.bpms[i], self.orbit_b.bpms[j]) for (i, j) in zip(a_rows, b_rows)]
+        self._bpm_name_dict = {bpm.name: bpm for bpm in self._bpms}
+        self._a_rows = np.array(a_rows, dtype=int)
+        self._b_rows = np.array(b_rows, dtype=int)
+        self._matched_layouts = (self.orbit_a._layout_version, self.orbit_b._layout_version)
+        self._clear_all_caches()
+        self._layout_version += 1
+
+    def _check_layout(self):
+        if self._matched_layouts != (self.orbit_a._layout_version, self.orbit_b._layout_version):
+            self._match_bpms()
+
+    @property
+    def bpms(self):
+        self._check_layout()
+        return self._bpms
+
+    @bpms.setter
+    def bpms(self, new_bpms):
+        raise AttributeError("The BPMs in a DiffOrbit come from the orbits it compares, and can't be set directly.")
+
+    def append(self, new_bpm):
+        raise AttributeError("The BPMs in a DiffOrbit come from the orbits it compares, and can't be appended.")
+
+    def __len__(self):
+        return len(self.bpms)
+
+    def __iter__(self):
+        return iter(self.bpms)
+
+    @property
+    def seq(self):
+        self._check_layout()
+        (a_seq, b_seq) = (self.orbit_a.seq, self.orbit_b.seq)
+        if a_seq is None or b_seq is None:
+            return None
+        return (self._layout_version, a_seq, b_seq)
+
+    def changed_rows(self, since):
+        self._check_layout()
+        if since is None or since[0] != self._layout_version:
+            return None
+        a_changed = self.orbit_a.changed_rows(since[1])
+        b_changed = self.orbit_b.changed_rows(since[2])
+        if a_changed is None or b_changed is None:
+            return None
+        return np.nonzero(np.isin(self._a_rows, a_changed) | np.isin(self._b_rows, b_changed))[0]
+
+    def _pair(self, field):
+        return (self.orbit_a.vals(field)[self._a_rows], self.orbit_b.vals(field)[self._b_rows])
+
+    def vals(self, axis):
+        self._check_layout()
+        if axis == 'z':
+            return self.orbit_a.vals('z')[self._a_rows]
+        if axis == 'is_energy_bpm':
+            (a, b) = self._pair(axis)
+            return a | b
+        if axis in ('x', 'y'):
+            (a, b) = self._pair(axis)
+            return a - b
+        if axis == 'tmit':
+            (a, b) = self._pair(axis)
+            if self.tmit_ratio:
+                return a / b
+            return a - b
+        if axis == 'tmit_rms' and self.tmit_ratio:
+            (a_rms, b_rms) = self._pair('tmit_rms')
+            (a_tmit, b_tmit) = self._pair('tmit')
+            a_frac = a_rms/a_tmit
+            b_frac = b_rms/b_tmit
+            return np.sqrt(a_frac*a_frac + b_frac*b_frac)*(a_tmit/b_tmit)
+        if axis in ('x_rms', 'y_rms', 'tmit_rms'):
+            (a_rms, b_rms) = self._pair(axis)
+            return np.sqrt(a_rms*a_rms + b_rms*b_rms)
+        if axis.endswith('_severity') or axis.endswith('_status'):
+            #Equivalent to the builtin max(a, b), which DiffBPM uses.
+            (a, b) = self._pair(axis)
+            return np.where(b > a, b, a)
+        return super(DiffOrbit, self).vals(axis)
+
+    def to_static(self):
+        """Freeze the current difference into a BaseOrbit of static BPMs."""
+        static_orbit = BaseOrbit(name=self.name)
+        columns = {field: self.vals(field) for field in OrbitStore.fields + OrbitStore.flag_fields}
+        static_orbit.set_columns(self.names(), columns)
+        return static_orbit
+
 #Generic code to get an array of PVs from aidalist.
 def get_pv_list(pattern):
     return subprocess.check_output(['eget','-ts','ds','-a','name={}'.format(pattern)]).splitlines()[:-1]
@@ -875,14 +1281,41 @@ class Orbit(BaseOrbit):
         
     connectStarted = pyqtSignal()
     connectionProgress = pyqtSignal()
+    #Emitted once every BPM has a Z position and the orbit is sorted.  The orbit can
+    #be displayed from then on: BPMs fill in as their PVs connect.
+    layoutReady = pyqtSignal()
+    #Emitted with the number of BPMs whose PVs just connected and started monitoring.
+    bpmsAdmitted = pyqtSignal(int)
     connectFinished = pyqtSignal()
+    #Emitted with the exception if a step of connect_async fails.  Connecting stops there.
+    connectFailed = pyqtSignal(object)
+    #How many BPMs to start connecting per step of the connection pipeline.
+    connect_batch_size = 100
+    #How long to wait for the Z PVs, and for the first connection to the BPM PVs, in seconds.
+    #BPMs which miss the first deadline keep connecting in the background.
+    z_timeout = 10.0
+    connect_timeout = 5.0
+    #How often the pipeline runs while connecting, and how often to check for late BPMs afterwards, in ms.
+    poll_interval = 100
+    reconnect_interval = 2000
+    #How long to wait for a single shot EDEF acquisition in to_static, in seconds.
+    acquisition_timeout = 5.0
     def __init__(self, bpm_name_list=None, auto_connect=True, edef=None, name=None, parent=None):
         super(Orbit, self).__init__(name=name, parent=parent)
         self.edef = edef
         self.bpms = []
         self.auto_connect = auto_connect
         self.connected = False
-        self._max_progress = 0
+        self._pending = []
+        self._connect_steps = None
+        self._progress = 0
+        self._progress_target = 0
+        self._connect_timer = QTimer(self)
+        self._connect_timer.setInterval(self.poll_interval)
+        self._connect_timer.timeout.connect(self._step_connection)
+        self._reconnect_timer = QTimer(self)
+        self._reconnect_timer.setInterval(self.reconnect_interval)
+        self._reconnect_timer.timeout.connect(self._admit_late_bpms)
         if bpm_name_list is not None:
             self.set_bpms(bpm_name_list)
     
@@ -909,135 +1342,173 @@ class Orbit(BaseOrbit):
         if self.auto_connect:
             self.connect()
 
+    def _num_batches(self):
+        return max(1, int(math.ceil(len(self.bpms)/float(self.connect_batch_size))))
+
     def progress_total(self):
-        # This value is the number of times the BPM list
-        # gets looped over in self.connect()
-        return 6
+        # The number of times connectionProgress is emitted by a connection:
+        # once for the Z positions, once per batch of BPMs, and once when the
+        # first round of connections is done.
+        return self._num_batches() + 2
         
     def pv_count(self):
         return len(self.bpms)*BPM.pv_count()
 
+    @perf.timed('Orbit.connect')
     def connect(self):
-        connection_progress = 0
-        #We iterate through the bpm list six times in the code below.
-        max_progress = self.progress_total()
-        #First, get Z values for all BPMs.
-        print("Starting connection")
+        """Connect to every BPM, blocking until the first round of connections is done.
+        Use connect_async() from a GUI."""
+        self.stop_connecting()
+        for step in self._connection_pipeline():
+            pyca.pend_event(self.poll_interval/1000.0)
+        if len(self._pending) > 0:
+            self._reconnect_timer.start()
+
+    def connect_async(self):
+        """Start connecting to every BPM, and return immediately.  The connection runs
+        in steps on a timer, so the event loop keeps running.  Progress is reported with
+        connectStarted, connectionProgress, layoutReady, bpmsAdmitted and connectFinished."""
+        self.stop_connecting()
+        self._connect_steps = self._connection_pipeline()
+        self._connect_timer.start()
+
+    def stop_connecting(self):
+        self._connect_timer.stop()
+        self._reconnect_timer.stop()
+        if self._connect_steps is not None:
+            self._connect_steps.close()
+            self._connect_steps = None
+
+    @perf.timed('Orbit connection step')
+    def _step_connection(self):
+        #This runs from a timer, so an exception here would escape a Qt slot (which aborts under PyQt5 5.5 and later).
         try:
-            z_positions = model.get_zpos(self.names(), full_model=model_data, ignore_bad_names=True)
-            print("Retrieved Z values from the model.")
-            for i, z in enumerate(z_positions):
-                self.bpms[i].z = z
-            connection_progress += 3
-            print("Connection progress = {}".format(connection_progress))
-            self.connectionProgress.emit()
-            QApplication.instance().processEvents()
-        except (IOError, NameError):
-            #Getting z positions from the model didn't work, try getting from PVs instead.
-            for bpm in self.bpms:
-                bpm.z_pv_obj = Pv(bpm.z_pv())
-            print("Getting from PVs instead")    
-            for bpm in self.bpms:
-                bpm.z_pv_obj.connect()
-            pyca.pend_event(0.2)
-            connection_progress += 1
-            self.connectionProgress.emit()
-            QApplication.instance().processEvents()
-            
-            #Now check and see if Z pvs are connected.
-            retries = 0
-            max_retries = 50
-            while retries < max_retries:
-                all_connected = True
-                for i, bpm in enumerate(self.bpms):
-                    if bpm.z_pv_obj.state() != 2:
-                        print(bpm.z_pv_obj.name)
-                        all_connected = False
-                if not all_connected:
-                    print("Retrying Z Position PV connections...")
-                    pyca.pend_event(.2)
-                else:
-                    break
-                retries = retries + 1
-            if retries == max_retries:
-                print("Some BPMs failed to connect.  Removing: {}".format([bpm.name for bpm in self.bpms if bpm.z_pv_obj.state() != 2]))
-                
-                self.bpms = [bpm for bpm in self.bpms if bpm.z_pv_obj.state() == 2]
-                #raise Exception("Could not connect to all Z PVs after {} retries.".format(retries))
-            connection_progress += 1
-            self.connectionProgress.emit()
-            QApplication.instance().processEvents()
-            
-            for bpm in self.bpms:
-                bpm.z_pv_obj.get(ctrl=False)
-            pyca.flush_io()
-            pyca.pend_event(0.2)
-            pyca.pend_io(2.2)
-            
-            connection_progress += 1
-            self.connectionProgress.emit()
-            QApplication.instance().processEvents()
-            
-            for bpm in self.bpms:
-                bpm.z = bpm.z_pv_obj.value
-                bpm.z_pv_obj.disconnect()
-        self.sort_bpms_by_z()
-                    
-        #Next, establish monitors for all the BPMs.
-        #print("Connecting to PVs...")
-        for bpm in self.bpms:
-                bpm.x_pv_obj = Pv(bpm.x_pv())
-                bpm.y_pv_obj = Pv(bpm.y_pv())
-                bpm.tmit_pv_obj = Pv(bpm.tmit_pv())
-        
-        bpm_pvs_connected = 0
-        total_bpm_pvs = len(self.bpms)*len(self.bpms[0].pv_objects())
-        for bpm in self.bpms:
-            for pv in bpm.pv_objects():
-                pv.connect()
-        pyca.pend_event(.2)
-        connection_progress += 1
-        self.connectionProgress.emit()
-        QApplication.instance().processEvents()
-        
-        #Now check and see if everything is connected.
-        retries = 0
-        max_retries = 3
-        while retries < max_retries:
-            all_connected = True
-            for i, bpm in enumerate(self.bpms):
-                if any([pv.state() != 2 for pv in bpm.pv_objects()]):
-                    all_connected = False
-            if not all_connected:
-                print("Retrying connection to BPM PVs...")
-                pyca.pend_event(.2)
-            else:
-                break
-            retries = retries + 1
-            time.sleep(1.0)
-        if retries == max_retries:
-            raise Exception("Could not connect to all PVs after {} retries.".format(retries))
-        connection_progress += 1
-        self.connectionProgress.emit()
-        QApplication.instance().processEvents()
-        
-        monitors_established = 0
-        for bpm in self.bpms:
-            for pv in bpm.pv_objects():
-                pv.monitor(pyca.DBE_VALUE|pyca.DBE_ALARM)
-        pyca.pend_event(.2)
-        connection_progress += 1
+            next(self._connect_steps)
+        except StopIteration:
+            self._connect_timer.stop()
+            self._connect_steps = None
+            if len(self._pending) > 0:
+                self._reconnect_timer.start()
+        except Exception as e:
+            self.stop_connecting()
+            print("Could not connect to the BPMs: {}".format(e))
+            self.connectFailed.emit(e)
+
+    def _emit_progress(self):
+        self._progress += 1
         self.connectionProgress.emit()
-        QApplication.instance().processEvents()
+
+    def _connection_pipeline(self):
+        """The connection pipeline, as a generator.  Every time it yields, the caller
+        lets Channel Access (and the UI) run for a while before resuming it."""
+        self._progress = 0
+        self._progress_target = self.progress_total()
+        self._pending = []
+        self.connectStarted.emit()
+        for step in self._connect_z_positions():
+            yield
+        self.sort_bpms_by_z()
+        self._emit_progress()
+        self.layoutReady.emit()
+
+        #Start connecting the BPM PVs a batch at a time, and start monitoring BPMs as soon as they connect.
+        for start in range(0, len(self.bpms), self.connect_batch_size):
+            batch = self.bpms[start:start+self.connect_batch_size]
+            for bpm in batch:
+                bpm.create_pvs()
+            pyca.flush_io()
+            self._pending.extend(batch)
+            self._emit_progress()
+            yield
+            self._admit_connected()
+        deadline = time.time() + self.connect_timeout
+        while len(self._pending) > 0 and time.time() < deadline:
+            yield
+            self._admit_connected()
+        if len(self._pending) > 0:
+            print("Some BPMs have not connected yet, will keep trying: {}".format([bpm.name for bpm in self._pending]))
+        #BPMs dropped while getting Z positions mean fewer batches than expected.
+        while self._progress < self._progress_target:
+            self._emit_progress()
         self.connected = True
         self.connectFinished.emit()
-        QApplication.instance().processEvents()
+
+    def _connect_z_positions(self):
+        """Get a Z position for every BPM, from the model if possible, and from
+        the Z PVs otherwise.  BPMs without a Z position are removed.  A generator,
+        like _connection_pipeline."""
+        z_positions = np.full(len(self.bpms), np.nan)
+        if MODEL_AVAILABLE:
+            try:
+                z_positions = np.atleast_1d(model.get_zpos(self.names(), ignore_bad_names=True))
+                print("Retrieved Z values from the model.")
+            except Exception as e:
+                #Any model, RPC or cache failure: fall back to the Z PVs below.
+                print("Could not get Z values from the model: {}".format(e))
+        remaining = []
+        for bpm, z in zip(self.bpms, z_positions):
+            if np.isnan(z):
+                remaining.append(bpm)
+            else:
+                bpm.z = z
+        if len(remaining) == 0:
+            return
+        #Getting z positions from the model didn't work, try getting from PVs instead.
+        print("Getting Z values for {} BPMs from PVs instead".format(len(remaining)))
+        for bpm in remaining:
+            bpm.z_pv_obj = Pv(bpm.z_pv())
+            bpm.z_pv_obj.connect()
+        pyca.flush_io()
+        requested = set()
+        deadline = time.time() + self.z_timeout
+        while len(remaining) > 0 and time.time() < deadline:
+            yield
+            waiting = []
+            for bpm in remaining:
+                pv = bpm.z_pv_obj
+                if pv.state() != 2:
+                    waiting.append(bpm)
+                elif bpm.name not in requested:
+                    pv.get(ctrl=False, timeout=None)
+                    requested.add(bpm.name)
+                    waiting.append(bpm)
+                elif "value" not in pv.data:
+                    waiting.append(bpm)
+                else:
+                    bpm.z = pv.data["value"]
+                    pv.disconnect()
+            remaining = waiting
+            pyca.flush_io()
+        if len(remaining) > 0:
+            print("Some BPMs failed to connect.  Removing: {}".format([bpm.name for bpm in remaining]))
+            for bpm in remaining:
+                bpm.z_pv_obj.disconnect()
+            failed = set(bpm.name for bpm in remaining)
+            self.bpms = [bpm for bpm in self.bpms if bpm.name not in failed]
+
+    def _admit_connected(self):
+        """Start monitoring every pending BPM whose PVs have all connected."""
+        admitted = [bpm for bpm in self._pending if bpm.connected()]
+        if len(admitted) == 0:
+            return 0
+        for bpm in admitted:
+            bpm.start_monitoring()
+        pyca.flush_io()
+        self._pending = [bpm for bpm in self._pending if not bpm.monitoring]
+        self.bpmsAdmitted.emit(len(admitted))
+        return len(admitted)
+
+    def _admit_late_bpms(self):
+        self._admit_connected()
+        if len(self._pending) == 0:
+            print("All BPMs connected.")
+            self._reconnect_timer.stop()
     
     def disconnect(self):
+        self.stop_connecting()
         for bpm in self.bpms:
-            for pv in bpm.pv_objects():
-                pv.unsubscribe()
-                pv.disconnect()
+            bpm.stop_monitoring()
+        self._pending = []
         self.connected = False
     
     def to_static(self, use_buffers=False, name=None):
@@ -1048,38 +1519,79 @@ class Orbit(BaseOrbit):
             old_n_meas = self.edef.n_measurements
             edef_was_started = not self.edef.is_acquisition_complete()
             self.edef.n_measurements = 1
-            self.edef.start()
-            #Loop until a single shot aquisition is complete.
-            while not self.edef.is_acquisition_complete():
-                time.sleep(0.001)
-        #If we're in 'use_buffers' mode, we extract the values and rms values out of the
-        #BSA history buffers.  Doing this is much slower, because we aren't already
-        #monitoring those PVs, but it gives you RMS data, which you can't get via
-        #other means.
-        if use_buffers and self.edef is not None and self.edef.is_reserved():
-            x_buffers = batch_get([bpm.buffer_pv('x') for bpm in self.bpms])
-            y_buffers = batch_get([bpm.buffer_pv('y') for bpm in self.bpms])
-            tmit_buffers = batch_get([bpm.buffer_pv('tmit') for bpm in self.bpms])
-            x_rms_buffers = batch_get([bpm.buffer_pv('x', suffix='RMSHST') for bpm in self.bpms])
-            y_rms_buffers = batch_get([bpm.buffer_pv('y', suffix='RMSHST') for bpm in self.bpms])
-            tmit_rms_buffers = batch_get([bpm.buffer_pv('tmit', suffix='RMSHST') for bpm in self.bpms])
-            for bpm in self.bpms:
-                x = x_buffers[bpm.buffer_pv('x')][0]
-                y = y_buffers[bpm.buffer_pv('y')][0]
-                tmit = tmit_buffers[bpm.buffer_pv('tmit')][0]
-                x_rms = x_rms_buffers[bpm.buffer_pv('x', suffix='RMSHST')][0]
-                y_rms = y_rms_buffers[bpm.buffer_pv('y', suffix='RMSHST')][0]
-                tmit_rms = tmit_rms_buffers[bpm.buffer_pv('tmit', suffix='RMSHST')][0]
-                static_bpm = StaticBPM(bpm.name, z_pos=bpm.z, x_val=x, y_val=y, tmit_val=tmit, x_rms=x_rms, y_rms=y_rms, tmit_rms=tmit_rms, x_status=bpm.status('x'), y_status=bpm.status('y'), tmit_status=bpm.status('tmit'), x_severity=bpm.severity('x'), y_severity=bpm.severity('y'), tmit_severity=bpm.severity('tmit'))
-                new_static_orbit.append(static_bpm)
-        else:
-            new_static_orbit.bpms = [bpm.to_static() for bpm in self.bpms]
-        if old_n_meas is not None:
-            self.edef.n_measurements = old_n_meas
-        if edef_was_started:
-            self.edef.start()
+        try:
+            if old_n_meas is not None:
+                #Wait for the CTRL monitor to say the single shot aquisition is complete.
+                self.edef.start_acquisition().result(timeout=self.acquisition_timeout)
+            if isinstance(self.edef, EventDefinition):
+                #Make extra sure we've got the latest data.
+                for bpm in self.bpms:
+                    if not bpm.monitoring:
+                        continue
+                    for pv in bpm.pv_objects():
+                        pv.get()
+                    bpm.update_from_pvs()
+            #Freeze the live values by copying every column at once.
+            frozen = self._store.take(np.arange(len(self._store)))
+            #If we're in 'use_buffers' mode, we extract the values and rms values out of the
+            #BSA history buffers.  Doing this is much slower, because we aren't already
+            #monitoring those PVs, but it gives you RMS data, which you can't get via
+            #other means.
+            if use_buffers and self.edef is not None and self.edef.is_reserved():
+                #Every X, Y and TMIT buffer (and their RMS buffers) in one bulk get.
+                pvs = {(bpm.name, axis): "{name}:{axis}".format(name=bpm.name, axis=axis.upper()) for bpm in self.bpms for axis in ('x', 'y', 'tmit')}
+                buffers = self.edef.get_buffers(list(pvs.values()), suffixes=('HST', 'RMSHST'))
+                for axis in ('x', 'y', 'tmit'):
+                    for field, suffix in ((axis, 'HST'), (axis + '_rms', 'RMSHST')):
+                        column = [buffers[suffix][pvs[(bpm.name, axis)]] for bpm in self.bpms]
+                        frozen.column(field)[:] = [np.nan if buff is None or len(buff) == 0 else buff[0] for buff in column]
+            new_static_orbit._adopt_store(frozen)
+        finally:
+            if old_n_meas is not None:
+                self.edef.n_measurements = old_n_meas
+            if edef_was_started:
+                self.edef.start()
         return new_static_orbit
 
+    def fit_buffers(self, start, end, fit_point, edef=None, min_tmit=0.0, **fit_options):
+        """Fit a trajectory to every shot in an EDEF's BSA history buffers.
+        The X, Y and TMIT buffers for every BPM are captured in one batch (see
+        EventDefinition.capture), and fit in one vectorized pass with BaseOrbit.fit_shots.
+
+        Parameters:
+        ----------
+        start, end, fit_point :
+            The same as for BaseOrbit.fit.
+        edef : Optional[EventDefinition]
+            The EDEF to read buffers from.  Defaults to this orbit's EDEF.
+        min_tmit : Optional[float]
+            Readings from shots where a BPM's TMIT is at or below this value are left out of the fit.
+        fit_options :
+            Any of the fit_* keyword arguments accepted by BaseOrbit.fit.
+
+        Returns
+        -------
+        dict
+            The result of BaseOrbit.fit_shots, with an extra 'pulse_ids' key holding
+            the pulse ID of each shot.
+        """
+        if edef is None:
+            edef = self.edef
+        if not isinstance(edef, EventDefinition) or not edef.is_reserved():
+            raise Exception("A reserved EventDefinition is needed to fit buffered data.")
+        names = self.names()
+        pvs = {axis: ["{name}:{axis}".format(name=name, axis=axis.upper()) for name in names] for axis in ('x', 'y', 'tmit')}
+        capture = edef.capture(pvs['x'] + pvs['y'] + pvs['tmit'], rms=False)
+        n = len(names)
+        xs = capture.data[:, 0:n]
+        ys = capture.data[:, n:2*n]
+        tmits = capture.data[:, 2*n:3*n]
+        #A reading is only good if its X, Y and TMIT buffers all had data for the shot.
+        good = capture.valid[:, 0:n] & capture.valid[:, n:2*n] & capture.valid[:, 2*n:3*n] & (tmits > min_tmit)
+        result = self.fit_shots(xs, ys, good, start, end, fit_point, **fit_options)
+        result['pulse_ids'] = capture.pulse_ids
+        return result
+
     def to_dict(self, use_buffers=True):
         frozen = self.to_static(use_buffers=use_buffers)
         return frozen.to_dict()
@@ -0,0 +1,182 @@
+import numpy as np
+from collections import OrderedDict
+MODEL_AVAILABLE = False
+try:
+    import utilities.model as model
+    import utilities.model_list as model_list
+    MODEL_AVAILABLE = True
+except ImportError:
+    MODEL_AVAILABLE = False
+
+"""Orbit correction with many correctors at once, from the model's orbit response."""
+#Converts an integrated field in kG-m to a kick in radians, at a momentum in GeV/c.
+KICK_PER_KGM = 0.0299792458
+
+class OrbitCorrector(object):
+    """Solves for corrector changes which move an orbit onto a target, and applies them.
+
+    The response matrix (mm of orbit at each BPM per kG-m at each corrector) is
+    built from the model's R12 (for X) or R34 (for Y) between every corrector and every
+    BPM downstream of it, and the beam momentum at each corrector.  It is cached until
+    the orbit's BPMs or the magnet list change.  The SVD of the rows for the BPMs in
+    use is cached too, so a solve is a couple of matrix-vector products.
+
+    Solutions are Tikhonov regularized: each singular value s is inverted as
+    s/(s^2 + l^2), with l = regularization*(largest singular value).  This damps
+    the weak directions which would otherwise take huge corrector changes to fit
+    noise.
+
+    Parameters
+    ----------
+    orbit : BaseOrbit
+        The orbit to correct, usually the live orbit.
+    magnet_list : MagnetList
+        The correctors to use.  The axis (X or Y) comes from the magnet list.
+    regularization : Optional[float]
+        The default regularization, relative to the largest singular value.
+    use_design : Optional[bool]
+        Whether to use the design model instead of the extant model.
+    """
+    #The number of SVDs (one per set of BPMs in use) to keep.
+    max_decompositions = 8
+    def __init__(self, orbit, magnet_list, regularization=0.05, use_design=False):
+        if MODEL_AVAILABLE == False:
+            raise Exception("Model is not available, cannot build an orbit response matrix.")
+        self.orbit = orbit
+        self.magnet_list = magnet_list
+        self.axis = magnet_list.axis.lower()
+        self.regularization = regularization
+        self.use_design = use_design
+        self._response = None
+        self._response_key = None
+        self._decompositions = OrderedDict()
+        self._undo_stack = []
+
+    def _layout_key(self):
+        return (self.orbit._layout_version, tuple(self.magnet_list.names()))
+
+    def response_matrix(self, refresh=False):
+        """Get the (n_bpms x n_correctors) response matrix, in mm per kG-m.  BPMs
+        which aren't in the model have a row of zeros."""
+        key = self._layout_key()
+        if refresh or self._response is None or self._response_key != key:
+            self._response = self._build_response()
+            self._response_key = key
+            self._decompositions = OrderedDict()
+        return self._response
+
+    def _build_response(self):
+        bpm_names = self.orbit.names()
+        cor_names = self.magnet_list.names()
+        machine_model = model.get_machine_model(self.use_design)
+        bpm_mats = machine_model.r_mats(bpm_names, ignore_bad_names=True)
+        cor_mats = machine_model.r_mats(cor_names, ignore_bad_names=True)
+        #The R matrix from corrector c to BPM b is R_b*inv(R_c).  Only the row (of R_b) and
+        #column (of inv(R_c)) for R12 or R34 are needed, so the whole matrix is one product.
+        (row, col) = (0, 1) if self.axis == 'x' else (2, 3)
+        cor_inv = np.full(cor_mats.shape, np.nan)
+        good_cors = np.all(np.isfinite(cor_mats), axis=(1, 2))
+        cor_inv[good_cors] = np.linalg.inv(cor_mats[good_cors])
+        r = np.dot(bpm_mats[:, row, :], cor_inv[:, :, col].T)
+        #A corrector can't move the orbit at BPMs upstream of it.
+        r[self.orbit.vals('z')[:, np.newaxis] <= self.magnet_list.z_vals()[np.newaxis, :]] = 0.0
+        p = model_list.shared_table().device_values('p0c', cor_names)*1.0e-9
+        response = r*(KICK_PER_KGM/p)[np.newaxis, :]*1000.0
+        response[~np.isfinite(response)] = 0.0
+        return response
+
+    def _decomposition(self, rows):
+        """Get the SVD of the response matrix rows for the BPMs in rows (a boolean mask)."""
+        response = self.response_matrix()
+        key = rows.tobytes()
+        try:
+            decomposition = self._decompositions.pop(key)
+        except KeyError:
+            decomposition = np.linalg.svd(response[rows], full_matrices=False)
+            if len(self._decompositions) >= self.max_decompositions:
+                self._decompositions.popitem(last=False)
+        self._decompositions[key] = decomposition
+        return decomposition
+
+    def goal(self, target=None, reference=None):
+        """Get the orbit to steer to, one value per BPM: target (an array), the readings
+        of a reference orbit (matched by BPM name), or zero."""
+        names = self.orbit.names()
+        if target is not None:
+            return np.asarray(target, dtype=float)
+        if reference is not None:
+            reference_vals = dict(zip(reference.names(), reference.vals(self.axis)))
+            return np.array([reference_vals.get(name, np.nan) for name in names], dtype=float)
+        return np.zeros(len(names))
+
+    def solve(self, target=None, reference=None, regularization=None, bpm_mask=None):
+        """Solve for the corrector changes which best move the orbit onto the goal
+        (see goal()).  Only BPMs with a good reading, a goal, and a model entry are used.
+
+        Parameters
+        ----------
+        target : Optional[numpy.ndarray]
+            The orbit to steer to, in mm, one value per BPM in the orbit.
+        reference : Optional[BaseOrbit]
+            An orbit to steer to, if target isn't given.
+        regularization : Optional[float]
+            Overrides the corrector's default regularization.
+        bpm_mask : Optional[numpy.ndarray]
+            A boolean array, one per BPM, which is False for BPMs to leave out.
+
+        Returns
+        -------
+        dict
+            'delta': the change for each corrector in kG-m, in magnet list order.
+            'predicted': the predicted orbit after the change, in mm (NaN for BPMs not used).
+            'residual_rms': the predicted RMS distance from the goal, in mm, at the BPMs used.
+            'bpms_used': a boolean array, True for the BPMs used.
+        """
+        if regularization is None:
+            regularization = self.regularization
+        response = self.response_matrix()
+        snapshot = self.orbit.snapshot()
+        current = snapshot[self.axis]
+        error = current - self.goal(target, reference)
+        rows = np.isfinite(error) & (snapshot[self.axis + '_severity'] == 0) & np.any(response != 0.0, axis=1)
+        if bpm_mask is not None:
+            rows &= np.asarray(bpm_mask, dtype=bool)
+        if not np.any(rows):
+            raise ValueError("No usable BPMs to steer with.")
+        (u, s, vt) = self._decomposition(rows)
+        l = regularization*s[0]
+        denominator = s*s + l*l
+        s_inv = np.divide(s, denominator, out=np.zeros_like(s), where=denominator > 0)
+        delta = -np.dot(vt.T, s_inv*np.dot(u.T, error[rows]))
+        predicted = np.full(len(current), np.nan)
+        predicted[rows] = current[rows] + np.dot(response[rows], delta)
+        residual = predicted[rows] - (current[rows] - error[rows])
+        return {'delta': delta, 'predicted': predicted, 'residual_rms': np.sqrt(np.mean(residual*residual)), 'bpms_used': rows}
+
+    def apply(self, delta, timeout=5.0):
+        """Add delta (kG-m per corrector) to the corrector setpoints, with one batched write.
+        The setpoints from before the write are saved for undo().
+
+        Returns
+        -------
+        GetResult
+            The result of MagnetList.write_setpoints."""
+        before = self.magnet_list.setpoints()
+        self._undo_stack.append(before)
+        return self.magnet_list.write_setpoints(before + np.asarray(delta, dtype=float), timeout=timeout)
+
+    def correct(self, target=None, reference=None, regularization=None, timeout=5.0):
+        """Solve for, and apply, a correction.  Returns the solution (see solve()), with
+        the result of the write under 'write'."""
+        solution = self.solve(target=target, reference=reference, regularization=regularization)
+        solution['write'] = self.apply(solution['delta'], timeout=timeout)
+        return solution
+
+    def can_undo(self):
+        return len(self._undo_stack) > 0
+
+    def undo(self, timeout=5.0):
+        """Restore the setpoints from before the last apply(), with one batched write."""
+        if not self.can_undo():
+            raise Exception("No correction to undo!")
+        return self.magnet_list.write_setpoints(self._undo_stack.pop(), timeout=timeout)
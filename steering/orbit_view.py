@@ -1,4 +1,5 @@
 import math
+import numpy as np
 from PyQt5.QtWidgets import QGraphicsView, QGraphicsLineItem, QApplication, QMenu, QAction
 from PyQt5.QtGui import QColor, QBrush, QPen
 from PyQt5.QtCore import pyqtSlot, QLineF, QRectF, QPoint, QPointF, Qt
@@ -6,11 +7,15 @@ from pyqtgraph import GraphicsLayoutWidget, PlotItem, ViewBox, GraphicsItem, Gra
 from orbit import Orbit, BPM
 from bpm_line_item import BPMLineItem
 from magnet_view import MagnetView
-from PyQt5.QtCore import QTimer
+from frame_governor import FrameGovernor
+import utilities.perf as perf
 
 class OrbitView(GraphicsLayoutWidget):
-    def __init__(self, orbit=None, axis="X", use_sector_ticks=True, parent=None, ymin=-1.0, ymax=1.0, name=None, label=None, units=None, draw_timer=None, magnet_list=None):
+    def __init__(self, orbit=None, axis="X", use_sector_ticks=True, parent=None, ymin=-1.0, ymax=1.0, name=None, label=None, units=None, draw_timer=None, magnet_list=None, batched=True):
         super(OrbitView, self).__init__(parent=parent)
+        #In batched mode, all the BPM bars are drawn by three plot items (one per pen),
+        #updated straight from the orbit's arrays.  Otherwise, each BPM gets its own line item.
+        self.batched = batched
         axis = axis.lower()
         if axis not in ["x", "y", "tmit"]:
             raise Exception("Axis must be 'x', 'y', or 'tmit'")
@@ -78,7 +83,17 @@ class OrbitView(GraphicsLayoutWidget):
         self.axis_line.setPen(self.axis_pen)
         self.plotItem.addItem(self.axis_line, ignoreBounds=True)
         self.lines = {}
+        self.bar_items = {}
+        if self.batched:
+            for state, pen in (('normal', self.bpm_pen), ('energy', self.energy_bpm_pen), ('no_beam', self.no_beam_pen)):
+                self.bar_items[state] = PlotDataItem(pen=pen, connect='pairs')
+                self.plotItem.addItem(self.bar_items[state])
         self.orbit = None
+        #The orbit's seq and fit data as of the last redraw, so unchanged frames can be skipped.
+        self._drawn_seq = None
+        self._drawn_fit = None
+        self.frames_drawn = 0
+        self.frames_skipped = 0
         self.needs_initial_range = True
         self.set_draw_timer(draw_timer)
         self._display_fit = False
@@ -99,17 +114,21 @@ class OrbitView(GraphicsLayoutWidget):
             self.plotItem.removeItem(self.fit_data_item)
             self.fit_data_item = None
         self._display_fit = enabled
+        self._drawn_seq = None
         
     def set_draw_timer(self, new_timer, start=False):
         try:
             self.draw_timer.timeout.disconnect(self.redraw_bpms)
         except:
             pass
+        if isinstance(getattr(self, 'draw_timer', None), FrameGovernor):
+            self.draw_timer.remove_view(self)
         if new_timer is None:
-            new_timer = QTimer(self)
-            new_timer.setInterval(int(1000/60))
+            new_timer = FrameGovernor(self)
         self.draw_timer = new_timer
         self.draw_timer.timeout.connect(self.redraw_bpms)
+        if isinstance(self.draw_timer, FrameGovernor):
+            self.draw_timer.add_view(self)
         if start:
             self.draw_timer.start()
             
@@ -129,11 +148,12 @@ class OrbitView(GraphicsLayoutWidget):
         self.plotItem.setLimits(xMin=self.orbit.zmin()-(0.02*extent), xMax=self.orbit.zmax()+(0.02*extent))
         self.plotItem.enableAutoRange(enable=False)
         self.axis_line.setLine(self.orbit.zmin(),0.0,self.orbit.zmax(),0.0)
-        for bpm in self.orbit:
-            line = BPMLineItem(bpm)
-            self.lines[bpm.name] = line
-            self.set_pen_for_bpm(bpm)
-            self.plotItem.addItem(self.lines[bpm.name])
+        if not self.batched:
+            for bpm in self.orbit:
+                line = BPMLineItem(bpm)
+                self.lines[bpm.name] = line
+                self.set_pen_for_bpm(bpm)
+                self.plotItem.addItem(self.lines[bpm.name])
         if self.use_sector_ticks and (old_zmax != orbit.zmax() or old_zmin != orbit.zmin()):
             self.sector_ticks = [[],[]]
             self.sector_ticks[0] = self.orbit.sector_locations()
@@ -190,17 +210,63 @@ class OrbitView(GraphicsLayoutWidget):
         self.plotItem.enableAutoRange(enable=False)
         if self.orbit is None:
             return
-        for bpm in self.orbit:
-            self.plotItem.removeItem(self.lines[bpm.name])
+        for item in self.bar_items.values():
+            item.setData(x=[], y=[])
+        for line in self.lines.values():
+            self.plotItem.removeItem(line)
         self.plotItem.enableAutoRange(x=auto_range_x_enabled, y=auto_range_y_enabled)
         self.lines = {}
+        self._drawn_seq = None
+        self._drawn_fit = None
             
     @pyqtSlot()
+    @perf.timed('OrbitView.redraw_bpms')
     def redraw_bpms(self):
-        for bpm in self.orbit:
-            self.set_pen_for_bpm(bpm)
-            self.lines[bpm.name].setLine(bpm.z,0.0,bpm.z,bpm[self.axis])
+        #Views sharing a governor share one snapshot per tick.  Its seq is read before the
+        #arrays are copied, so an update which lands mid-copy is picked up next frame.
+        snapshot = self.orbit.snapshot(frame=getattr(self.draw_timer, 'frame', None))
+        seq = snapshot.seq
+        fit_data = self.orbit.fit_data
+        if seq is not None and seq == self._drawn_seq and fit_data is self._drawn_fit:
+            self.frames_skipped += 1
+            return
+        if self.batched:
+            self.redraw_bars(snapshot)
+        else:
+            rows = self.orbit.changed_rows(self._drawn_seq)
+            bpms = self.orbit.bpms
+            if rows is not None:
+                bpms = [bpms[i] for i in rows]
+            for bpm in bpms:
+                self.set_pen_for_bpm(bpm)
+                self.lines[bpm.name].setLine(bpm.z,0.0,bpm.z,bpm[self.axis])
         self.update_fit()
+        self._drawn_seq = seq
+        self._drawn_fit = fit_data
+        self.frames_drawn += 1
+
+    def reset_frame_counters(self):
+        self.frames_drawn = 0
+        self.frames_skipped = 0
+
+    def redraw_bars(self, snapshot=None):
+        """Draw every BPM bar from a snapshot of the orbit, with one setData call per pen."""
+        if snapshot is None:
+            snapshot = self.orbit.snapshot()
+        z = snapshot['z']
+        vals = snapshot[self.axis]
+        no_beam = snapshot[self.axis + '_severity'] != 0
+        energy = snapshot['is_energy_bpm'] & ~no_beam
+        normal = ~(no_beam | energy)
+        drawable = np.isfinite(vals) & np.isfinite(z)
+        for state, mask in (('normal', normal), ('energy', energy), ('no_beam', no_beam)):
+            mask = mask & drawable
+            n = np.count_nonzero(mask)
+            #Each bar is a pair of points, (z, 0) to (z, value).
+            xs = np.repeat(z[mask], 2)
+            ys = np.zeros(2*n)
+            ys[1::2] = vals[mask]
+            self.bar_items[state].setData(x=xs, y=ys)
 
     def set_pen_for_bpm(self, bpm):
         if bpm.severity(self.axis) != 0:
@@ -211,6 +277,7 @@ class OrbitView(GraphicsLayoutWidget):
             else:
                 self.lines[bpm.name].setPen(self.bpm_pen)
 
+    @perf.timed('OrbitView.update_fit')
     def update_fit(self):
         if not self._display_fit:
             return
@@ -4,14 +4,19 @@ import zmq
 from pydm import Display
 from orbit_view import OrbitView
 from orbit import Orbit
+from frame_governor import FrameGovernor
+from live_fit import LiveFitter, format_fit
 from steering_magnets import MagnetList
-from qtpy.QtWidgets import QVBoxLayout, QApplication, QProgressBar, QLabel
+import utilities.perf_widgets as perf_widgets
+from qtpy.QtWidgets import QVBoxLayout, QHBoxLayout, QApplication, QProgressBar, QLabel, QCheckBox
 from qtpy.QtCore import QTimer, Slot, Qt
 
 class SteeringDisplay(Display):
     def __init__(self, parent=None, macros=None, args=[]):
         super(SteeringDisplay, self).__init__(parent=parent, macros=macros, args=args)
         self._live_orbit = None
+        self._pending_orbit = None
+        self.live_fitter = None
         self.setup_ui()
     
     def ui_filename(self):
@@ -22,7 +27,8 @@ class SteeringDisplay(Display):
     
     def setup_ui(self):
         self.setWindowTitle("Steering Panel")
-        self.draw_timer = QTimer(self)
+        #The governor picks the redraw rate from the BPM update rate and the drawing cost.
+        self.draw_timer = FrameGovernor(self)
         self.draw_timer.setInterval(int(1000/5))
         self.setLayout(QVBoxLayout())
         self.current_progress = 0
@@ -32,15 +38,34 @@ class SteeringDisplay(Display):
         self.progress_bar.setMinimum(0)
         self.progress_bar.setMaximum(100)
         self.x_magnet_list = None
+        self.y_magnet_list = None
         self.layout().addStretch()
         self.layout().addWidget(self.loading_label)
         self.layout().addWidget(self.progress_bar)
         self.layout().addStretch()
         position_scale = 2.0
+        tmit_scale = 2.0e9
+        #All three views share the draw timer, so they redraw from one snapshot of the live orbit per tick.
         self.orbit_view = OrbitView(parent=self, axis="x", name="X Orbit", label="X Orbit", units="mm", ymin=-position_scale, ymax=position_scale, draw_timer=self.draw_timer)
-        self.orbit_view.hide()
-        self.layout().addWidget(self.orbit_view)
-        self.layout().setStretchFactor(self.orbit_view, 1)
+        self.y_orbit_view = OrbitView(parent=self, axis="y", name="Y Orbit", label="Y Orbit", units="mm", ymin=-position_scale, ymax=position_scale, draw_timer=self.draw_timer)
+        self.tmit_view = OrbitView(parent=self, axis="tmit", name="TMIT", label="TMIT", units="Nel", ymin=0.0, ymax=tmit_scale, draw_timer=self.draw_timer)
+        self.y_orbit_view.setXLink(self.orbit_view)
+        self.tmit_view.setXLink(self.orbit_view)
+        for view in self.orbit_views():
+            view.hide()
+            self.layout().addWidget(view)
+            self.layout().setStretchFactor(view, 1)
+        fit_layout = QHBoxLayout()
+        self.live_fit_checkbox = QCheckBox("Live Fit", self)
+        self.live_fit_checkbox.setEnabled(False)
+        self.live_fit_checkbox.toggled.connect(self.enable_live_fit)
+        self.fit_label = QLabel(self)
+        fit_layout.addWidget(self.live_fit_checkbox)
+        fit_layout.addWidget(self.fit_label)
+        fit_layout.addStretch()
+        self.layout().addLayout(fit_layout)
+        #Only there when the SIMUI_PERF environment variable is set.
+        self.perf_tools = perf_widgets.attach(self)
         QTimer.singleShot(50,self.initialize_orbit)
         
     @Slot()
@@ -48,18 +73,39 @@ class SteeringDisplay(Display):
         QApplication.instance().processEvents() #Need to call processEvents to make the status bar message show up before the live orbit connection stuff starts.
         orbit = Orbit.lcls_bpms(auto_connect=False, parent=self)
         self.x_magnet_list = MagnetList("X", "xcor_list.json", parent=self)
-        self.total_progress = orbit.progress_total() + self.x_magnet_list.progress_total()
-        num_pvs = orbit.pv_count() + self.x_magnet_list.pv_count()
+        self.y_magnet_list = MagnetList("Y", "ycor_list.json", parent=self)
+        self.total_progress = orbit.progress_total() + self.x_magnet_list.progress_total() + self.y_magnet_list.progress_total()
+        num_pvs = orbit.pv_count() + self.x_magnet_list.pv_count() + self.y_magnet_list.pv_count()
         self.loading_label.setText("Connecting to {} PVs...".format(num_pvs))
         self.loading_label.setAlignment(Qt.AlignCenter)
         self.progress_bar.setMaximum(self.total_progress)
         orbit.connectionProgress.connect(self.increment_progress)
         self.x_magnet_list.connectionProgress.connect(self.increment_progress)
-        orbit.connect()
+        self.y_magnet_list.connectionProgress.connect(self.increment_progress)
         orbit.name = "Live Orbit"
-        self.live_orbit = orbit
+        orbit.layoutReady.connect(self.orbit_layout_ready)
+        orbit.connectFinished.connect(self.orbit_connect_finished)
+        orbit.connectFailed.connect(self.orbit_connect_failed)
+        self._pending_orbit = orbit
+        orbit.connect_async()
+
+    @Slot()
+    def orbit_layout_ready(self):
+        #Show the orbit right away, BPMs fill in as they connect.
+        self.live_orbit = self._pending_orbit
+        for view in self.orbit_views():
+            view.show()
+
+    @Slot()
+    def orbit_connect_finished(self):
+        self._pending_orbit = None
         self.initialize_magnet_lists()
         self.connection_complete()
+
+    @Slot(object)
+    def orbit_connect_failed(self, error):
+        self._pending_orbit = None
+        self.loading_label.setText("Could not connect to the BPMs: {}".format(error))
     
     @Slot()
     def increment_progress(self):
@@ -72,12 +118,39 @@ class SteeringDisplay(Display):
         self.layout().removeWidget(self.loading_label)
         self.progress_bar.deleteLater()
         self.loading_label.deleteLater()
-        self.orbit_view.show()
+        for view in self.orbit_views():
+            view.show()
+        self.live_fit_checkbox.setEnabled(True)
+
+    @Slot(bool)
+    def enable_live_fit(self, enabled):
+        if self.live_fitter is None:
+            #Fit the whole orbit, from the first BPM.
+            self.live_fitter = LiveFitter(self.live_orbit, 0, len(self.live_orbit)-1, 0, timer=self.draw_timer, parent=self)
+            self.live_fitter.fitUpdated.connect(self.show_fit)
+        if enabled:
+            self.live_fitter.start()
+        else:
+            self.live_fitter.stop()
+            self.live_orbit.fit_data = None
+            self.fit_label.setText("")
+        self.orbit_view.display_fit(enabled)
+        self.y_orbit_view.display_fit(enabled)
+
+    @Slot(object)
+    def show_fit(self, result):
+        self.fit_label.setText(format_fit(result))
+
+    def orbit_views(self):
+        return (self.orbit_view, self.y_orbit_view, self.tmit_view)
     
     def initialize_magnet_lists(self):
         self.x_magnet_list.connect()
+        self.y_magnet_list.connect()
         self.orbit_view.set_magnet_list(self.x_magnet_list)
         self.orbit_view.show_magnet_views(True)
+        self.y_orbit_view.set_magnet_list(self.y_magnet_list)
+        self.y_orbit_view.show_magnet_views(True)
     
     @property
     def live_orbit(self):
@@ -88,4 +161,5 @@ class SteeringDisplay(Display):
         if new_live_orbit == self._live_orbit:
             return
         self._live_orbit = new_live_orbit
-        self.orbit_view.set_orbit(self._live_orbit, reset_range=False)
\ No newline at end of file
+        for view in self.orbit_views():
+            view.set_orbit(self._live_orbit, reset_range=False)
\ No newline at end of file
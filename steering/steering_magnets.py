@@ -6,6 +6,15 @@ import pyca
 import numpy as np
 from operator import attrgetter
 import json
+import time
+from utilities.channel_pool import GetResult, OK, NOT_CONNECTED, TIMEOUT
+
+def pv_value(pv):
+    """The latest monitored value of a PV, or NaN if there isn't one yet."""
+    try:
+        return pv.data["value"]
+    except KeyError:
+        return np.nan
 
 class Magnet(object):
     kick_delta = 0.0002 #in kG
@@ -129,21 +138,84 @@ class MagnetList(QObject):
         magnets.sort(key=attrgetter('z'))
         return magnets
     
+    def names(self):
+        return [magnet.name for magnet in self._list]
+
+    def z_vals(self):
+        return np.array([magnet.z for magnet in self._list], dtype=float)
+
+    def setpoints(self):
+        """Get every magnet's BCTRL, from the monitors, as an array.  NaN for magnets with no value yet."""
+        return np.array([pv_value(magnet.bctrl_pv) for magnet in self._list], dtype=float)
+
+    def readbacks(self):
+        """Get every magnet's BACT, from the monitors, as an array.  NaN for magnets with no value yet."""
+        return np.array([pv_value(magnet.bact_pv) for magnet in self._list], dtype=float)
+
+    def snapshot(self):
+        """Get the z position, BCTRL and BACT of every magnet, as a dictionary of arrays in list order."""
+        return {'names': self.names(), 'z': self.z_vals(), 'setpoints': self.setpoints(), 'readbacks': self.readbacks()}
+
     def save_setpoints(self):
-        self.saved_setpoints = np.zeros(len(self))
-        for i, magnet in enumerate(self._list):
-            self.saved_setpoints[i] = magnet.kick_setpoint
+        self.saved_setpoints = self.setpoints()
 
     def save_readbacks(self):
-        self.saved_readbacks = np.zeros(len(self))
-        for i, magnet in enumerate(self._list):
-            self.saved_readbacks[i] = magnet.kick_readback
+        self.saved_readbacks = self.readbacks()
 
-    def load_saved_setpoints(self):
+    def load_saved_setpoints(self, timeout=5.0):
         if self.saved_setpoints is None:
             raise Exception("No saved setpoints to load!")
-        for i, magnet in enumerate(self._list):
-            magnet.kick_setpoint = self.saved_setpoints[i]
+        return self.write_setpoints(self.saved_setpoints, timeout=timeout)
+
+    def write_setpoints(self, values, timeout=5.0, confirm=True, tolerance=1.0e-6):
+        """Write new BCTRL setpoints to many magnets at once.
+
+        Every put is sent before any is waited on, with a single flush.  If confirm is
+        True, the call then waits (for at most timeout seconds overall) until the BCTRL
+        monitor of every magnet shows its new value.
+
+        Args:
+            values (numpy.ndarray or dict): One setpoint per magnet in list order (NaN
+                leaves a magnet alone), or a dictionary of magnet name to setpoint.
+            timeout (Optional[float]): How long to wait for confirmation, in seconds.
+            confirm (Optional[bool]): Whether to wait for the new values to show up.
+            tolerance (Optional[float]): How close (in kG) BCTRL has to be to the new value.
+        Returns:
+            GetResult: Magnet name to the value written (None if it wasn't), with an OK,
+            NOT_CONNECTED or TIMEOUT status for every magnet written to.
+        """
+        if isinstance(values, dict):
+            by_name = {magnet.name: magnet for magnet in self._list}
+            targets = [(by_name[name], value) for (name, value) in values.items()]
+        else:
+            values = np.asarray(values, dtype=float)
+            if len(values) != len(self._list):
+                raise ValueError("Expected {} setpoints, got {}.".format(len(self._list), len(values)))
+            targets = [(magnet, value) for (magnet, value) in zip(self._list, values) if not np.isnan(value)]
+        result = GetResult()
+        sent = []
+        for (magnet, value) in targets:
+            result[magnet.name] = None
+            if magnet.bctrl_pv.state() != 2:
+                result.status[magnet.name] = NOT_CONNECTED
+                continue
+            #A negative timeout sends the put without waiting for it.
+            magnet.bctrl_pv.put(value, timeout=-1.0)
+            sent.append((magnet, value))
+        pyca.flush_io()
+        deadline = time.time() + timeout
+        waiting = list(sent)
+        while confirm and len(waiting) > 0 and time.time() < deadline:
+            pyca.pend_event(0.01)
+            waiting = [(magnet, value) for (magnet, value) in waiting if not abs(pv_value(magnet.bctrl_pv) - value) <= tolerance]
+        unconfirmed = set([magnet.name for (magnet, value) in waiting]) if confirm else set()
+        for (magnet, value) in sent:
+            if magnet.name in unconfirmed:
+                result.status[magnet.name] = TIMEOUT
+                continue
+            result[magnet.name] = value
+            result.status[magnet.name] = OK
+        return result
 
     def __getitem__(self, item):
         return self._list[item]
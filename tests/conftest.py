@@ -0,0 +1,11 @@
+import pytest
+import simulation
+
+@pytest.fixture(scope='session')
+def machine():
+    """A simulated machine, served with simulation.install() for the whole session.
+    Modules keep what they imported from the stand-ins (and edef keeps its NAME
+    monitors), so every test shares the one machine."""
+    machine = simulation.install(seed=0)
+    yield machine
+    simulation.uninstall()
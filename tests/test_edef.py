@@ -0,0 +1,90 @@
+"""Checks EventDefinition.start_acquisition against the simulated machine."""
+
+import pytest
+
+@pytest.fixture
+def edef(machine):
+    from utilities import edef as edef_module
+    e = edef_module.EventDefinition("TEST", measurements=2)
+    yield e
+    e.release()
+
+@pytest.fixture
+def ctrl_posts_on_change(machine, monkeypatch):
+    """Post CTRL monitors only when CTRL changes, as a real bo record does."""
+    original = machine._set
+    def _set(record, value, events, **kw):
+        if record.name.endswith(":CTRL") and record.value == value:
+            return
+        original(record, value, events, **kw)
+    monkeypatch.setattr(machine, '_set', _set)
+
+def test_acquisition_finishes(machine, edef):
+    acquisition = edef.start_acquisition()
+    assert not acquisition.done()
+    machine.step(1)
+    assert not acquisition.done()
+    machine.step(1)
+    assert acquisition.wait(0)
+    assert acquisition.result(0) is edef
+
+def test_stale_ctrl_off_before_the_put_completes_is_ignored(machine, edef, monkeypatch):
+    #Like Channel Access: a put only completes later, unless it is waited for, and a
+    #CTRL=0 monitor from before the put (the first one after subscribing, say) is still
+    #queued, so it is delivered before the put completes.
+    put = edef.ctrl_pv.put
+    queued = []
+    def complete_puts():
+        edef._ctrl_changed(value=0)
+        while len(queued) > 0:
+            put(queued.pop(0))
+    def queued_put(value, wait=False, **kw):
+        queued.append(value)
+        if wait:
+            complete_puts()
+        return 1
+    monkeypatch.setattr(edef.ctrl_pv, 'put', queued_put)
+    acquisition = edef.start_acquisition()
+    if len(queued) > 0:
+        complete_puts()
+    assert not acquisition.done()
+    machine.step(2)
+    assert acquisition.done()
+
+def test_already_running_edef(machine, edef, ctrl_posts_on_change):
+    edef.start()
+    machine.step(1)
+    #CTRL is already 1, so the put posts no monitor.
+    acquisition = edef.start_acquisition()
+    assert not acquisition.done()
+    machine.step(2)
+    assert acquisition.done()
+
+def test_finished_before_the_put_returned(machine, edef, monkeypatch):
+    edef.n_measurements = 1
+    put = edef.ctrl_pv.put
+    def put_then_pulse(value, **kw):
+        result = put(value, **kw)
+        #The acquisition finishes, and its CTRL=0 monitor arrives, before start_acquisition sees the put complete.
+        machine.step(1)
+        return result
+    monkeypatch.setattr(edef.ctrl_pv, 'put', put_then_pulse)
+    acquisition = edef.start_acquisition()
+    assert acquisition.done()
+
+def test_timeout(machine, edef):
+    from utilities.edef import AcquisitionTimeout
+    acquisition = edef.start_acquisition()
+    with pytest.raises(AcquisitionTimeout):
+        acquisition.result(timeout=0.01)
+
+def test_set_masks_refreshes_mask_names_once(edef, monkeypatch):
+    refreshes = []
+    populate = edef.populate_bit_mask_name_cache
+    def counting_populate(refresh=False):
+        refreshes.append(refresh)
+        populate(refresh=refresh)
+    monkeypatch.setattr(edef, 'populate_bit_mask_name_cache', counting_populate)
+    with pytest.raises(KeyError):
+        edef.inclusion_masks = ['NOT_A_MASK', 'NOR_THIS']
+    assert refreshes.count(True) == 1
@@ -0,0 +1,141 @@
+"""Checks the QR least-squares fit in utilities.fit against the original normal
+equations implementation (fit_normal_equations), which it replaced."""
+
+import numpy as np
+import pytest
+from utilities import fit
+
+RTOL = 1e-8
+#The reference implementation uses numpy matrices.
+pytestmark = pytest.mark.filterwarnings('ignore::PendingDeprecationWarning')
+
+def assert_close(actual, expected):
+    actual = np.asarray(actual, dtype=float).reshape(-1)
+    expected = np.asarray(expected, dtype=float).reshape(-1)
+    assert actual.shape == expected.shape
+    #Relative to the value, or absolute for values near zero.
+    assert np.all(np.abs(actual - expected) <= RTOL*np.maximum(np.abs(expected), 1.0))
+
+def random_problem(rng, N, n, k=None):
+    Q = rng.randn(N, n)
+    shape = (n,) if k is None else (n, k)
+    noise = (N,) if k is None else (N, k)
+    s = np.dot(Q, rng.randn(*shape)) + 0.1*rng.randn(*noise)
+    return (Q, s)
+
+def reference(Q, s, sig=None):
+    """fit_normal_equations, called with the numpy matrices it was written for."""
+    sig_col = None if sig is None else np.asarray(sig, dtype=float).reshape(-1, 1)
+    return fit.fit_normal_equations(np.asmatrix(Q), np.asmatrix(s).T, sig_col)
+
+#The sizes used for trajectory fitting (up to 7 parameters, a few to a few hundred BPM readings).
+SIZES = [(2, 1), (3, 2), (10, 3), (40, 5), (200, 7), (600, 7)]
+
+@pytest.mark.parametrize('N, n', SIZES)
+@pytest.mark.parametrize('weighted', [False, True])
+def test_single_matches_normal_equations(N, n, weighted):
+    rng = np.random.RandomState(N*10 + n)
+    (Q, s) = random_problem(rng, N, n)
+    sig = 0.05 + rng.rand(N) if weighted else None
+    new = fit.fit(Q, s.reshape(-1, 1), sig)
+    old = reference(Q, s, sig)
+    for (a, b) in zip(new, old):
+        assert_close(a, b)
+
+def test_column_input_keeps_its_shape():
+    rng = np.random.RandomState(1)
+    (Q, s) = random_problem(rng, 20, 3)
+    (y, dy, R, dR, chisq, V) = fit.fit(Q, s.reshape(-1, 1))
+    assert y.shape == (20, 1)
+    assert dy.shape == (20, 1)
+    assert R.shape == (3, 1)
+    (y, dy, R, dR, chisq, V) = fit.fit(Q, s)
+    assert y.shape == (20,)
+    assert R.shape == (3,)
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_batched_matches_individual_fits(weighted):
+    rng = np.random.RandomState(2)
+    (Q, S) = random_problem(rng, 50, 5, k=6)
+    sig = 0.05 + rng.rand(50) if weighted else None
+    (y, dy, R, dR, chisq, V) = fit.fit(Q, S, sig)
+    assert y.shape == S.shape
+    assert R.shape == (5, 6)
+    for k in range(S.shape[1]):
+        old = reference(Q, S[:, k], sig)
+        assert_close(y[:, k], old[0])
+        assert_close(R[:, k], old[2])
+        if weighted:
+            #The errors don't depend on the data, so are shared by every data set.
+            assert_close(dy, old[1])
+            assert_close(dR, old[3])
+            assert_close(chisq[k], old[4])
+            assert_close(V, old[5])
+        else:
+            #The errors are scaled by each data set's own goodness of fit.
+            assert_close(dy[:, k], old[1])
+            assert_close(dR[:, k], old[3])
+            assert chisq == 1
+            assert_close(V[k], old[5])
+
+def test_weighted_chisq_and_dy():
+    rng = np.random.RandomState(3)
+    (Q, s) = random_problem(rng, 30, 4)
+    sig = 0.05 + rng.rand(30)
+    (y, dy, R, dR, chisq, V) = fit.fit(Q, s, sig)
+    assert_close(chisq, np.sum(((s - y)/sig)**2)/(30 - 4))
+    #dy is the error propagated from the parameters: dy_i^2 = (Q V Q^T)_ii.
+    assert_close(dy, np.sqrt(np.einsum('ij,jk,ik->i', Q, V, Q)))
+    assert_close(dR, np.sqrt(np.diag(V)))
+
+def test_unweighted_fit_is_renormalized():
+    rng = np.random.RandomState(4)
+    (Q, s) = random_problem(rng, 30, 4)
+    (y, dy, R, dR, chisq, V) = fit.fit(Q, s)
+    (y1, dy1, R1, dR1, chisq1, V1) = fit.fit(Q, s, np.ones(30))
+    assert chisq == 1
+    assert_close(y, y1)
+    assert_close(dR, dR1*np.sqrt(chisq1))
+    assert_close(dy, dy1*np.sqrt(chisq1))
+    assert_close(V, V1*chisq1)
+
+def test_exactly_determined():
+    rng = np.random.RandomState(5)
+    (Q, s) = random_problem(rng, 4, 4)
+    new = fit.fit(Q, s.reshape(-1, 1), np.ones(4))
+    old = reference(Q, s, np.ones(4))
+    for (a, b) in zip(new, old):
+        assert_close(a, b)
+    #One data point per parameter: the fit goes through every point.
+    assert_close(new[0], s)
+
+def test_perfect_data_has_zero_chisq():
+    rng = np.random.RandomState(6)
+    Q = rng.randn(20, 3)
+    s = np.dot(Q, np.array([1.0, -2.0, 0.5]))
+    (y, dy, R, dR, chisq, V) = fit.fit(Q, s, np.ones(20))
+    assert_close(R, [1.0, -2.0, 0.5])
+    assert abs(chisq) < 1e-20
+
+@pytest.mark.parametrize('make_Q', [
+    lambda a, b: np.c_[a, a],
+    lambda a, b: np.c_[a, 2.0*a, b],
+    lambda a, b: np.c_[a, np.zeros_like(a)],
+    lambda a, b: np.c_[a, b, a + b],
+], ids=['duplicate', 'scaled', 'zero', 'combination'])
+def test_rank_deficient_raises(make_Q):
+    rng = np.random.RandomState(7)
+    Q = make_Q(rng.randn(10), rng.randn(10))
+    s = rng.randn(10)
+    with pytest.raises(np.linalg.LinAlgError):
+        reference(Q, s)
+    with pytest.raises(np.linalg.LinAlgError):
+        fit.fit(Q, s)
+
+def test_too_few_points_raises():
+    with pytest.raises(ValueError):
+        fit.fit(np.ones((2, 3)), np.ones(2))
+
+def test_wrong_number_of_uncertainties_raises():
+    with pytest.raises(ValueError):
+        fit.fit(np.ones((5, 2)), np.ones(5), np.ones(4))
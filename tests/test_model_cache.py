@@ -0,0 +1,166 @@
+"""Checks the on-disk model cache (utilities.model_cache), alone and as used by
+utilities.model and utilities.model_list against the simulated machine."""
+
+import os
+import json
+import numpy as np
+import pytest
+from utilities import model_cache
+from utilities.model_cache import ModelCache
+
+class CountingFetch(object):
+    """A fetch callable for ModelCache.get which counts its calls."""
+    def __init__(self, timestamp=1.0):
+        self.calls = 0
+        self.timestamp = timestamp
+
+    def __call__(self):
+        self.calls += 1
+        return (np.arange(10.0)*self.calls, self.timestamp)
+
+def test_miss_then_hit(tmp_path):
+    cache = ModelCache(cache_dir=str(tmp_path))
+    fetch = CountingFetch()
+    first = cache.get('key', fetch)
+    second = cache.get('key', fetch)
+    assert fetch.calls == 1
+    assert (cache.misses, cache.hits) == (1, 1)
+    np.testing.assert_array_equal(first, second)
+
+def test_entries_persist_between_caches(tmp_path):
+    fetch = CountingFetch()
+    ModelCache(cache_dir=str(tmp_path)).get('key', fetch)
+    ModelCache(cache_dir=str(tmp_path)).get('key', fetch)
+    assert fetch.calls == 1
+
+def test_expired_entry_is_fetched_again(tmp_path):
+    cache = ModelCache(cache_dir=str(tmp_path), ttl=0.0)
+    fetch = CountingFetch()
+    cache.get('key', fetch)
+    assert cache.get('key', fetch)[1] == 2.0
+    assert fetch.calls == 2
+
+def test_expired_entry_with_unchanged_timestamp_is_used(tmp_path):
+    cache = ModelCache(cache_dir=str(tmp_path), ttl=0.0)
+    fetch = CountingFetch(timestamp=5.0)
+    cache.get('key', fetch)
+    with open(os.path.join(str(tmp_path), 'key.json')) as f:
+        saved = json.load(f)['saved']
+    cache.get('key', fetch, timestamp=lambda: 5.0)
+    assert fetch.calls == 1
+    #The entry's age is reset.
+    with open(os.path.join(str(tmp_path), 'key.json')) as f:
+        assert json.load(f)['saved'] >= saved
+
+def test_expired_entry_with_changed_timestamp_is_fetched_again(tmp_path):
+    cache = ModelCache(cache_dir=str(tmp_path), ttl=0.0)
+    fetch = CountingFetch(timestamp=5.0)
+    cache.get('key', fetch)
+    cache.get('key', fetch, timestamp=lambda: 6.0)
+    assert fetch.calls == 2
+
+def test_failing_timestamp_check_fetches_again(tmp_path):
+    cache = ModelCache(cache_dir=str(tmp_path), ttl=0.0)
+    fetch = CountingFetch()
+    cache.get('key', fetch)
+    def timestamp():
+        raise IOError("No connection")
+    cache.get('key', fetch, timestamp=timestamp)
+    assert fetch.calls == 2
+
+def test_invalidate(tmp_path):
+    cache = ModelCache(cache_dir=str(tmp_path))
+    fetch = CountingFetch()
+    cache.get('a', fetch)
+    cache.get('b', fetch)
+    cache.invalidate('a')
+    cache.get('a', fetch)
+    cache.get('b', fetch)
+    assert fetch.calls == 3
+    cache.invalidate()
+    cache.get('a', fetch)
+    cache.get('b', fetch)
+    assert fetch.calls == 5
+
+def test_other_cache_version_is_ignored(tmp_path):
+    cache = ModelCache(cache_dir=str(tmp_path))
+    fetch = CountingFetch()
+    cache.get('key', fetch)
+    meta_path = os.path.join(str(tmp_path), 'key.json')
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['version'] = model_cache.CACHE_VERSION + 1
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    cache.get('key', fetch)
+    assert fetch.calls == 2
+
+def test_failed_saves_are_not_fatal(tmp_path, monkeypatch):
+    cache = ModelCache(cache_dir=str(tmp_path), ttl=0.0)
+    fetch = CountingFetch(timestamp=5.0)
+    cache.get('key', fetch)
+    def read_only(path, write, mode='w'):
+        raise OSError("Read-only file system")
+    monkeypatch.setattr(model_cache, 'replace_file', read_only)
+    #A valid entry whose age can't be reset is still used.
+    cache.get('key', fetch, timestamp=lambda: 5.0)
+    assert fetch.calls == 1
+    #A fresh fetch which can't be saved is still returned.
+    assert cache.get('key', fetch, timestamp=lambda: 6.0)[1] == 2.0
+
+def test_replace_file_writes_through_a_per_writer_temporary_file(tmp_path):
+    path = os.path.join(str(tmp_path), 'table.json')
+    names = []
+    def write(f):
+        names.append(f.name)
+        f.write('{}')
+    model_cache.replace_file(path, write)
+    assert str(os.getpid()) in os.path.basename(names[0])
+    assert names[0] != path
+    assert os.listdir(str(tmp_path)) == ['table.json']
+
+def test_replace_file_leaves_the_old_file_if_writing_fails(tmp_path):
+    path = os.path.join(str(tmp_path), 'table.json')
+    model_cache.replace_file(path, lambda f: f.write('old'))
+    def write(f):
+        f.write('partial')
+        raise ValueError("Could not serialize")
+    with pytest.raises(ValueError):
+        model_cache.replace_file(path, write)
+    with open(path) as f:
+        assert f.read() == 'old'
+    assert os.listdir(str(tmp_path)) == ['table.json']
+
+def test_full_machine_model_makes_no_rpc_when_cached(machine, tmp_path, monkeypatch):
+    from utilities import model
+    rpcs = []
+    response = machine.model_response
+    def counting_response(path):
+        rpcs.append(path)
+        return response(path)
+    monkeypatch.setattr(machine, 'model_response', counting_response)
+    cache = ModelCache(cache_dir=str(tmp_path))
+    first = model.get_full_machine_model(cache=cache)
+    second = model.get_full_machine_model(cache=cache)
+    assert len(rpcs) == 1
+    np.testing.assert_array_equal(first['z_position'], second['z_position'])
+    model.get_full_machine_model(cache=ModelCache(cache_dir=str(tmp_path)))
+    assert len(rpcs) == 1
+
+def test_twiss_table_is_only_fetched_when_its_timestamp_changes(machine, tmp_path, monkeypatch):
+    from utilities import model_list
+    requests = []
+    get = model_list.c.get
+    def counting_get(name, request=None, **kw):
+        requests.append(request)
+        return get(name, request=request, **kw)
+    monkeypatch.setattr(model_list.c, 'get', counting_get)
+    cache = ModelCache(cache_dir=str(tmp_path), ttl=0.0)
+    model_list.twiss_table(cache=cache)
+    assert requests == [None]
+    #The entry has expired, but only the timestamp is read to check it.
+    model_list.twiss_table(cache=cache)
+    assert requests == [None, "field(timeStamp)"]
+    monkeypatch.setattr(machine, 'model_timestamp', machine.model_timestamp + 1.0)
+    model_list.twiss_table(cache=cache)
+    assert requests == [None, "field(timeStamp)", "field(timeStamp)", None]
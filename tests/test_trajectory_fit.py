@@ -0,0 +1,19 @@
+"""Checks the argument checking in utilities.trajectory_fit."""
+
+import numpy as np
+import pytest
+from utilities.trajectory_fit import TrajectoryFitter
+
+N_BPMS = 10
+ENABLED = (True,)*7
+
+def test_too_few_rmats_raises_value_error():
+    fitter = TrajectoryFitter()
+    Rs = np.tile(np.eye(6), (N_BPMS - 4, 1, 1))
+    zs = np.arange(N_BPMS, dtype=float)
+    readings = np.zeros(N_BPMS)
+    with pytest.raises(ValueError):
+        fitter.fit(Rs, zs, readings, readings, readings, readings, np.zeros(N_BPMS), 0, N_BPMS - 1, 0.5, ENABLED)
+    shots = np.zeros((2, N_BPMS))
+    with pytest.raises(ValueError):
+        fitter.fit_shots(Rs, zs, shots, shots, np.ones((2, N_BPMS), dtype=bool), 0, N_BPMS - 1, 0.5, ENABLED)
@@ -4,16 +4,20 @@ import numpy as np
 from qtpy.QtCore import Slot
 from qtpy.QtGui import QColor
 from pyqtgraph import ColorMap
+import utilities.perf as perf
+import utilities.perf_widgets as perf_widgets
 
 class TuningDisplay(Display):
     def __init__(self, parent=None, macros=None, args=[]):
         super(TuningDisplay, self).__init__(parent=parent, macros=macros, args=args)
         self.gdetPlot._curves[0].data_changed.connect(self.new_gdet_val)
+        self.perf_tools = perf_widgets.attach(self)
         
     def ui_filename(self):
         return "tuning.ui"
         
     @Slot()
+    @perf.timed('TuningDisplay.new_gdet_val')
     def new_gdet_val(self):
         #Update the rolling average
         gdet_mean = np.mean(self.gdetPlot._curves[0].y_waveform[-30:])
@@ -1,18 +1,9 @@
-from epics import ca
+from .channel_pool import default_pool
+from . import perf
 
-def batch_get(pv_list):
-	chids = {}
-	pvdata = {}
-	for name in pv_list:
-		chid = ca.create_channel(name, connect=False, auto_cb=False)
-		chids[name] = chid
-	for name, chid in chids.items():
-		ca.connect_channel(chid)
-	ca.poll()
-	for name, chid in chids.items():
-		ca.get(chid, wait=False)
-	ca.poll()
-	for name, chid in chids.items():
-		val = ca.get_complete(chid)
-		pvdata[name] = val
-	return pvdata
+@perf.timed('batch_get')
+def batch_get(pv_list, timeout=None):
+	"""Get the current value of every PV in pv_list, as a dictionary of PV name to value.
+	PVs which can't be read have a value of None (the result's status attribute says why).
+	Channels are kept open in the shared channel pool, so repeated calls are cheap."""
+	return default_pool().get(pv_list, timeout=timeout)
@@ -0,0 +1,128 @@
+"""bsa_capture.py - Captures the BSA buffers of many PVs at once, aligned by pulse ID.
+
+A capture fetches the data buffer (and optionally the RMS buffer) of every PV, along
+with the edef's pulse ID buffer, in one bulk get.  The result is one 2D array per
+kind of buffer, with a row per shot and a column per PV, so building a dataset needs
+no per-PV bookkeeping.
+"""
+
+import numpy as np
+from .channel_pool import default_pool
+
+class BSACapture(object):
+    """The buffers for a set of PVs from one edef acquisition.
+
+    Shots with no pulse ID (unfilled buffer entries) are left out.  Values which
+    couldn't be read (a buffer that failed to come back, or was shorter than the
+    others) are NaN, and False in the valid mask.
+
+    Attributes:
+        pvs (list of str): The PVs, in column order.
+        pulse_ids (numpy.ndarray): The pulse ID of each shot (row), in acquisition order.
+        data (numpy.ndarray): An (n_shots x n_pvs) array of values.
+        rms (numpy.ndarray): An (n_shots x n_pvs) array of RMS values, or None if RMS
+            buffers weren't captured.
+        valid (numpy.ndarray): An (n_shots x n_pvs) boolean array, True where data holds a real reading.
+        status (dict): The status of the get for every buffer PV (see utilities.channel_pool).
+    """
+    def __init__(self, pvs, pulse_ids, data, rms=None, valid=None, status=None):
+        self.pvs = list(pvs)
+        self.pulse_ids = np.asarray(pulse_ids, dtype=np.int64)
+        self.data = data
+        self.rms = rms
+        self.valid = valid if valid is not None else np.isfinite(data)
+        self.status = status if status is not None else {}
+        self._columns = {pv: i for i, pv in enumerate(self.pvs)}
+        self._rows = None
+
+    def __len__(self):
+        return len(self.pulse_ids)
+
+    def column(self, pv):
+        """Gets the data for one PV, as a view."""
+        return self.data[:, self._columns[pv]]
+
+    def rms_column(self, pv):
+        """Gets the RMS data for one PV, as a view."""
+        return self.rms[:, self._columns[pv]]
+
+    def columns(self, pvs):
+        """Gets the column numbers for a list of PVs."""
+        return [self._columns[pv] for pv in pvs]
+
+    def rows_for(self, pulse_ids):
+        """Gets the row for each pulse ID in pulse_ids, or -1 for pulses which weren't captured."""
+        if self._rows is None:
+            self._rows = {pulse_id: row for row, pulse_id in enumerate(self.pulse_ids.tolist())}
+        return np.array([self._rows.get(pulse_id, -1) for pulse_id in np.atleast_1d(pulse_ids).tolist()], dtype=int)
+
+    def select(self, pvs):
+        """Makes a capture with just some of the PVs (the arrays are copies)."""
+        cols = self.columns(pvs)
+        rms = self.rms[:, cols] if self.rms is not None else None
+        return BSACapture(pvs, self.pulse_ids.copy(), self.data[:, cols], rms=rms, valid=self.valid[:, cols], status=self.status)
+
+    def to_structured(self):
+        """Gets the data as a structured array with one record per shot: a 'pulse_id'
+        field, a 'data' field (and 'rms', if captured) holding a value per PV, and a 'valid' mask."""
+        n = len(self.pvs)
+        dtype = [('pulse_id', 'int64'), ('data', 'float64', (n,)), ('valid', 'bool', (n,))]
+        if self.rms is not None:
+            dtype.append(('rms', 'float64', (n,)))
+        records = np.zeros(len(self), dtype=dtype)
+        records['pulse_id'] = self.pulse_ids
+        records['data'] = self.data
+        records['valid'] = self.valid
+        if self.rms is not None:
+            records['rms'] = self.rms
+        return records
+
+    def to_dict(self):
+        """Gets the capture as a dictionary, ready to save with utilities.matlog.save."""
+        d = {'pvs': np.array(self.pvs, dtype=object), 'pulse_ids': self.pulse_ids, 'data': self.data, 'valid': self.valid}
+        if self.rms is not None:
+            d['rms'] = self.rms
+        return d
+
+def capture(edef, pvs, rms=True, timeout=None):
+    """Captures the data (and RMS) buffers of pvs, and the pulse ID buffer, from an edef.
+
+    Args:
+        edef (EventDefinition): A reserved edef.
+        pvs (list of str): BSA-capable PVs, without any BSA suffixes.
+        rms (Optional[bool]): Whether to capture the RMS buffers too.
+        timeout (Optional[float]): How long to wait for the buffers, in seconds.
+    Returns:
+        BSACapture: The buffers, aligned by pulse ID.
+    """
+    pvs = list(pvs)
+    suffixes = ('HST', 'RMSHST') if rms else ('HST',)
+    pulse_id_pv = edef.buffer_pv("PATT:{sys}:1:PULSEID".format(sys=edef.sys), suffix='HST')
+    names = {suffix: [edef.buffer_pv(pv, suffix=suffix) for pv in pvs] for suffix in suffixes}
+    all_names = [pulse_id_pv]
+    for suffix in suffixes:
+        all_names.extend(names[suffix])
+    values = default_pool().get(all_names, timeout=timeout)
+    if values[pulse_id_pv] is None:
+        raise Exception("Could not read the pulse ID buffer for EDEF {}.".format(edef.edef_num))
+    pulse_ids = np.asarray(values[pulse_id_pv])
+    n_meas = edef.n_measurements
+    if n_meas > 0:
+        #If this isn't a rolling buffer, trim it to only include the collected data.
+        pulse_ids = pulse_ids[:n_meas]
+    #Unfilled entries in the pulse ID buffer are zero.
+    shots = np.where(pulse_ids > 0)[0]
+    def matrix(suffix):
+        m = np.full((len(shots), len(pvs)), np.nan)
+        for (j, name) in enumerate(names[suffix]):
+            buff = values[name]
+            if buff is None:
+                continue
+            buff = np.atleast_1d(buff)
+            rows = shots[shots < len(buff)]
+            m[:len(rows), j] = buff[rows]
+        return m
+    data = matrix('HST')
+    valid = np.isfinite(data)
+    rms_data = matrix('RMSHST') if rms else None
+    return BSACapture(pvs, pulse_ids[shots], data, rms=rms_data, valid=valid, status=values.status)
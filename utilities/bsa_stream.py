@@ -0,0 +1,194 @@
+"""bsa_stream.py - Streams new BSA samples from a rolling edef.
+
+Re-reading a rolling edef's HST buffers costs the whole buffer length every time,
+and Channel Access can't fetch just the end of a waveform.  Instead, a BSAStream
+monitors each PV's per-pulse value for the edef ("{pv}{num}") along with the edef's
+pulse ID PV.  Every BSA PV for a pulse has the same timestamp, so values are matched
+up by timestamp into samples, which are handed out as numpy chunks holding only the
+samples that arrived since the last chunk.  The most recent samples are also kept
+in a ring buffer.
+"""
+
+import threading
+import numpy as np
+import epics
+
+class RingBuffer(object):
+    """A fixed size ring buffer of rows.
+
+    Args:
+        capacity (int): The number of rows to keep.
+        width (int): The number of columns in each row.
+    """
+    def __init__(self, capacity, width):
+        self.data = np.full((capacity, width), np.nan)
+        self.capacity = capacity
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def extend(self, rows):
+        """Adds rows (an N x width array) to the buffer, dropping the oldest rows if it is full."""
+        rows = rows[-self.capacity:]
+        n = len(rows)
+        first = min(n, self.capacity - self._next)
+        self.data[self._next:self._next+first] = rows[:first]
+        self.data[:n-first] = rows[first:]
+        self._next = (self._next + n) % self.capacity
+        self._count = min(self._count + n, self.capacity)
+
+    def rows(self):
+        """Gets a copy of the rows in the buffer, oldest first."""
+        if self._count < self.capacity:
+            return self.data[:self._count].copy()
+        return np.concatenate((self.data[self._next:], self.data[:self._next]))
+
+class BSAStream(object):
+    """Streams new samples of a set of BSA PVs from a rolling edef.
+
+    Use it as a generator (chunks()), poll it (poll()), or give it a callback.  Each
+    chunk is a dictionary with a 'pulse_id' array and an array for every PV, with one
+    entry per new sample.  A value which never arrived for a sample is NaN.
+
+    Args:
+        edef (EventDefinition): The edef to stream from.  It should be rolling
+            (n_measurements == -1).
+        pvs (list of str): BSA-capable PVs, without any BSA suffixes.
+        capacity (Optional[int]): The number of samples to keep in the ring buffer.
+        callback (Optional[callable]): Called with every chunk as it completes.  This
+            runs on the Channel Access callback thread.
+        max_pending (Optional[int]): The number of incomplete samples to hold while
+            waiting for their other values.  When there are more, the oldest is
+            handed out with NaNs for its missing values.
+    """
+    def __init__(self, edef, pvs, capacity=2800, callback=None, max_pending=360):
+        self.edef = edef
+        self.pvs = list(pvs)
+        self.callback = callback
+        self.max_pending = max_pending
+        self.columns = ['pulse_id'] + self.pvs
+        self.ring = RingBuffer(capacity, len(self.columns))
+        self.num_acquired = None
+        self.samples_dropped = 0
+        self._lock = threading.Condition()
+        self._pending = {}
+        self._new = []
+        self._pv_objects = []
+        self._stopped = True
+
+    def start(self):
+        """Starts monitoring the PVs."""
+        if not self._stopped:
+            return
+        self._stopped = False
+        pulse_id_pv = "PATT:{sys}:1:PULSEID{num}".format(sys=self.edef.sys, num=self.edef.edef_num)
+        names = [pulse_id_pv] + ["{pv}{num}".format(pv=pv, num=self.edef.edef_num) for pv in self.pvs]
+        self._pv_objects = [epics.PV(name, form='time', callback=self._make_callback(column)) for column, name in enumerate(names)]
+        count_pv = "EDEF:{sys}:{num}:CNT".format(sys=self.edef.sys, num=self.edef.edef_num)
+        self._pv_objects.append(epics.PV(count_pv, callback=self._count_changed))
+
+    def stop(self):
+        """Stops monitoring the PVs."""
+        self._stopped = True
+        for pv in self._pv_objects:
+            pv.clear_callbacks()
+            pv.disconnect()
+        self._pv_objects = []
+        with self._lock:
+            self._lock.notify_all()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def _make_callback(self, column):
+        def callback(value=None, timestamp=None, posixseconds=None, nanoseconds=None, **kw):
+            #Match samples on the exact timestamp if we have it, the float version otherwise.
+            key = (posixseconds, nanoseconds) if nanoseconds is not None else timestamp
+            self._add_value(key, column, value)
+        return callback
+
+    def _count_changed(self, value=None, **kw):
+        with self._lock:
+            if self.num_acquired is not None and value is not None and value < self.num_acquired:
+                #The edef was restarted, anything still waiting is from the old acquisition.
+                self._pending = {}
+            self.num_acquired = value
+
+    def _add_value(self, key, column, value):
+        with self._lock:
+            try:
+                (sample, arrived) = self._pending[key]
+            except KeyError:
+                (sample, arrived) = (np.full(len(self.columns), np.nan), np.zeros(len(self.columns), dtype=bool))
+                self._pending[key] = (sample, arrived)
+            sample[column] = value
+            arrived[column] = True
+            completed = []
+            if arrived.all():
+                completed.append(self._pending.pop(key)[0])
+            while len(self._pending) > self.max_pending:
+                (sample, arrived) = self._pending.pop(min(self._pending))
+                if not arrived[0]:
+                    #Without a pulse ID the sample can't be placed.
+                    self.samples_dropped += 1
+                    continue
+                completed.append(sample)
+            if len(completed) == 0:
+                return
+            rows = np.array(completed)
+            self.ring.extend(rows)
+            self._new.append(rows)
+            self._lock.notify_all()
+        if self.callback is not None:
+            self.callback(self._to_chunk(rows))
+
+    def _to_chunk(self, rows):
+        chunk = {column: rows[:, i] for i, column in enumerate(self.columns)}
+        chunk['pulse_id'] = rows[:, 0].astype(np.int64)
+        return chunk
+
+    def poll(self):
+        """Gets the samples which arrived since the last poll (or chunk), without waiting.
+        Returns None if there aren't any."""
+        with self._lock:
+            return self._take_new()
+
+    def _take_new(self):
+        if len(self._new) == 0:
+            return None
+        rows = np.concatenate(self._new)
+        self._new = []
+        return self._to_chunk(rows)
+
+    def chunks(self, timeout=None):
+        """A generator of chunks of new samples.  Stops when the stream is stopped,
+        or when no samples arrive for timeout seconds."""
+        while not self._stopped:
+            with self._lock:
+                if len(self._new) == 0:
+                    self._lock.wait(timeout)
+                chunk = self._take_new()
+            if chunk is None:
+                if timeout is not None:
+                    return
+                continue
+            yield chunk
+
+    def buffer(self, pv=None):
+        """Gets the samples in the ring buffer for a PV (or the pulse IDs, if pv is None), oldest first."""
+        with self._lock:
+            rows = self.ring.rows()
+        if pv is None:
+            return rows[:, 0].astype(np.int64)
+        return rows[:, self.columns.index(pv)]
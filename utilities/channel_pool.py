@@ -0,0 +1,272 @@
+"""channel_pool.py - Bulk Channel Access gets and puts over a shared pool of channels.
+
+Channels are created on first use and kept open in a least-recently-used pool,
+so repeated reads of the same PVs (BSA buffers, for example) skip the search and
+connection entirely.  A bulk get sends every request before waiting for any of
+them, waits at most a fixed timeout overall, and reports a status for every PV.
+Channels in use by a get or put are never cleared: the pool grows past its limit
+for as long as a request needs it to, and shrinks back afterwards.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from epics import ca
+
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_MAX_CHANNELS = 4096
+
+#Per-PV status values in a GetResult.
+OK = 'ok'
+NOT_CONNECTED = 'not connected'
+TIMEOUT = 'timeout'
+
+class GetResult(dict):
+    """The result of a bulk get or put: a dictionary of PV name to value.  PVs which
+    could not be read (or written) have a value of None, and their reason is in status.
+
+    Attributes:
+        status (dict): PV name to OK, NOT_CONNECTED or TIMEOUT.
+    """
+    def __init__(self):
+        super(GetResult, self).__init__()
+        self.status = {}
+
+    @property
+    def failed(self):
+        """The names of the PVs which could not be read."""
+        return [name for name, status in self.status.items() if status != OK]
+
+    @property
+    def ok(self):
+        return len(self.failed) == 0
+
+class PendingGet(object):
+    """A bulk get running in the background (see ChannelPool.get_async)."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the get to finish, and return its GetResult.  Raises any exception
+        raised by the get, or RuntimeError if it doesn't finish within timeout."""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Bulk get did not finish within {} seconds.".format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, callback):
+        """Call callback(pending_get) once the get is done (from the background thread),
+        or right away if it is already done."""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+class ChannelPool(object):
+    """A pool of open Channel Access channels, shared by everything that does bulk gets.
+
+    Args:
+        max_channels (Optional[int]): The most channels to keep open between requests.
+            When the pool is full, the least recently used channels not in use are cleared.
+        timeout (Optional[float]): The default timeout for a bulk get, in seconds.
+    """
+    def __init__(self, max_channels=DEFAULT_MAX_CHANNELS, timeout=DEFAULT_TIMEOUT):
+        self.max_channels = max_channels
+        self.timeout = timeout
+        self._chids = OrderedDict()
+        #PV name to the number of running gets and puts using its channel.
+        self._in_use = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._chids)
+
+    def __contains__(self, name):
+        return name in self._chids
+
+    def channel(self, name):
+        """Get the channel for a PV, creating it (without waiting for it to connect) if needed."""
+        with self._lock:
+            try:
+                chid = self._chids.pop(name)
+            except KeyError:
+                self._evict(self.max_channels - 1)
+                chid = ca.create_channel(name, connect=False, auto_cb=False)
+            self._chids[name] = chid
+            return chid
+
+    def _evict(self, size):
+        """Clear the least recently used channels which are not in use, until there are
+        at most size channels (or every channel left is in use)."""
+        for name in list(self._chids):
+            if len(self._chids) <= max(size, 0):
+                break
+            if name in self._in_use:
+                continue
+            chid = self._chids.pop(name)
+            try:
+                ca.clear_channel(chid)
+            except ca.ChannelAccessException:
+                pass
+
+    def _release(self, chids):
+        """Finish using channels returned by _connect, and shrink the pool back to its limit."""
+        with self._lock:
+            for name in chids:
+                self._in_use[name] -= 1
+                if self._in_use[name] == 0:
+                    del self._in_use[name]
+            self._evict(self.max_channels)
+
+    def clear(self):
+        """Clear every channel in the pool, except those in use by a running get or put."""
+        with self._lock:
+            self._evict(0)
+
+    def get(self, pv_list, timeout=None, count=None, as_string=False):
+        """Get the current value of every PV in pv_list.
+
+        Every channel is connected, and every get request is sent, before waiting on
+        any of them, so the whole call takes at most about timeout seconds no matter
+        how many PVs there are.
+
+        Args:
+            pv_list (list of str): The PVs to get.
+            timeout (Optional[float]): How long to wait, in seconds.  Defaults to the pool's timeout.
+            count (Optional[int]): The number of elements to get, for waveforms.
+            as_string (Optional[bool]): Whether to get values as strings.
+        Returns:
+            GetResult: PV name to value, with a status for every PV.
+        """
+        (chids, deadline) = self._connect(pv_list, timeout)
+        try:
+            result = GetResult()
+            requested = []
+            for name, chid in chids.items():
+                result[name] = None
+                if not ca.isConnected(chid):
+                    result.status[name] = NOT_CONNECTED
+                    continue
+                ca.get(chid, count=count, as_string=as_string, wait=False)
+                requested.append(name)
+            ca.poll()
+            for name in requested:
+                value = ca.get_complete(chids[name], count=count, as_string=as_string, timeout=max(deadline - time.time(), 1.e-3))
+                result[name] = value
+                result.status[name] = OK if value is not None else TIMEOUT
+            return result
+        finally:
+            self._release(chids)
+
+    def _connect(self, pv_list, timeout):
+        """Get channels for every PV, and wait (until the deadline) for them to connect.
+        Returns the channels, and the deadline for the rest of the operation.  The
+        channels are in use (so they won't be cleared) until they are passed to _release."""
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        chids = OrderedDict()
+        with self._lock:
+            for name in pv_list:
+                if name in chids:
+                    continue
+                chids[name] = self.channel(name)
+                self._in_use[name] = self._in_use.get(name, 0) + 1
+        waiting = [name for name, chid in chids.items() if not ca.isConnected(chid)]
+        while len(waiting) > 0 and time.time() < deadline:
+            ca.poll(evt=1.e-3, iot=0.0)
+            waiting = [name for name in waiting if not ca.isConnected(chids[name])]
+        return (chids, deadline)
+
+    def put(self, values, timeout=None, wait=True):
+        """Put a value to every PV in values.
+
+        Every put is sent before waiting on any of them.  If wait is True, the puts
+        use completion callbacks, and the call waits (once, for at most about timeout
+        seconds) for all of them to complete.
+
+        Args:
+            values (dict): PV name to the value to put.
+            timeout (Optional[float]): How long to wait, in seconds.  Defaults to the pool's timeout.
+            wait (Optional[bool]): Whether to wait for the puts to complete.
+        Returns:
+            GetResult: PV name to the value put (None if it wasn't), with a status for every PV.
+        """
+        (chids, deadline) = self._connect(list(values), timeout)
+        try:
+            return self._put(chids, values, deadline, wait)
+        finally:
+            self._release(chids)
+
+    def _put(self, chids, values, deadline, wait):
+        result = GetResult()
+        completed = set()
+        def completion_callback(pvname=None, data=None, **kw):
+            completed.add(data)
+        requested = []
+        for name, chid in chids.items():
+            result[name] = None
+            if not ca.isConnected(chid):
+                result.status[name] = NOT_CONNECTED
+                continue
+            if wait:
+                ca.put(chid, values[name], wait=False, callback=completion_callback, callback_data=name)
+            else:
+                ca.put(chid, values[name], wait=False)
+            requested.append(name)
+        ca.flush_io()
+        while wait and len(completed) < len(requested) and time.time() < deadline:
+            ca.poll(evt=1.e-3, iot=0.0)
+        for name in requested:
+            if wait and name not in completed:
+                result.status[name] = TIMEOUT
+                continue
+            result[name] = values[name]
+            result.status[name] = OK
+        return result
+
+    def get_async(self, pv_list, callback=None, timeout=None, count=None, as_string=False):
+        """Start a bulk get on a background thread, and return a PendingGet for it.
+        If callback is given, it is called with the PendingGet when the get finishes
+        (on the background thread, so don't touch widgets from it)."""
+        pending = PendingGet()
+        if callback is not None:
+            pending.add_done_callback(callback)
+        def run():
+            ca.use_initial_context()
+            try:
+                pending._finish(result=self.get(pv_list, timeout=timeout, count=count, as_string=as_string))
+            except Exception as e:
+                pending._finish(error=e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return pending
+
+_default_pool = None
+
+def default_pool():
+    """Get the process-wide ChannelPool."""
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ChannelPool()
+    return _default_pool
@@ -5,9 +5,25 @@ Author: Matt Gibbs (mgibbs@slac.stanford.edu)
 import epics
 import os
 import time
-from .batch_get import batch_get
+import json
+import atexit
+import threading
+from functools import partial
+from collections import OrderedDict
+from .channel_pool import default_pool
+from .model_cache import default_cache_dir, replace_file
+from .bsa_stream import BSAStream
+from . import bsa_capture
 
 NUM_MASK_BITS = 160
+#How long a saved table of mask bit names is trusted, in seconds.
+MASK_NAME_CACHE_TTL = 24*3600.0
+NUM_EDEFS = 15
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
 
 def get_system():
     """Gets the accelerator you are currently running on (LCLS, FACET, LCLS2, NLCTA, etc).
@@ -39,16 +55,154 @@ def get_system():
         accelerator = 'ACCTEST'
     return (sys, accelerator)
 
+#Mask name to bit number, for each system.  The mask bits are the same for every edef
+#on a system, so the table is shared by every EventDefinition, and saved between runs.
+_bit_mask_names = {}
+
+def _mask_name_cache_path(sys):
+    return os.path.join(default_cache_dir(), "edef_masks_{sys}.json".format(sys=sys))
+
+def load_bit_mask_names(sys):
+    """Loads the saved table of mask bit names for a system.
+
+    Returns:
+        dict: Mask name to bit number, or None if there is no saved table, or it is older
+            than MASK_NAME_CACHE_TTL.
+    """
+    try:
+        with open(_mask_name_cache_path(sys)) as f:
+            saved = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if time.time() - saved.get('saved', 0) > MASK_NAME_CACHE_TTL:
+        return None
+    return {name: int(bit) for name, bit in saved['names'].items()}
+
+def save_bit_mask_names(sys, names):
+    """Saves a table of mask bit names (mask name to bit number) for a system."""
+    path = _mask_name_cache_path(sys)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        replace_file(path, lambda f: json.dump({'saved': time.time(), 'names': names}, f))
+    except (IOError, OSError) as e:
+        print("Could not save EDEF mask names: {}".format(e))
+
+class EdefNameWatcher(object):
+    """Monitors the NAME PV of every edef on a system, so reserving an edef can wait for
+    its name to show up instead of polling every slot.  Use name_watcher(sys) to get the
+    shared watcher for a system.
+    """
+    def __init__(self, sys):
+        self.sys = sys
+        self.names = {}
+        self._condition = threading.Condition()
+        self.pvs = [epics.PV("EDEF:{sys}:{num}:NAME".format(sys=sys, num=num), callback=partial(self._name_changed, num)) for num in range(1, NUM_EDEFS+1)]
+
+    def _name_changed(self, num, value=None, **kw):
+        with self._condition:
+            self.names[num] = value
+            self._condition.notify_all()
+
+    def find(self, name):
+        """Gets the number of the (lowest numbered) edef with this name, or None."""
+        with self._condition:
+            matches = [num for num, edef_name in self.names.items() if edef_name == name]
+        return min(matches) if len(matches) > 0 else None
+
+    def wait_for(self, name, timeout):
+        """Waits until an edef has this name, and returns its number, or None after timeout seconds."""
+        deadline = time.time() + timeout
+        with self._condition:
+            num = self.find(name)
+            while num is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+                num = self.find(name)
+            return num
+
+_name_watchers = {}
+
+def name_watcher(sys):
+    """Gets the shared EdefNameWatcher for a system."""
+    if sys not in _name_watchers:
+        _name_watchers[sys] = EdefNameWatcher(sys)
+    return _name_watchers[sys]
+
+class AcquisitionTimeout(Exception):
+    pass
+
+class Acquisition(object):
+    """A data acquisition started by EventDefinition.start_acquisition.
+    It completes when the edef's CTRL PV goes from on to off.  Works like a future:
+    wait for it with wait() or result(), or get called back with add_done_callback().
+    """
+    def __init__(self, edef):
+        self.edef = edef
+        self.started = False
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def _ctrl_changed(self, value):
+        if value == 0 and self.started:
+            self._finish()
+
+    def _put_done(self):
+        """Marks the acquisition as started, once the put to CTRL has completed.  CTRL
+        monitors from before then are left over from earlier (or from subscribing), so
+        they are ignored.  Monitors can't say when it started anyway: if the edef was
+        already running, the put doesn't change CTRL, so no monitor is posted."""
+        self.started = True
+
+    def _finish(self):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the acquisition to finish.
+        Returns:
+            bool: True if it finished, False if timeout seconds passed first.
+        """
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """Waits for the acquisition to finish, and returns the edef.
+        Raises AcquisitionTimeout if it doesn't finish within timeout seconds."""
+        if not self.wait(timeout):
+            raise AcquisitionTimeout("EDEF {num} did not finish acquiring within {t} seconds.".format(num=self.edef.edef_num, t=timeout))
+        return self.edef
+
+    def add_done_callback(self, callback):
+        """Calls callback(acquisition) when the acquisition finishes (from the CA callback
+        thread), or right away if it already has."""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
 """EventDefinition is a class that represents an event definition.
 Instantiate an EventDefinition to reserve an edef.  Configure it,
 then start data aquisition with the 'start' method."""
 class EventDefinition(object):
-    def __init__(self, name, user=None, avg=1, measurements=-1, inclusion_masks=None, exclusion_masks=None, avg_callback=None, measurements_callback=None, ctrl_callback=None):
+    def __init__(self, name, user=None, avg=1, measurements=-1, inclusion_masks=None, exclusion_masks=None, avg_callback=None, measurements_callback=None, ctrl_callback=None, reserve_timeout=5.0):
         (self.sys, self.accelerator) = get_system()
         self.ioc_location = self.sys
         if self.accelerator == 'LCLS':
             self.ioc_location = 'IN20'
-        self.edef_num = self.reserve_edef(name, self.sys, self.accelerator, user=user)
+        self.edef_num = self.reserve_edef(name, self.sys, self.accelerator, user=user, timeout=reserve_timeout)
         print("Reserved EDEF {}".format(self.edef_num))
         
         self.n_avg_pv = epics.PV("EDEF:{sys}:{num}:AVGCNT".format(sys=self.sys, num=self.edef_num))
@@ -70,6 +224,9 @@ class EventDefinition(object):
         self._ctrl_callback_index = None
         if ctrl_callback is not None:
             self.ctrl_callback = ctrl_callback
+        #Drives start_acquisition().  Kept separate from the user's ctrl_callback.
+        self._acquisition = None
+        self.ctrl_pv.add_callback(self._ctrl_changed)
         self.bit_mask_name_cache = {}
         self.bit_mask_reverse_cache = {}
         if inclusion_masks is not None:
@@ -77,19 +234,16 @@ class EventDefinition(object):
         if exclusion_masks is not None:
             self.exclusion_masks = exclusion_masks
 
-    def reserve_edef(self, name, sys, accelerator, user=None):
+    def reserve_edef(self, name, sys, accelerator, user=None, timeout=5.0):
+        """Reserves an edef, and returns its number.  Waits (for at most timeout seconds)
+        for the edef's name to show up on the monitored NAME PVs."""
+        watcher = name_watcher(sys)
         epics.caput("IOC:{iocloc}:EV01:EDEFNAME".format(iocloc=self.ioc_location), name, wait=True)
-        timeout = 5.0
-        time_elapsed = 0.0
-        while time_elapsed < timeout:
-            for num in range(1,16):
-                edef_name = epics.caget("EDEF:{sys}:{num}:NAME".format(sys=sys, num=num))
-                if edef_name == name:
-                    if user is not None:
-                        epics.caput("EDEF:{sys}:{num}:USERNAME".format(sys=sys, num=num), str(user))
-                    return num
-            time.sleep(0.05)
-            time_elapsed += 0.05
+        num = watcher.wait_for(name, timeout)
+        if num is not None:
+            if user is not None:
+                epics.caput("EDEF:{sys}:{num}:USERNAME".format(sys=sys, num=num), str(user))
+            return num
         #If you get this far, the edef wasn't reserved.
         #Check if there just aren't any EDEFs.
         edefs_remaining_pv = "IOC:{iocloc}:EV01:EDEFAVAIL".format(iocloc=self.ioc_location)
@@ -231,57 +385,112 @@ class EventDefinition(object):
         self.set_masks(excl_pv_template, masks)
     
     def get_masks(self, pv_template):
+        """Gets the names of the masks which are set, reading every mask bit in one bulk get."""
         if len(self.bit_mask_reverse_cache) == 0:
             self.populate_bit_mask_name_cache()
-        masks = []
-        for bit_num in range(1, NUM_MASK_BITS+1):
-            bit_val = epics.caget(pv_template.format(n=bit_num))
-            if bit_val == 1:
-                masks.append(self.bit_mask_reverse_cache[bit_num])
-        return masks
+        pvs = [pv_template.format(n=bit_num) for bit_num in range(1, NUM_MASK_BITS+1)]
+        values = default_pool().get(pvs)
+        if not values.ok:
+            raise Exception("Could not read EDEF masks: {}".format(values.failed))
+        bits = [bit_num for bit_num, pv in enumerate(pvs, start=1) if values[pv] == 1]
+        if any(bit_num not in self.bit_mask_reverse_cache for bit_num in bits):
+            #The saved table might be out of date.
+            self.populate_bit_mask_name_cache(refresh=True)
+        return [self.bit_mask_reverse_cache[bit_num] for bit_num in bits]
 
     def set_masks(self, pv_template, masks):
+        """Sets masks, either from a dictionary of mask name to value, or a list of
+        mask names to turn on.  Every bit is written at once, then the puts are
+        waited on together."""
         if len(self.bit_mask_name_cache) == 0:
             self.populate_bit_mask_name_cache()
         if isinstance(masks, dict):
-            for mask, val in masks.iteritems():
-                bit_num = self.bit_mask_name_cache[mask]
-                epics.caput(pv_template.format(n=bit_num), val, wait=True)
+            items = masks.items()
+        else:
+            items = [(mask, 1) for mask in masks]
+        items = list(items)
+        if any(mask not in self.bit_mask_name_cache for mask, val in items):
+            #The saved table might be out of date.
+            self.populate_bit_mask_name_cache(refresh=True)
+        unknown = [mask for mask, val in items if mask not in self.bit_mask_name_cache]
+        if len(unknown) > 0:
+            raise KeyError("Unknown EDEF mask names: {}".format(unknown))
+        values = OrderedDict()
+        for mask, val in items:
+            values[pv_template.format(n=self.bit_mask_name_cache[mask])] = val
+        result = default_pool().put(values, wait=True)
+        if not result.ok:
+            raise Exception("Could not set EDEF masks: {}".format(result.failed))
+
+    def populate_bit_mask_name_cache(self, refresh=False):
+        """Fills in the mask name to bit number tables.  The table for this edef's system
+        is re-used if another EventDefinition already has it, or it was saved by an
+        earlier run.  Otherwise (or if refresh is True), every bit's name is read in
+        one bulk get.  A table with names missing (because some reads failed) is only
+        used by this EventDefinition, never shared or saved."""
+        names = None
+        if not refresh:
+            names = _bit_mask_names.get(self.sys)
+            if names is None:
+                names = load_bit_mask_names(self.sys)
+        if names is None:
+            name_pv_template = ("EDEF:{sys}:{num}:".format(sys=self.sys, num=self.edef_num))+"INCM{n}.DESC"
+            pvs = {name_pv_template.format(n=bit_num): bit_num for bit_num in range(1, NUM_MASK_BITS+1)}
+            values = default_pool().get(list(pvs))
+            names = {values[pv]: bit_num for pv, bit_num in pvs.items() if values[pv] is not None}
+            if values.ok:
+                _bit_mask_names[self.sys] = names
+                save_bit_mask_names(self.sys, names)
         else:
-            for mask in masks:
-                bit_num = self.bit_mask_name_cache[mask]
-                epics.caput(pv_template.format(n=bit_num), 1, wait=True)
-
-    def populate_bit_mask_name_cache(self):
-        name_pv_template = ("EDEF:{sys}:{num}:".format(sys=self.sys, num=self.edef_num))+"INCM{n}.DESC"
-        chids = {}
-        for bit_num in range(1, NUM_MASK_BITS+1):
-            pv = (name_pv_template).format(n=bit_num)
-            chid = epics.ca.create_channel(pv, connect=False, auto_cb=False)
-            chids[pv] = (chid, bit_num)
-        for pv, chid in chids.iteritems():
-            epics.ca.connect_channel(chid[0])
-        epics.ca.poll()
-        for pv, chid in chids.iteritems():
-            epics.ca.get(chid[0], wait=False)
-        epics.ca.poll()
-        for pv, chid in chids.iteritems():
-            mask_name = epics.ca.get_complete(chid[0])
-            self.bit_mask_name_cache[mask_name] = chid[1]
-        self.bit_mask_reverse_cache = {num: name for name, num in self.bit_mask_name_cache.iteritems()}
-
-    def start(self):
+            _bit_mask_names[self.sys] = names
+        self.bit_mask_name_cache = names
+        self.bit_mask_reverse_cache = {num: name for name, num in names.items()}
+
+    def start(self, wait=False):
         """Starts data acquisition. 
         This is equivalent to clicking the 'On' button on the edef's EDM panel.
         Raises an exception if the edef was not properly reserved.
+        Args:
+            wait (Optional[bool]): Whether to wait for the put to CTRL to complete.
         Returns:
             bool: True if successful, False otherwise.  
         """ 
         if not self.is_reserved():
             raise Exception("EDEF was not reserved, cannot acquire data.")
             return False
-        self.ctrl_pv.put(1)
-        return True
+        result = self.ctrl_pv.put(1, wait=wait)
+        return result is not None and result > 0
+
+    def start_acquisition(self):
+        """Starts data acquisition, and returns an Acquisition which finishes when the
+        edef's CTRL PV goes back to off.  Use this instead of polling is_acquisition_complete.
+        Raises an exception if the edef was not properly reserved.
+
+        Returns:
+            Acquisition: The running acquisition.
+        """
+        acquisition = Acquisition(self)
+        self._acquisition = acquisition
+        try:
+            if not self.start(wait=True):
+                raise Exception("Could not start EDEF {num}.".format(num=self.edef_num))
+        except Exception:
+            self._acquisition = None
+            raise
+        acquisition._put_done()
+        #A short acquisition can finish before _put_done, with its CTRL monitor ignored,
+        #so read CTRL from the IOC (not the monitor) to check.
+        if self.ctrl_pv.get(use_monitor=False) == 0:
+            acquisition._finish()
+            self._acquisition = None
+        return acquisition
+
+    def _ctrl_changed(self, value=None, **kw):
+        acquisition = self._acquisition
+        if acquisition is not None:
+            acquisition._ctrl_changed(value)
+            if acquisition.done():
+                self._acquisition = None
 
     def is_acquisition_complete(self):
         """Checks if the edef is done collecting data.
@@ -303,21 +512,63 @@ class EventDefinition(object):
         return "{pv}{suffix}{num}".format(pv=pv, suffix=suffix, num=self.edef_num)
 
     def get_buffer(self, pv, suffix='HST'):
-        if isinstance(pv, (str, unicode)):
+        if isinstance(pv, string_types):
             buff = epics.caget(self.buffer_pv(pv=pv, suffix=suffix))
             if self.n_measurements > 0:
                 #If this isn't a rolling buffer, trim it to only include the collected data.
                 buff = buff[0:self.n_measurements]
             return buff
         else:
-            pv_list = [self.buffer_pv(pv=a_pv, suffix=suffix) for a_pv in pv]
-            suffix_length = len(suffix + str(self.edef_num))
-            buff_dict = batch_get(pv_list)
-            if self.n_measurements > 0:
-                buff_dict = {a_pv[:-suffix_length]: buff_dict[a_pv][0:self.n_measurements] for a_pv in buff_dict}
-            else:
-                buff_dict = {a_pv[:-suffix_length]: buff_dict[a_pv] for a_pv in buff_dict}
-            return buff_dict
+            return self.get_buffers(pv, suffixes=(suffix,))[suffix]
+
+    def get_buffers(self, pvs, suffixes=('HST', 'RMSHST'), timeout=None):
+        """Gets several kinds of buffer for a list of PVs, in a single bulk get.
+
+        Args:
+            pvs (list of str): BSA-capable PVs, without any BSA suffixes.
+            suffixes (Optional[tuple of str]): The buffers to get for each PV.
+            timeout (Optional[float]): How long to wait for the data, in seconds.
+        Returns:
+            dict: Suffix to a dictionary of PV to buffer.  Buffers which could not be
+                read are None.
+        """
+        n_meas = self.n_measurements
+        names = {}
+        for suffix in suffixes:
+            for a_pv in pvs:
+                names[self.buffer_pv(pv=a_pv, suffix=suffix)] = (suffix, a_pv)
+        values = default_pool().get(list(names), timeout=timeout)
+        buffers = {suffix: {} for suffix in suffixes}
+        for name, (suffix, a_pv) in names.items():
+            buff = values[name]
+            if buff is not None and n_meas > 0:
+                #If this isn't a rolling buffer, trim it to only include the collected data.
+                buff = buff[0:n_meas]
+            buffers[suffix][a_pv] = buff
+        return buffers
+
+    def capture(self, pvs, rms=True, timeout=None):
+        """Captures the data (and RMS) buffers for a list of PVs, along with the pulse ID
+        buffer, in one bulk get.
+
+        Args:
+            pvs (list of str): BSA-capable PVs, without any BSA suffixes.
+            rms (Optional[bool]): Whether to capture the RMS buffers too.
+            timeout (Optional[float]): How long to wait for the buffers, in seconds.
+        Returns:
+            BSACapture: The buffers as (shots x PVs) arrays, aligned by pulse ID.
+        """
+        return bsa_capture.capture(self, pvs, rms=rms, timeout=timeout)
+
+    def stream(self, pvs, **kwargs):
+        """Makes a BSAStream which follows new samples of pvs as this (rolling) edef
+        acquires them, instead of re-reading the whole buffer.  Keyword arguments are
+        passed on to BSAStream.  Call start() on it, or use it in a with statement.
+
+        Returns:
+            BSAStream: The (not yet started) stream.
+        """
+        return BSAStream(self, pvs, **kwargs)
 
     def get_data_buffer(self, pv):
         """Gets the collected data for an edef measurement (or the current value of the
@@ -361,11 +612,11 @@ class EventDefinition(object):
         Returns:
             The latest value of the pv.
         """
-        if isinstance(pv, (str, unicode)):
+        if isinstance(pv, string_types):
             return epics.caget("{pv}{num}".format(pv=pv, num=self.edef_num))
         else:
             pv_list = ["{a_pv}{num}".format(a_pv=a_pv, num=self.edef_num) for a_pv in pv]
-            values = batch_get(pv_list)
+            values = default_pool().get(pv_list)
             return {a_pv[:-len(str(self.edef_num))]: values[a_pv] for a_pv in values}
 
     def num_acquired(self):
@@ -395,3 +646,180 @@ class EventDefinition(object):
         if not self.is_reserved():
             raise Exception("EDEF was not reserved, cannot release.")
         epics.caput("EDEF:{sys}:{num}:FREE".format(sys=self.sys, num=self.edef_num), 1)
+        self.edef_num = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.is_reserved():
+            self.release()
+        return False
+
+def _mask_set(masks):
+    """The set of mask names turned on by a list or dictionary of masks."""
+    if masks is None:
+        return frozenset()
+    if isinstance(masks, dict):
+        return frozenset(name for name, val in masks.items() if val)
+    return frozenset(masks)
+
+class EdefLease(object):
+    """A lease on an edef from an EdefPool.  Use it as a context manager (which gives
+    you the EventDefinition), or call release() when you are done with it.
+    """
+    def __init__(self, pool, entry):
+        self.pool = pool
+        self.edef = entry.edef
+        self._entry = entry
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool._return(self._entry)
+
+    def __enter__(self):
+        return self.edef
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+class _PoolEntry(object):
+    def __init__(self, edef, config):
+        self.edef = edef
+        self.config = config
+        self.leases = 0
+        self.exclusive = False
+
+class EdefPool(object):
+    """Shares edefs between everything in a process that needs one.
+
+    A lease on an edef with the same averaging, number of measurements and masks as
+    an edef already in the pool re-uses it (unless either lease is exclusive), so
+    several displays can share one acquisition.  Edefs nobody is leasing are kept
+    (up to max_idle of them) and reconfigured for the next lease instead of being
+    released and reserved again.  Every edef in the pool is released when the
+    process exits.  Use default_edef_pool() to get the process-wide pool.
+
+    Args:
+        name (Optional[str]): The start of the name of every edef the pool reserves.
+        user (Optional[str]): The user name to reserve edefs with.
+        max_idle (Optional[int]): How many edefs to keep reserved while nobody is leasing them.
+    """
+    def __init__(self, name="SIMUI", user=None, max_idle=1):
+        self.name = name
+        self.user = user
+        self.max_idle = max_idle
+        self._entries = []
+        self._reservations = 0
+        self._lock = threading.RLock()
+        atexit.register(self.release_all)
+
+    def lease(self, avg=1, measurements=-1, inclusion_masks=None, exclusion_masks=None, exclusive=False):
+        """Leases an edef configured with these settings.  If exclusive is True, the edef
+        won't be shared with any other lease while this one is held (use this if you are
+        going to change its settings).
+
+        Returns:
+            EdefLease: The lease.
+        """
+        config = (avg, measurements, _mask_set(inclusion_masks), _mask_set(exclusion_masks))
+        with self._lock:
+            entry = None
+            if not exclusive:
+                matches = [e for e in self._entries if e.config == config and not e.exclusive]
+                entry = matches[0] if len(matches) > 0 else None
+            if entry is None:
+                idle = [e for e in self._entries if e.leases == 0]
+                if len(idle) > 0:
+                    entry = idle[0]
+                    self._configure(entry, config)
+                else:
+                    entry = self._reserve(config)
+            entry.leases += 1
+            entry.exclusive = exclusive
+            return EdefLease(self, entry)
+
+    def _reserve(self, config):
+        (avg, measurements, inclusion_masks, exclusion_masks) = config
+        self._reservations += 1
+        #Every reservation needs a unique name, that's how the reserved edef is found.
+        name = "{name} {pid}.{n}".format(name=self.name, pid=os.getpid(), n=self._reservations)
+        edef = EventDefinition(name, user=self.user, avg=avg, measurements=measurements,
+                               inclusion_masks=list(inclusion_masks) or None, exclusion_masks=list(exclusion_masks) or None)
+        entry = _PoolEntry(edef, config)
+        self._entries.append(entry)
+        return entry
+
+    def _configure(self, entry, config):
+        (avg, measurements, inclusion_masks, exclusion_masks) = config
+        edef = entry.edef
+        if entry.config is None:
+            #Whoever had it last may have changed anything, so check what the masks really are.
+            entry.config = (None, None, frozenset(edef.inclusion_masks), frozenset(edef.exclusion_masks))
+        (old_avg, old_measurements, old_inclusion_masks, old_exclusion_masks) = entry.config
+        edef.n_avg = avg
+        edef.n_measurements = measurements
+        #Turn off any masks from the old configuration, and turn on the new ones.
+        if inclusion_masks != old_inclusion_masks:
+            masks = {mask: 0 for mask in old_inclusion_masks - inclusion_masks}
+            masks.update({mask: 1 for mask in inclusion_masks})
+            edef.inclusion_masks = masks
+        if exclusion_masks != old_exclusion_masks:
+            masks = {mask: 0 for mask in old_exclusion_masks - exclusion_masks}
+            masks.update({mask: 1 for mask in exclusion_masks})
+            edef.exclusion_masks = masks
+        entry.config = config
+
+    def _return(self, entry):
+        with self._lock:
+            entry.leases -= 1
+            if entry.leases > 0:
+                return
+            if entry.exclusive:
+                #An exclusive lease may have changed the settings.
+                entry.config = None
+                entry.exclusive = False
+            idle = [e for e in self._entries if e.leases == 0]
+            if len(idle) > self.max_idle:
+                self._entries.remove(entry)
+                entry.edef.release()
+
+    def release_all(self):
+        """Releases every edef in the pool, leased or not."""
+        with self._lock:
+            for entry in self._entries:
+                if entry.edef.is_reserved():
+                    try:
+                        entry.edef.release()
+                    except Exception as e:
+                        print("Could not release EDEF: {}".format(e))
+            self._entries = []
+
+    def occupancy(self):
+        """Reports how the pool is being used.
+
+        Returns:
+            dict: 'reserved' (edefs held by this pool), 'leased' (edefs with at least one
+                lease), 'idle' (edefs held for re-use), 'leases' (the total number of
+                leases), and 'available' (free edefs left on the system, or None if that
+                couldn't be read).
+        """
+        with self._lock:
+            leased = [e for e in self._entries if e.leases > 0]
+            occupancy = {'reserved': len(self._entries), 'leased': len(leased), 'idle': len(self._entries) - len(leased), 'leases': sum(e.leases for e in leased)}
+        (sys, accelerator) = get_system()
+        ioc_location = 'IN20' if accelerator == 'LCLS' else sys
+        occupancy['available'] = epics.caget("IOC:{iocloc}:EV01:EDEFAVAIL".format(iocloc=ioc_location))
+        return occupancy
+
+_default_edef_pool = None
+
+def default_edef_pool():
+    """Gets the process-wide EdefPool."""
+    global _default_edef_pool
+    if _default_edef_pool is None:
+        _default_edef_pool = EdefPool()
+    return _default_edef_pool
@@ -1,6 +1,107 @@
 import numpy as np
-"""least_squares.py performs least-squares fitting."""
+"""least_squares.py performs least-squares fitting.
+
+The fit is done with a QR factorization of the (weighted) design matrix, which is
+more numerically stable than inverting the normal matrix.  A LeastSquares object
+holds the factorization, so it can be re-used to fit any number of data sets with
+the same design matrix and weights."""
+
+class LeastSquares(object):
+	"""The factorized least-squares problem for a design matrix Q and uncertainties sig.
+
+	Args:
+		Q (array): An N x n design matrix.
+		sig (Optional): The uncertainty for each of the N data points, or a single
+			uncertainty for all of them.  If None, every point has an uncertainty of 1,
+			and the results from solve() are renormalized by the goodness of fit.
+	"""
+	def __init__(self, Q, sig=None):
+		self.renorm = False
+		if sig is None:
+			sig = 1
+			self.renorm = True
+		Q = np.asarray(Q, dtype=float)
+		if Q.ndim == 1:
+			Q = Q.reshape(-1, 1)
+		N, n = np.shape(Q)
+		if n > N:
+			raise ValueError("Not enough data points to fit the curve.")
+		sig = np.asarray(sig, dtype=float).reshape(-1)
+		if len(sig) == 1:
+			sig = sig[0] * np.ones(N)
+		elif len(sig) != N:
+			raise ValueError("len(sig) must be equal to number of data points.")
+		self.Q = Q
+		self.sig = sig
+		self.NDF = N - n
+		if n == N:
+			self.NDF = 1
+		(q, r) = np.linalg.qr(Q / sig[:, np.newaxis])
+		#Rounding keeps r's diagonal from being exactly zero for a rank-deficient Q (two
+		#identical columns, say), so use the same tolerance as numpy.linalg.matrix_rank.
+		diag = np.abs(np.diag(r))
+		if np.any(diag <= diag.max() * max(N, n) * np.finfo(float).eps):
+			raise np.linalg.LinAlgError("Singular matrix")
+		r_inv = np.linalg.inv(r)
+		#t maps the data onto the fit parameters: R = t*s.
+		self.t = np.dot(r_inv, q.T) / sig
+		#V = (Q^T W Q)^-1 = r^-1 r^-T
+		self.V = np.dot(r_inv, r_inv.T)
+		self.dR = np.sqrt(np.diag(self.V))
+		#dy_i^2 = sum_j (Q*t)_ij^2 sig_j^2, which is the squared norm of row i of Q*r^-1.
+		#Computing it that way avoids building any N x N matrices.
+		self.dy = np.sqrt(np.sum(np.dot(Q, r_inv)**2.0, axis=1))
+
+	def solve(self, s):
+		"""Fit one or more data sets.
+
+		Args:
+			s (array): The data, either a vector of length N, or an N x K array
+				holding K data sets (for example, K shots) as columns.
+		Returns:
+			A tuple (y, dy, R, dR, chisq, V).  y is the fitted data, R the fitted
+			parameters, and dy and dR their errors.  chisq is the reduced chi-squared
+			(or 1 for an unweighted fit, where the errors are scaled by it instead).
+			For K data sets, y and R have K columns, and chisq has K entries.  In
+			an unweighted fit, dy and dR then also have K columns and V gets a
+			leading axis of length K.
+		"""
+		s = np.asarray(s, dtype=float)
+		R = np.dot(self.t, s)
+		y = np.dot(self.Q, R)
+		sig = self.sig if s.ndim == 1 else self.sig[:, np.newaxis]
+		chi = (s - y) / sig
+		chisq = np.sum(chi**2.0, axis=0) / self.NDF
+		if not self.renorm:
+			return (y, self.dy, R, self.dR, chisq, self.V)
+		scale = np.sqrt(chisq)
+		if s.ndim == 1:
+			return (y, self.dy*scale, R, self.dR*scale, 1, self.V*chisq)
+		dy = self.dy[:, np.newaxis]*scale
+		dR = self.dR[:, np.newaxis]*scale
+		V = self.V[np.newaxis, :, :]*chisq[:, np.newaxis, np.newaxis]
+		return (y, dy, R, dR, 1, V)
+
 def fit(Q, s, sig=None):
+	"""Least-squares fit of data s to the model y = Q*R.
+
+	s can be a vector of length N, or an N x K array of K data sets, which
+	are all fit in one call.  See LeastSquares.solve for the return values."""
+	s = np.asarray(s, dtype=float)
+	#Keep supporting data passed as an N x 1 column.
+	column = s.ndim == 2 and s.shape[1] == 1
+	if column:
+		s = s[:, 0]
+	(y, dy, R, dR, chisq, V) = LeastSquares(Q, sig).solve(s)
+	if column:
+		y = y.reshape(-1, 1)
+		R = R.reshape(-1, 1)
+		dy = np.asarray(dy).reshape(-1, 1)
+	return (y, dy, R, dR, chisq, V)
+
+def fit_normal_equations(Q, s, sig=None):
+	"""The original implementation of fit(), which inverts the normal matrix.
+	It is kept as a reference to check fit() against."""
 	renorm = False
 	if sig is None:
 		sig = 1
@@ -24,20 +125,20 @@ def fit(Q, s, sig=None):
 	sig2 = np.asarray(sig) ** 2.0
 	e = sig2 ** -1
 	E = e*np.ones((1,n))
-	G = np.mat(np.array(Q)*np.array(E))
+	G = np.asmatrix(np.array(Q)*np.array(E))
 	NDF = N - n
 	if n == N:
 		NDF = 1
-	
-	V = np.linalg.inv(np.mat(Q).transpose() * G)
+
+	V = np.linalg.inv(np.asmatrix(Q).transpose() * G)
 	t = V*G.transpose()
 	dR = np.sqrt(np.diag(V))
-	T = np.mat(Q)*t
-	dy2 = np.mat(np.asarray(T)**2)*sig2
+	T = np.asmatrix(Q)*t
+	dy2 = np.asmatrix(np.asarray(T)**2)*sig2
 	dy = np.sqrt(np.asarray(dy2))
-	R = np.mat(t)*np.mat(s)
+	R = np.asmatrix(t)*np.asmatrix(s)
 	y = Q*R
-	chi = np.mat((np.mat(s) - np.mat(y))/sig)
+	chi = np.asmatrix((np.asmatrix(s) - np.asmatrix(y))/sig)
 	chisq = (chi.transpose()*chi)/NDF
 
 	if renorm:
@@ -52,6 +153,6 @@ def fit(Q, s, sig=None):
 if __name__ == '__main__':
 	#if this file is run directly from the command line it runs a test fit.
 	x = np.array([0.0, 1.0, 2.0, 3.0, 4.0, 5.0]).transpose()
-	Q = np.array([x, np.ones((len(x),1))]).transpose()
+	Q = np.array([x, np.ones(len(x))]).transpose()
 	s = np.array([0.0, 1.1, 1.8, 3.3, 3.9, 5.1]).transpose()
 	print(fit(Q,s))
@@ -5,8 +5,121 @@ try:
 	PVACCESS_AVAILABLE = True
 except ImportError:
 	pass
-from itertools import cycle
 from collections import OrderedDict
+import time
+from . import model_cache
+from . import perf
+
+class MachineModel(object):
+	"""A machine model (the structured array returned by get_full_machine_model),
+	with a hash index from (device name, position index) to row.  The index is built
+	once, so bulk lookups are a dictionary lookup per device and one fancy-indexing
+	operation, instead of a scan of the whole model per device."""
+	def __init__(self, model_array):
+		self.data = model_array
+		self._rows = {}
+		self._first_rows = {}
+		for (i, (name, pos)) in enumerate(zip(model_array['epics_channel_access_name'], model_array['position_index'])):
+			name = _to_str(name).strip()
+			pos = _to_str(pos).strip()
+			self._rows.setdefault((name, pos), i)
+			self._first_rows.setdefault(name, i)
+
+	def __len__(self):
+		return len(self.data)
+
+	def __contains__(self, device):
+		return device in self._first_rows
+
+	def rows(self, device_list, pos='MIDDLE'):
+		"""Get the row in the model for each device.  If a device has entries for
+		several positions, the entry for pos is used.
+
+		Returns:
+			A tuple (rows, missing): the row for each device, and a boolean mask of the
+			devices which aren't in the model.  The rows of missing devices are
+			meaningless, so only use rows[~missing] to index the model."""
+		rows = np.zeros(len(device_list), dtype=int)
+		missing = np.zeros(len(device_list), dtype=bool)
+		for (i, dev) in enumerate(device_list):
+			row = self._rows.get((dev, pos))
+			if row is None:
+				row = self._first_rows.get(dev)
+			if row is None:
+				missing[i] = True
+			else:
+				rows[i] = row
+		return (rows, missing)
+
+	def _lookup(self, device_list, pos, ignore_bad_names, msg):
+		(rows, missing) = self.rows(device_list, pos)
+		for i in np.where(missing)[0]:
+			error = msg.format(name=device_list[i])
+			if not ignore_bad_names:
+				raise IndexError(error)
+			print(error)
+		return (rows, missing)
+
+	def r_mats(self, device_list, pos='MIDDLE', ignore_bad_names=False):
+		"""Get the R matrix for each device, as an Nx6x6 array.  Missing devices get NaNs
+		if ignore_bad_names is True, otherwise an IndexError is raised."""
+		(rows, missing) = self._lookup(device_list, pos, ignore_bad_names, "BPM with name {name} not found in the machine model.")
+		mats = np.full((len(rows), 6, 6), np.nan)
+		mats[~missing] = self.data['r_mat'][rows[~missing]]
+		return mats
+
+	def z_positions(self, device_list, pos='MIDDLE', ignore_bad_names=False):
+		"""Get the Z position of each device.  Missing devices get NaN if
+		ignore_bad_names is True, otherwise an IndexError is raised."""
+		(rows, missing) = self._lookup(device_list, pos, ignore_bad_names, "BPM with name {name} not found in the machine model, could not get Z position.")
+		z_pos = np.full(len(rows), np.nan)
+		z_pos[~missing] = self.data['z_position'][rows[~missing]]
+		return z_pos
+
+	def relative_r_mats(self, from_device, to_device, from_pos='MIDDLE', to_pos='MIDDLE', ignore_bad_names=False):
+		"""Get the R matrix from each device in from_device to the matching device in to_device.
+		Either list may have a single entry, which is then paired with every entry in the other.
+
+		The relative matrix B*inv(A) is computed as the solution X of X*A = B, with one
+		batched call to numpy.linalg.solve."""
+		a_mats = self.r_mats(from_device, from_pos, ignore_bad_names)
+		b_mats = self.r_mats(to_device, to_pos, ignore_bad_names)
+		(a_mats, b_mats) = np.broadcast_arrays(a_mats, b_mats)
+		if len(a_mats) == 0:
+			return np.zeros((0, 6, 6))
+		#X*A = B is the same as A^T*X^T = B^T.
+		return np.swapaxes(np.linalg.solve(np.swapaxes(a_mats, 1, 2), np.swapaxes(b_mats, 1, 2)), 1, 2)
+
+def _to_str(s):
+	if isinstance(s, bytes):
+		return s.decode('utf-8')
+	return str(s)
+
+_machine_models = {}
+_last_wrapped = (None, None)
+
+def get_machine_model(use_design=False, refresh=False):
+	"""Get a MachineModel for the extant (or design) model.
+	The model is re-used until refresh is True, or until it is older than the model
+	cache's TTL, when it is reloaded from the on-disk cache (which re-checks the source)."""
+	cached = _machine_models.get(use_design)
+	if refresh or cached is None or (time.time() - cached[1]) >= model_cache.default_cache().ttl:
+		if refresh:
+			model_cache.default_cache().invalidate(_cache_key(use_design))
+		cached = (MachineModel(get_full_machine_model(use_design)), time.time())
+		_machine_models[use_design] = cached
+	return cached[0]
+
+def _as_machine_model(full_model, use_design=False):
+	global _last_wrapped
+	if full_model is None:
+		return get_machine_model(use_design)
+	if isinstance(full_model, MachineModel):
+		return full_model
+	#Wrapping a raw model array builds an index, so remember the most recent one.
+	if _last_wrapped[0] is not full_model:
+		_last_wrapped = (full_model, MachineModel(full_model))
+	return _last_wrapped[1]
 
 def get_rmat(from_device, to_device=[], use_design=False, from_pos='MIDDLE', to_pos='MIDDLE', full_model=None, ignore_bad_names=False):
 	if isinstance(from_device, str):
@@ -18,69 +131,43 @@ def get_rmat(from_device, to_device=[], use_design=False, from_pos='MIDDLE', to_
 	if len(to_device) == 0:
 		to_device = list(from_device)
 		from_device = ['CATH:IN20:111']
-	if full_model is None:
-		full_model = get_full_machine_model(use_design)
-	device_list = zip(from_device, cycle(to_device)) if len(from_device) > len(to_device) else zip(cycle(from_device), to_device)
-	rmats = np.zeros((len(device_list),6,6))
-	i = 0
-	for dev_pair in device_list:
-		a, b = dev_pair
-		a_index = np.where(full_model['epics_channel_access_name'] == a)
-		if len(a_index[0]) > 1:
-			a_index = a_index & (full_model['position_index'] == from_pos)
-		b_index = np.where(full_model['epics_channel_access_name'] == b)
-		if len(b_index[0]) > 1:
-			b_index = b_index & (full_model['position_index'] == to_pos)
-		try:
-			a_mat = np.mat(full_model[a_index][0]['r_mat'])
-		except IndexError:
-			msg = "BPM with name {name} not found in the machine model.".format(name=a)
-			if ignore_bad_names:
-				print(msg)
-				continue
-			else:
-				raise IndexError(msg)
-		try:
-			b_mat = np.mat(full_model[b_index][0]['r_mat'])
-		except IndexError:
-			msg = "BPM with name {name} not found in the machine model.".format(name=b)
-			if ignore_bad_names:
-				print(msg)
-				continue
-			else:
-				raise IndexError(msg)
-		rmats[i] = b_mat * np.linalg.inv(a_mat)
-		i += 1
-	if i == 1:
+	machine_model = _as_machine_model(full_model, use_design)
+	rmats = machine_model.relative_r_mats(from_device, to_device, from_pos=from_pos, to_pos=to_pos, ignore_bad_names=ignore_bad_names)
+	if len(rmats) == 1:
 		return rmats[0]
 	return rmats
 
 def get_zpos(device_list, pos='MIDDLE', full_model=None, ignore_bad_names=False):
 	if isinstance(device_list, str):
 		device_list = [device_list]
-	if full_model is None:
-		full_model = get_full_machine_model()
-	z_pos = np.zeros((len(device_list)))
-	i = 0
-	for dev in device_list:
-		dev_index = np.where(full_model['epics_channel_access_name'] == dev)
-		if len(dev_index[0]) > 1:
-			dev_index = dev_index & (full_model['position_index'] == pos)
-		if len(dev_index[0]) > 0:
-			z_pos[i] = full_model[dev_index][0]['z_position']
-		else:
-			msg = "BPM with name {name} not found in the machine model, could not get Z position.".format(name=dev)
-			if ignore_bad_names:
-				print(msg)
-				z_pos[i] = None
-			else:
-				raise IndexError(msg)
-		i += 1
-	if i == 1:
+	machine_model = _as_machine_model(full_model)
+	z_pos = machine_model.z_positions(device_list, pos=pos, ignore_bad_names=ignore_bad_names)
+	if len(z_pos) == 1:
 		return z_pos[0]
 	return z_pos
 
-def get_full_machine_model(use_design=False):
+def _cache_key(use_design):
+	return "rmats-{}".format("DESIGN" if use_design else "EXTANT")
+
+@perf.timed('model.get_full_machine_model')
+def get_full_machine_model(use_design=False, use_cache=True, cache=None):
+	"""Get the full machine model as a structured array.
+
+	The parsed model is kept in an on-disk cache (see utilities.model_cache), so
+	it is only fetched over RPC when the cached copy is older than the cache's TTL.
+	Pass use_cache=False to always fetch it, or a ModelCache as cache to use a
+	different cache than the default one."""
+	if not use_cache:
+		return fetch_full_machine_model(use_design)
+	if cache is None:
+		cache = model_cache.default_cache()
+	#The model service has no cheap way to ask when the model last changed, so
+	#only the TTL decides when to fetch it again.
+	return cache.get(_cache_key(use_design), lambda: (fetch_full_machine_model(use_design), time.time()))
+
+@perf.timed('model.fetch_full_machine_model')
+def fetch_full_machine_model(use_design=False):
+	"""Fetch the full machine model from the model service, bypassing the cache."""
 	if not PVACCESS_AVAILABLE:
 		raise NoPVAccessException
 	request = pvaccess.PvObject(OrderedDict([('scheme', pvaccess.STRING), ('path', pvaccess.STRING)]), 'epics:nt/NTURI:1.0')
@@ -91,13 +178,13 @@ def get_full_machine_model(use_design=False):
 	rpc = pvaccess.RpcClient(path)
 	request.set(OrderedDict([('scheme', 'pva'), ('path', path)]))
 	response = rpc.invoke(request).getStructure()
-	m = np.zeros(len(response['ELEMENT_NAME']), dtype=[('ordinal', 'i16'),('element_name', 'a60'), ('epics_channel_access_name', 'a60'), ('position_index', 'a6'), ('z_position', 'float32'), ('r_mat', 'float32', (6,6))])
+	m = np.zeros(len(response['ELEMENT_NAME']), dtype=[('ordinal', 'int32'),('element_name', 'a60'), ('epics_channel_access_name', 'a60'), ('position_index', 'a6'), ('z_position', 'float32'), ('r_mat', 'float32', (6,6))])
 	m['ordinal'] = response['ORDINAL']
 	m['element_name'] = response['ELEMENT_NAME']
 	m['epics_channel_access_name'] = response['EPICS_CHANNEL_ACCESS_NAME']
 	m['position_index'] = response['POSITION_INDEX']
 	m['z_position'] = response['Z_POSITION']
-	m['r_mat'] = np.reshape(np.array([response['R11'], response['R12'], response['R13'], response['R14'], response['R15'], response['R16'], response['R21'], response['R22'], response['R23'], response['R24'], response['R25'], response['R26'], response['R31'], response['R32'], response['R33'], response['R34'], response['R35'], response['R36'], response['R41'], response['R42'], response['R43'], response['R44'], response['R45'], response['R46'], response['R51'], response['R52'], response['R53'], response['R54'], response['R55'], response['R56'], response['R61'], response['R62'], response['R63'], response['R64'], response['R65'], response['R66']]).T, (-1,6,6))
+	m['r_mat'] = np.reshape(np.array([response['R{}{}'.format(i, j)] for i in range(1, 7) for j in range(1, 7)]).T, (-1,6,6))
 	return m
 
 
@@ -105,7 +192,7 @@ class NoPVAccessException(Exception):
 	pass
 
 if __name__ == '__main__':
-	rmats = get_r_matrix('BPMS:LI23:201',['BPMS:LI23:301','BPMS:LI23:401'])
+	rmats = get_rmat('BPMS:LI23:201',['BPMS:LI23:301','BPMS:LI23:401'])
 	print(rmats)
-	rmat = get_r_matrix('BPMS:LI24:801')
+	rmat = get_rmat('BPMS:LI24:801')
 	print(rmat)
@@ -0,0 +1,169 @@
+"""model_cache.py - A persistent on-disk cache for parsed machine model tables.
+
+Parsed tables are stored as .npy files (which can be memory-mapped), with a small
+JSON file alongside each one recording the cache format version, the model's source
+timestamp, and when it was saved.  An entry younger than the TTL is used without
+contacting the control system at all.  An older entry is still used if a cheap
+timestamp check says the source hasn't changed.
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+CACHE_VERSION = 1
+DEFAULT_TTL = 3600.0
+
+def default_cache_dir():
+    """The cache directory.  Set the SIMUI_CACHE_DIR environment variable to override it."""
+    cache_dir = os.getenv('SIMUI_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    return os.path.join(os.path.expanduser('~'), '.cache', 'simui')
+
+def replace_file(path, write, mode='w'):
+    """Write a file with write(f) under a temporary name unique to this process and
+    thread, then rename it into place, so processes (or threads) saving the same file
+    at once never write to the same file.
+
+    Args:
+        path (str): The file to write.
+        write (callable): Called with the open temporary file.
+        mode (Optional[str]): The mode to open the temporary file with, 'w' or 'wb'.
+    """
+    tmp_path = "{path}.{pid}-{thread}.tmp".format(path=path, pid=os.getpid(), thread=threading.current_thread().ident)
+    try:
+        with open(tmp_path, mode) as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class ModelCache(object):
+    """An on-disk cache of numpy arrays, keyed by name (for example 'rmats-EXTANT').
+
+    Args:
+        cache_dir (Optional[str]): Where to keep the cache files.  Defaults to default_cache_dir().
+        ttl (Optional[float]): How long, in seconds, an entry is used without checking the source.
+        mmap (Optional[bool]): Whether to memory-map cached arrays instead of reading them in.
+    """
+    def __init__(self, cache_dir=None, ttl=DEFAULT_TTL, mmap=True):
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+        self.ttl = ttl
+        self.mmap = mmap
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return (base + '.npy', base + '.json')
+
+    def _read_meta(self, key):
+        (data_path, meta_path) = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('version') != CACHE_VERSION or not os.path.exists(data_path):
+            return None
+        return meta
+
+    def _write_meta(self, key, meta):
+        (data_path, meta_path) = self._paths(key)
+        replace_file(meta_path, lambda f: json.dump(meta, f))
+
+    def load(self, key):
+        """Load a cached array, ignoring its age.  Returns None if there isn't one."""
+        if self._read_meta(key) is None:
+            return None
+        (data_path, meta_path) = self._paths(key)
+        try:
+            return np.load(data_path, mmap_mode='r' if self.mmap else None)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, key, array, source_timestamp=None):
+        """Save an array to the cache."""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        (data_path, meta_path) = self._paths(key)
+        replace_file(data_path, lambda f: np.save(f, array), 'wb')
+        self._write_meta(key, {'version': CACHE_VERSION, 'source_timestamp': source_timestamp, 'saved': time.time()})
+
+    def invalidate(self, key=None):
+        """Remove an entry from the cache, or every entry if key is None."""
+        if key is None:
+            if not os.path.isdir(self.cache_dir):
+                return
+            keys = [filename[:-len('.json')] for filename in os.listdir(self.cache_dir) if filename.endswith('.json')]
+        else:
+            keys = [key]
+        for k in keys:
+            for path in self._paths(k):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get(self, key, fetch, timestamp=None):
+        """Get an array from the cache, fetching it from the source if needed.
+
+        Args:
+            key (str): The cache key.
+            fetch (callable): Called with no arguments to fetch the data from the source.
+                Must return a tuple (array, source_timestamp).  source_timestamp may be None.
+            timestamp (Optional[callable]): Called with no arguments to cheaply get the
+                source's current timestamp, when an entry is older than the TTL.  If it
+                matches the cached entry's timestamp, the entry is used and its age reset.
+        Returns:
+            numpy.ndarray: The cached or freshly fetched array.
+        """
+        meta = self._read_meta(key)
+        if meta is not None:
+            fresh = (time.time() - meta['saved']) < self.ttl
+            if not fresh and timestamp is not None and meta['source_timestamp'] is not None:
+                try:
+                    fresh = timestamp() == meta['source_timestamp']
+                except Exception:
+                    fresh = False
+                if fresh:
+                    meta['saved'] = time.time()
+                    try:
+                        self._write_meta(key, meta)
+                    except (IOError, OSError) as e:
+                        #The entry is still good, it will just be checked again next time.
+                        print("Could not update {key} in the model cache: {e}".format(key=key, e=e))
+            if fresh:
+                array = self.load(key)
+                if array is not None:
+                    self.hits += 1
+                    return array
+        self.misses += 1
+        (array, source_timestamp) = fetch()
+        try:
+            self.store(key, array, source_timestamp)
+        except (IOError, OSError) as e:
+            #A read-only or full disk shouldn't stop anyone from getting the model.
+            print("Could not save {key} to the model cache: {e}".format(key=key, e=e))
+        return array
+
+_default_cache = None
+
+def default_cache():
+    """Get the process-wide ModelCache."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ModelCache()
+    return _default_cache
+
+def set_default_cache(cache):
+    """Replace the process-wide ModelCache (for example, with one in a temporary directory)."""
+    global _default_cache
+    _default_cache = cache
@@ -1,72 +1,147 @@
 from p4p.client.thread import Context
 from p4p.nt import NTTable
+import os
+import json
+from collections import OrderedDict
 import numpy as np
+from . import model_cache
+from . import perf
 
 c = Context('pva')
 
+TWISS_PV = "BMAD:SYS0:1:FULL_MACHINE:DESIGN:TWISS"
+TWISS_CACHE_KEY = "twiss-DESIGN"
+
 def pv_table():
-    return c.get("BMAD:SYS0:1:FULL_MACHINE:DESIGN:TWISS")
+    return c.get(TWISS_PV)
+
+def table_timestamp():
+    """Get the timestamp of the TWISS table, without fetching the table itself."""
+    stamp = c.get(TWISS_PV, request="field(timeStamp)").timeStamp
+    return stamp.secondsPastEpoch + 1e-9*stamp.nanoseconds
+
+@perf.timed('model_list.fetch_table')
+def fetch_table():
+    """Fetch and parse the TWISS table, bypassing the cache.
+    Returns a tuple (table, source timestamp)."""
+    value = pv_table()
+    try:
+        stamp = value.timeStamp.secondsPastEpoch + 1e-9*value.timeStamp.nanoseconds
+    except AttributeError:
+        stamp = None
+    return (unwrap_to_np(value), stamp)
+
+@perf.timed('model_list.twiss_table')
+def twiss_table(use_cache=True, cache=None):
+    """Get the TWISS table as a structured array.  The parsed table is kept in the
+    on-disk model cache, and is only fetched again if it is older than the cache's TTL
+    and the table's timestamp has changed."""
+    if not use_cache:
+        return fetch_table()[0]
+    if cache is None:
+        cache = model_cache.default_cache()
+    return cache.get(TWISS_CACHE_KEY, fetch_table, timestamp=table_timestamp)
+
+class ModelTable(object):
+    """The TWISS table, with an index from element name to row, so that sector
+    slices and device lists can be handed out without searching the table.
+
+    Slices are views of the table (no data is copied), and device lists are
+    computed once per (prefix, start, end) and then re-used.
+
+    Args:
+        table (numpy.ndarray): The structured array returned by twiss_table().
+        sectors (Optional[list]): Sector definitions (dicts with name, start_marker and
+            end_marker).  Defaults to the contents of sectors.json.
+    """
+    def __init__(self, table, sectors=None):
+        self.table = table
+        (elements, first_rows) = np.unique(table['element'], return_index=True)
+        self._element_index = dict(zip(elements.tolist(), first_rows.tolist()))
+        if sectors is None:
+            with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'sectors.json')) as f:
+                sectors = json.load(f)
+        self.sectors = OrderedDict()
+        for sector in sectors:
+            self.sectors[sector['name']] = (sector['start_marker'], sector['end_marker'])
+        self._device_lists = {}
+        self._device_index = None
+
+    def index(self, element):
+        """Get the first row for an element, or None if it isn't in the table."""
+        return self._element_index.get(element.upper())
+
+    def device_values(self, field, device_names):
+        """Get the value of a column (for example 'p0c') for each device in device_names,
+        from the device's first row.  Devices which aren't in the table get NaN."""
+        if self._device_index is None:
+            (devices, first_rows) = np.unique(self.table['device_name'], return_index=True)
+            self._device_index = dict(zip(devices.tolist(), first_rows.tolist()))
+        rows = np.array([self._device_index.get(name, -1) for name in device_names], dtype=int)
+        values = self.table[field][rows].astype(float)
+        values[rows < 0] = np.nan
+        return values
+
+    def bounds(self, start_element=None, end_element=None):
+        """Get the (start, end) slice bounds used by model_list()."""
+        start_index = 0
+        if start_element:
+            start_index = self.index(start_element)
+            if start_index is None:
+                raise ValueError("Start element not found in table.")
+        end_index = -1
+        if end_element:
+            end_index = self.index(end_element)
+            if end_index is None:
+                raise ValueError("End element not found in table.")
+        return (start_index, end_index)
+
+    def slice(self, start_element=None, end_element=None):
+        """Get the rows from start_element up to (but not including) end_element, as a view."""
+        (start_index, end_index) = self.bounds(start_element, end_element)
+        return self.table[start_index:end_index]
+
+    def sector(self, name):
+        """Get the rows for a sector in sectors.json, as a view."""
+        return self.slice(*self.sectors[name])
+
+    def devices(self, prefix, start_element=None, end_element=None, unique=True):
+        """Get the names of devices starting with prefix (for example 'BPM', 'KLYS' or
+        'QUAD') between start_element and end_element, in beamline order.  If unique is
+        True, devices which appear more than once (split elements) are only listed once."""
+        key = (prefix, start_element, end_element, unique)
+        try:
+            return list(self._device_lists[key])
+        except KeyError:
+            pass
+        names = self.slice(start_element, end_element)['device_name']
+        names = names[np.char.startswith(names, prefix)]
+        if unique:
+            (_, first) = np.unique(names, return_index=True)
+            names = names[np.sort(first)]
+        self._device_lists[key] = tuple(names.tolist())
+        return list(self._device_lists[key])
+
+_shared_table = None
+
+def shared_table(refresh=False):
+    """Get the process-wide ModelTable.  The table is loaded once (from the model
+    cache, see twiss_table()) and shared by every display that needs it."""
+    global _shared_table
+    if refresh or _shared_table is None:
+        if refresh:
+            model_cache.default_cache().invalidate(TWISS_CACHE_KEY)
+        _shared_table = ModelTable(twiss_table())
+    return _shared_table
 
 def model_list(start_element=None, end_element=None):
-    table = unwrap_to_np(c.get("BMAD:SYS0:1:FULL_MACHINE:DESIGN:TWISS"))
-    start_index = 0
-    if start_element:
-        i = np.argmax(table['element']==start_element.upper())
-        # if nothing is found, np.argmax returns 0, so we need to check if
-        # we got a zero because the first element was a match, or because
-        # it wasn't found at all.
-        if i == 0 and table['element'][0] != start_element.upper():
-            raise ValueError("Start element not found in table.")
-        start_index = i
-    end_index = -1
-    if end_element:
-        i = np.argmax(table['element']==end_element.upper())
-        if i == 0 and table['element'][0] != end_element.upper():
-            raise ValueError("End element not found in table.")
-        end_index = i
-    return table[start_index:end_index]
+    return shared_table().slice(start_element, end_element)
 
 def unwrap_to_np(value):
-    m = np.zeros(len(value.value.items()[0][1]), dtype=[('element', 'U30'), ('device_name', 'U30'), ('s', 'float32'), ('length', 'float32'), ('p0c', 'float32'), ("alpha_x", "float32"), ("beta_x", "float32"), ("eta_x", "float32"), ("etap_x", "float32"), ("psi_x", "float32"), ("alpha_y", "float32"), ("beta_y", "float32"), ("eta_y", "float32"), ("etap_y", "float32"), ("psi_y", "float32"), ('r_mat', 'float32', (6,6))])
-    for col_name, data in value.value.items()[0:14]:
+    items = list(value.value.items())
+    m = np.zeros(len(items[0][1]), dtype=[('element', 'U30'), ('device_name', 'U30'), ('s', 'float32'), ('length', 'float32'), ('p0c', 'float32'), ("alpha_x", "float32"), ("beta_x", "float32"), ("eta_x", "float32"), ("etap_x", "float32"), ("psi_x", "float32"), ("alpha_y", "float32"), ("beta_y", "float32"), ("eta_y", "float32"), ("etap_y", "float32"), ("psi_y", "float32"), ('r_mat', 'float32', (6,6))])
+    for col_name, data in items[0:14]:
         m[col_name] = data
-    m['r_mat'] = np.reshape(np.array([
-        value.value.items()[15][1], #R11
-        value.value.items()[16][1], #R12
-        value.value.items()[17][1], #R13
-        value.value.items()[18][1], #R14
-        value.value.items()[19][1], #R15
-        value.value.items()[20][1], #R16
-        value.value.items()[21][1], #R21
-        value.value.items()[22][1], #R22
-        value.value.items()[23][1], #R23
-        value.value.items()[24][1], #R24
-        value.value.items()[25][1], #R25
-        value.value.items()[26][1], #R26
-        value.value.items()[27][1], #R31
-        value.value.items()[28][1], #R32
-        value.value.items()[29][1], #R33
-        value.value.items()[30][1], #R34
-        value.value.items()[31][1], #R35
-        value.value.items()[32][1], #R36
-        value.value.items()[33][1], #R41
-        value.value.items()[34][1], #R42
-        value.value.items()[35][1], #R43
-        value.value.items()[36][1], #R44
-        value.value.items()[37][1], #R45
-        value.value.items()[38][1], #R46
-        value.value.items()[39][1], #R51
-        value.value.items()[40][1], #R52
-        value.value.items()[41][1], #R53
-        value.value.items()[42][1], #R54
-        value.value.items()[43][1], #R55
-        value.value.items()[44][1], #R56
-        value.value.items()[45][1], #R61
-        value.value.items()[46][1], #R62
-        value.value.items()[47][1], #R63
-        value.value.items()[48][1], #R64
-        value.value.items()[49][1], #R65
-        value.value.items()[50][1], #R66
-    ]).T, (-1,6,6))
+    #Columns 15 through 50 are R11, R12, ... R66.
+    m['r_mat'] = np.reshape(np.array([data for (col_name, data) in items[15:51]]).T, (-1,6,6))
     return m
-        
\ No newline at end of file
@@ -0,0 +1,304 @@
+"""perf.py - Timers and counters on the hot paths, for finding out why a panel is slow.
+
+Instrumentation is built in only when the SIMUI_PERF environment variable is set
+(or enable() is called before the instrumented modules are imported).  Otherwise
+@timed and counted() return the function they are given unchanged, so a normal
+run pays nothing at all for the instrumentation.  When it is built in, recording
+can be paused and resumed at any time with set_recording().
+
+Each timer or counter keeps a total count, and its most recent samples, so it can
+report a rate (calls per second) and latency percentiles over a recent window.
+The results can be shown live (see utilities.perf_widgets), dumped as JSON lines
+every so often (see PeriodicDump), or posted to the elog (see elog_snapshot).
+"""
+
+import os
+import json
+import time
+import getpass
+import threading
+import functools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import numpy as np
+
+ENV_VAR = 'SIMUI_PERF'
+#Set this to a file name to append a JSON line of stats to it every DUMP_INTERVAL_ENV_VAR seconds.
+DUMP_ENV_VAR = 'SIMUI_PERF_DUMP'
+DUMP_INTERVAL_ENV_VAR = 'SIMUI_PERF_DUMP_INTERVAL'
+DEFAULT_DUMP_INTERVAL = 60.0
+
+_clock = getattr(time, 'perf_counter', time.time)
+_instrumented = bool(os.getenv(ENV_VAR))
+_recording = True
+
+TIMER = 'timer'
+COUNTER = 'counter'
+
+def instrumented():
+    """Whether instrumentation is built into functions decorated from now on."""
+    return _instrumented
+
+def enable():
+    """Build instrumentation into everything decorated from now on.  This only affects
+    modules imported after it is called: set SIMUI_PERF to instrument everything."""
+    global _instrumented
+    _instrumented = True
+
+def set_recording(recording):
+    """Pause (or resume) recording.  Instrumented functions still check this flag while paused."""
+    global _recording
+    _recording = recording
+
+def is_recording():
+    return _instrumented and _recording
+
+class Stat(object):
+    """The samples for one timer or counter.
+
+    Args:
+        name (str): What is being measured, for example 'OrbitView.redraw_bpms'.
+        kind (str): TIMER or COUNTER.
+        max_samples (Optional[int]): How many recent samples to keep, for rates and percentiles.
+    """
+    #Rates are measured over (at most) this many recent seconds.
+    rate_window = 10.0
+    def __init__(self, name, kind, max_samples=2048):
+        self.name = name
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._times = deque(maxlen=max_samples)
+        self._durations = deque(maxlen=max_samples)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+            self._since = time.time()
+            self._times.clear()
+            self._durations.clear()
+
+    def add(self, duration=None, n=1):
+        """Record n events, or one call which took duration seconds."""
+        now = time.time()
+        with self._lock:
+            self.count += n
+            self._times.append((now, n))
+            if duration is not None:
+                self.total += duration
+                self.max = max(self.max, duration)
+                self._durations.append(duration)
+
+    def summary(self, now=None):
+        """Get the count, recent rate, and (for timers) latency statistics, in milliseconds."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            times = list(self._times)
+            durations = np.array(self._durations)
+            count = self.count
+            total = self.total
+            longest = self.max
+            since = self._since
+        recent = [n for (t, n) in times if now - t <= self.rate_window]
+        span = max(min(self.rate_window, now - since), 1.0e-3)
+        rate = sum(recent)/span
+        summary = OrderedDict([('kind', self.kind), ('count', count), ('rate_hz', rate)])
+        if self.kind == TIMER:
+            summary['total_s'] = total
+            summary['mean_ms'] = 1000.0*total/count if count > 0 else None
+            for p in (50, 90, 99):
+                summary['p{}_ms'.format(p)] = 1000.0*float(np.percentile(durations, p)) if len(durations) > 0 else None
+            summary['max_ms'] = 1000.0*longest
+        return summary
+
+class Registry(object):
+    """All the timers and counters in the process."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = OrderedDict()
+        self.started = time.time()
+
+    def stat(self, name, kind=TIMER):
+        """Get a Stat by name, making it if it doesn't exist yet."""
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = Stat(name, kind)
+                self._stats[name] = stat
+            return stat
+
+    def record(self, name, duration):
+        self.stat(name, TIMER).add(duration=duration)
+
+    def count(self, name, n=1):
+        self.stat(name, COUNTER).add(n=n)
+
+    def reset(self):
+        with self._lock:
+            stats = list(self._stats.values())
+            self.started = time.time()
+        for stat in stats:
+            stat.reset()
+
+    def summary(self):
+        """Get the summary of every Stat, as an ordered dictionary of name to summary."""
+        now = time.time()
+        with self._lock:
+            stats = list(self._stats.values())
+        return OrderedDict([(stat.name, stat.summary(now)) for stat in stats])
+
+    def snapshot(self):
+        """Get every Stat's summary along with when and where it was taken, ready for JSON."""
+        return OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('pid', os.getpid()),
+                            ('recording_since', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))),
+                            ('stats', self.summary())])
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def format_table(self):
+        """Format the summary as a text table."""
+        def ms(value):
+            return "{:.2f}".format(value) if value is not None else ""
+        lines = ["{:<36} {:>9} {:>9} {:>9} {:>9} {:>9}".format('', 'count', 'rate Hz', 'p50 ms', 'p99 ms', 'max ms')]
+        for (name, s) in self.summary().items():
+            lines.append("{:<36} {:>9} {:>9.1f} {:>9} {:>9} {:>9}".format(name, s['count'], s['rate_hz'], ms(s.get('p50_ms')), ms(s.get('p99_ms')), ms(s.get('max_ms'))))
+        return "\n".join(lines)
+
+_registry = Registry()
+
+def default_registry():
+    """Get the process-wide Registry, which the instrumented code records into."""
+    return _registry
+
+def record(name, duration):
+    """Record a duration (in seconds) measured some other way, if recording."""
+    if _instrumented and _recording:
+        _registry.record(name, duration)
+
+def count(name, n=1):
+    """Count n events, if recording."""
+    if _instrumented and _recording:
+        _registry.count(name, n)
+
+def timed(name):
+    """A decorator which times every call to a function.  Without instrumentation it
+    returns the function itself."""
+    def decorate(func):
+        if not _instrumented:
+            return func
+        stat = _registry.stat(name, TIMER)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _recording:
+                return func(*args, **kwargs)
+            start = _clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stat.add(duration=_clock() - start)
+        return wrapper
+    return decorate
+
+def counted(name, func):
+    """Wrap func (a callback, usually) so its calls are counted.  Without instrumentation
+    returns func itself."""
+    if not _instrumented:
+        return func
+    stat = _registry.stat(name, COUNTER)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _recording:
+            stat.add()
+        return func(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def timer(name):
+    """Time a block of code.  Unlike timed(), this costs a little even without
+    instrumentation, so keep it off the hottest paths."""
+    if not (_instrumented and _recording):
+        yield
+        return
+    start = _clock()
+    try:
+        yield
+    finally:
+        _registry.record(name, _clock() - start)
+
+class PeriodicDump(object):
+    """Appends a JSON line of stats to a file every interval seconds, on a background thread.
+
+    Args:
+        path (str): The file to append to.
+        interval (Optional[float]): Seconds between dumps.
+        registry (Optional[Registry]): The stats to dump.  Defaults to the process-wide registry.
+    """
+    def __init__(self, path, interval=DEFAULT_DUMP_INTERVAL, registry=None):
+        self.path = path
+        self.interval = interval
+        self.registry = registry if registry is not None else _registry
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="PerfDump")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.dump()
+
+    def dump(self):
+        try:
+            with open(self.path, 'a') as f:
+                f.write(self.registry.to_json())
+                f.write("\n")
+        except (IOError, OSError) as e:
+            print("Could not write performance stats to {path}: {e}".format(path=self.path, e=e))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+_periodic_dump = None
+
+def start_periodic_dump_from_env():
+    """Start dumping stats to the file named by SIMUI_PERF_DUMP (every SIMUI_PERF_DUMP_INTERVAL
+    seconds), if it is set and instrumentation is on.  Returns the PeriodicDump, or None."""
+    global _periodic_dump
+    path = os.getenv(DUMP_ENV_VAR)
+    if not _instrumented or not path:
+        return None
+    if _periodic_dump is None:
+        _periodic_dump = PeriodicDump(path, interval=float(os.getenv(DUMP_INTERVAL_ENV_VAR, DEFAULT_DUMP_INTERVAL)))
+        _periodic_dump.start()
+    return _periodic_dump
+
+def elog_snapshot(title, logbook='lcls', username=None, attachment=None, registry=None):
+    """Post the current stats to the physics elog, as a text table.
+
+    Args:
+        title (str): The entry's title, for example "Steering panel performance".
+        logbook (Optional[str]): The logbook to post to.
+        username (Optional[str]): The entry's author.  Defaults to the current user.
+        attachment (Optional[str]): The path of an image (a screenshot of the panel, say) to attach.
+        registry (Optional[Registry]): The stats to post.  Defaults to the process-wide registry.
+    """
+    #physicselog needs the elog's environment, so it is only imported when it's used.
+    from . import physicselog
+    if registry is None:
+        registry = _registry
+    if username is None:
+        username = getpass.getuser()
+    return physicselog.submit_entry(logbook, username, title, entry_text=registry.format_table(), attachment=attachment)
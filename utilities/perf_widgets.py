@@ -0,0 +1,222 @@
+"""perf_widgets.py - Live views of the stats in utilities.perf, for PyDM displays.
+
+attach(display) gives a display an overlay (a small table drawn over the top right
+corner of the display) and a performance panel, which is docked in the main window if
+there is one, and a separate tool window otherwise.  Ctrl+Shift+P shows and hides the
+overlay, and Ctrl+Shift+D shows and hides the panel.  Without instrumentation (see
+utilities.perf) attach() does nothing.
+"""
+
+import os
+import tempfile
+from qtpy.QtWidgets import (QWidget, QLabel, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem, QPushButton,
+                            QHeaderView, QDockWidget, QMainWindow, QShortcut, QFileDialog, QMessageBox)
+from qtpy.QtGui import QKeySequence, QFont
+from qtpy.QtCore import Qt, QTimer, QEvent, Slot
+from . import perf
+
+#How often the overlay and panel refresh, in milliseconds.
+REFRESH_INTERVAL = 1000
+
+def _ms(value):
+    return "{:.2f}".format(value) if value is not None else ""
+
+class PerfOverlay(QLabel):
+    """A translucent table of the busiest timers and counters, drawn over a corner of a widget.
+    It ignores the mouse, so the widget underneath works as usual.
+
+    Args:
+        target (QWidget): The widget to draw over.
+        rows (Optional[int]): How many stats to show, busiest (most total time, then highest rate) first.
+    """
+    def __init__(self, target, rows=8, registry=None):
+        super(PerfOverlay, self).__init__(target)
+        self.target = target
+        self.rows = rows
+        self.registry = registry if registry is not None else perf.default_registry()
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setStyleSheet("QLabel { background-color: rgba(0, 0, 0, 160); color: rgb(220, 220, 220); padding: 4px; }")
+        font = QFont("Monospace")
+        font.setStyleHint(QFont.TypeWriter)
+        font.setPointSize(8)
+        self.setFont(font)
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL)
+        self.timer.timeout.connect(self.refresh)
+        target.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if obj is self.target and event.type() == QEvent.Resize:
+            self._place()
+        return False
+
+    def _place(self):
+        self.adjustSize()
+        self.move(max(self.target.width() - self.width() - 4, 0), 4)
+        self.raise_()
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super(PerfOverlay, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super(PerfOverlay, self).hideEvent(event)
+
+    @Slot()
+    def refresh(self):
+        summary = self.registry.summary()
+        busiest = sorted(summary.items(), key=lambda item: (item[1].get('total_s', 0.0), item[1]['rate_hz']), reverse=True)
+        lines = ["{:<28} {:>7} {:>8} {:>8}".format('', 'Hz', 'p50 ms', 'max ms')]
+        for (name, s) in busiest[:self.rows]:
+            lines.append("{:<28} {:>7.1f} {:>8} {:>8}".format(name[-28:], s['rate_hz'], _ms(s.get('p50_ms')), _ms(s.get('max_ms'))))
+        if not perf.is_recording():
+            lines.append("(recording paused)")
+        self.setText("\n".join(lines))
+        self._place()
+
+class PerfPanel(QWidget):
+    """A table of every timer and counter, with buttons to pause recording, reset, save
+    the stats as JSON, and post them (with a screenshot of the display) to the elog.
+
+    Args:
+        display (Optional[QWidget]): The display being measured, for the elog screenshot.
+    """
+    columns = ('Name', 'Count', 'Rate (Hz)', 'Mean (ms)', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'Max (ms)')
+    def __init__(self, display=None, registry=None, parent=None):
+        super(PerfPanel, self).__init__(parent=parent)
+        self.display = display
+        self.registry = registry if registry is not None else perf.default_registry()
+        self.setLayout(QVBoxLayout())
+        self.table = QTableWidget(0, len(self.columns), self)
+        self.table.setHorizontalHeaderLabels(self.columns)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.verticalHeader().hide()
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.layout().addWidget(self.table)
+        buttons = QHBoxLayout()
+        self.record_button = QPushButton("Recording", self)
+        self.record_button.setCheckable(True)
+        self.record_button.setChecked(perf.is_recording())
+        self.record_button.toggled.connect(self.set_recording)
+        self.reset_button = QPushButton("Reset", self)
+        self.reset_button.clicked.connect(self.reset)
+        self.save_button = QPushButton("Save JSON...", self)
+        self.save_button.clicked.connect(self.save)
+        self.elog_button = QPushButton("Elog Snapshot", self)
+        self.elog_button.clicked.connect(self.post_to_elog)
+        for button in (self.record_button, self.reset_button, self.save_button, self.elog_button):
+            buttons.addWidget(button)
+        buttons.addStretch()
+        self.layout().addLayout(buttons)
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super(PerfPanel, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super(PerfPanel, self).hideEvent(event)
+
+    @Slot()
+    def refresh(self):
+        summary = self.registry.summary()
+        self.table.setRowCount(len(summary))
+        for (row, (name, s)) in enumerate(summary.items()):
+            values = (name, str(s['count']), "{:.1f}".format(s['rate_hz']), _ms(s.get('mean_ms')), _ms(s.get('p50_ms')),
+                      _ms(s.get('p90_ms')), _ms(s.get('p99_ms')), _ms(s.get('max_ms')))
+            for (col, value) in enumerate(values):
+                item = self.table.item(row, col)
+                if item is None:
+                    item = QTableWidgetItem()
+                    if col > 0:
+                        item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                    self.table.setItem(row, col, item)
+                item.setText(value)
+
+    @Slot(bool)
+    def set_recording(self, recording):
+        perf.set_recording(recording)
+        self.record_button.setText("Recording" if recording else "Paused")
+
+    @Slot()
+    def reset(self):
+        self.registry.reset()
+        self.refresh()
+
+    @Slot()
+    def save(self):
+        (path, selected_filter) = QFileDialog.getSaveFileName(self, "Save Performance Stats", "perf.json", "JSON (*.json)")
+        if not path:
+            return
+        try:
+            with open(path, 'w') as f:
+                f.write(self.registry.to_json())
+        except (IOError, OSError) as e:
+            QMessageBox.warning(self, "Save Failed", "Could not save {}: {}".format(path, e))
+
+    @Slot()
+    def post_to_elog(self):
+        attachment = None
+        if self.display is not None:
+            attachment = os.path.join(tempfile.gettempdir(), "simui-perf-{}.png".format(os.getpid()))
+            if not self.display.window().grab().save(attachment):
+                attachment = None
+        title = "{} performance".format(self.display.windowTitle() if self.display is not None else "Display")
+        try:
+            perf.elog_snapshot(title, attachment=attachment, registry=self.registry)
+        except Exception as e:
+            QMessageBox.warning(self, "Elog Failed", "Could not post to the elog: {}".format(e))
+
+class PerfTools(object):
+    """The overlay and panel attached to one display (see attach())."""
+    def __init__(self, display):
+        self.display = display
+        self.overlay = PerfOverlay(display)
+        self.panel = PerfPanel(display=display)
+        self.dock = None
+        self.overlay_shortcut = QShortcut(QKeySequence("Ctrl+Shift+P"), display)
+        self.overlay_shortcut.activated.connect(self.toggle_overlay)
+        self.panel_shortcut = QShortcut(QKeySequence("Ctrl+Shift+D"), display)
+        self.panel_shortcut.activated.connect(self.toggle_panel)
+        self.dump = perf.start_periodic_dump_from_env()
+
+    def toggle_overlay(self):
+        self.overlay.setVisible(not self.overlay.isVisible())
+
+    def _dock(self):
+        #PyDM puts a display in its main window after making it, so this is done as late as possible.
+        window = self.display.window()
+        if self.dock is None and isinstance(window, QMainWindow):
+            self.dock = QDockWidget("Performance", window)
+            self.dock.setObjectName("PerformanceDock")
+            self.dock.setWidget(self.panel)
+            window.addDockWidget(Qt.RightDockWidgetArea, self.dock)
+        if self.dock is None and self.panel.parent() is None:
+            self.panel.setParent(self.display, Qt.Tool)
+            self.panel.setWindowTitle("Performance")
+
+    def toggle_panel(self):
+        self._dock()
+        widget = self.dock if self.dock is not None else self.panel
+        widget.setVisible(not widget.isVisible())
+
+def attach(display, show_overlay=True):
+    """Give a display a performance overlay and panel, if instrumentation is on.
+
+    Args:
+        display (QWidget): The display to measure.
+        show_overlay (Optional[bool]): Whether to show the overlay right away.
+    Returns:
+        PerfTools: The overlay and panel, or None without instrumentation.
+    """
+    if not perf.instrumented():
+        return None
+    tools = PerfTools(display)
+    tools.overlay.setVisible(show_overlay)
+    return tools
@@ -0,0 +1,201 @@
+"""trajectory_fit.py - Fits a trajectory to an orbit's BPM readings.
+
+Everything that only depends on the lattice and on which BPMs are usable (the
+design matrix and its least-squares solution operator) is computed once and
+cached, so fitting a new set of readings costs a couple of matrix-vector products.
+"""
+
+import numpy as np
+from collections import OrderedDict
+from .fit import LeastSquares
+from . import perf
+
+#The order of the fit parameters in the design matrix.
+PARAMETERS = ('xpos0', 'xang0', 'ypos0', 'yang0', 'dE/E', 'xkick', 'ykick')
+#Below this much dispersion (in meters) at every BPM, dE/E can't be fit.
+MIN_DISPERSION = 0.010
+
+def _check_rmats(Rs, end):
+    """Raise a ValueError unless there is an R matrix for every BPM up to index end."""
+    if len(Rs) <= end:
+        raise ValueError("Rs has {n} R matrices, but BPMs up to index {end} ({needed} BPMs) are being fit.".format(n=len(Rs), end=end, needed=end+1))
+
+class FitPlan(object):
+    """The design matrix and factorized least-squares problem for one fit configuration.
+
+    Args:
+        Rs (numpy.ndarray): An Nx6x6 array of R matrices from the fit point to each BPM.
+        zs (numpy.ndarray): The Z position of each BPM.
+        z0 (float): The Z position of the fit point.  Kicks are applied here.
+        enabled (tuple of bool): Whether or not to fit each of the parameters in PARAMETERS.
+        sig (Optional[numpy.ndarray]): The uncertainty for each reading (X readings
+            followed by Y readings).  If None, the fit is unweighted, and the errors
+            are scaled by the goodness of fit.
+    """
+    def __init__(self, Rs, zs, z0, enabled, sig=None):
+        #Grab just the R1s and R3s, except for R15 and R35.
+        R1s = Rs[:, 0, [0, 1, 2, 3, 5]]
+        R3s = Rs[:, 2, [0, 1, 2, 3, 5]]
+        enabled = list(enabled)
+        if not (np.any(np.abs(R1s[:, 4]) > MIN_DISPERSION) or np.any(np.abs(R3s[:, 4]) > MIN_DISPERSION)):
+            #Not enough dispersion to fit energy, disabling energy fit.
+            enabled[4] = False
+        #Kicks at the fit point only affect BPMs downstream of it.
+        downstream = (zs > z0)[:, np.newaxis]
+        R1s = np.hstack((R1s, R1s[:, [1, 3]]*downstream))
+        R3s = np.hstack((R3s, R3s[:, [1, 3]]*downstream))
+        self.parameter_indices = np.where(enabled)[0]
+        self.num_bpms = len(zs)
+        self.Q = np.vstack((R1s[:, self.parameter_indices], R3s[:, self.parameter_indices]))
+        self.solver = LeastSquares(self.Q, sig)
+
+    def solve(self, s):
+        """Fit readings (X readings followed by Y readings).  s can be a single
+        vector, or a 2D array with one set of readings (for example, one shot) per column.
+
+        Returns:
+            A tuple (y, dy, R, dR, chisq, V), as returned by utilities.fit.LeastSquares.solve.
+        """
+        return self.solver.solve(s)
+
+class TrajectoryFitter(object):
+    """Fits trajectories, caching a FitPlan for each combination of start BPM, end BPM,
+    fit point, enabled parameters and mask of good BPMs.  A plan is only rebuilt when one
+    of those changes (in practice, when the set of BPMs with good TMIT changes), or when
+    new R matrices are supplied.
+
+    Args:
+        max_plans (Optional[int]): The number of plans to keep in the cache.
+    """
+    def __init__(self, max_plans=16):
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._rmats = None
+        self.plans_built = 0
+
+    def clear_cache(self):
+        self._plans = OrderedDict()
+
+    def plan(self, Rs, zs, z0, enabled, good, start, end, sig=None):
+        """Get the FitPlan for a configuration, building it if it isn't cached."""
+        if Rs is not self._rmats:
+            self.clear_cache()
+            self._rmats = Rs
+        key = (start, end, z0, tuple(enabled), good.tobytes(), None if sig is None else sig.tobytes())
+        try:
+            plan = self._plans.pop(key)
+        except KeyError:
+            plan = FitPlan(Rs[start:end+1][good], zs[good], z0, enabled, sig=sig)
+            self.plans_built += 1
+            if len(self._plans) >= self.max_plans:
+                self._plans.popitem(last=False)
+        self._plans[key] = plan
+        return plan
+
+    @perf.timed('TrajectoryFitter.fit')
+    def fit(self, Rs, zs, xs, ys, dxs, dys, tmit_sevrs, start, end, z0, enabled):
+        """Fit a trajectory to a set of BPM readings.
+
+        Args:
+            Rs (numpy.ndarray): An Nx6x6 array of R matrices from the fit point to every BPM.
+            zs, xs, ys, dxs, dys, tmit_sevrs (numpy.ndarray): Z position, X and Y readings,
+                X and Y RMS, and TMIT severity for every BPM.
+            start (int): The index of the first BPM to include in the fit.
+            end (int): The index of the last BPM to include in the fit.
+            z0 (float): The Z position of the fit point.
+            enabled (tuple of bool): Whether or not to fit each of the parameters in PARAMETERS.
+        Returns:
+            dict: The fit result (see BaseOrbit.fit), or None if no BPMs have good TMIT.
+        Raises:
+            ValueError: If Rs doesn't have an R matrix for every BPM up to end.
+        """
+        _check_rmats(Rs, end)
+        window = slice(start, end+1)
+        #Filter out BPMS with bad TMIT severity (usually a good indicator of no beam)
+        good = np.asarray(tmit_sevrs)[window] == 0
+        num_bpms = np.count_nonzero(good)
+        if num_bpms == 0:
+            return None
+        if Rs[window][good].shape != (num_bpms, 6, 6):
+            raise ValueError("Number of R matrices in Rs does not equal the number of BPMs in the orbit.")
+        zs = np.asarray(zs)[window]
+        s = np.concatenate((np.asarray(xs)[window][good], np.asarray(ys)[window][good]))
+        ds = np.concatenate((np.asarray(dxs)[window][good], np.asarray(dys)[window][good]))
+        sig = None if np.all(ds == 0.0) else ds
+        plan = self.plan(Rs, zs, z0, enabled, good, start, end, sig=sig)
+        (Ssf, dSsf, p, dp, chisq, V) = plan.solve(s)
+        return self.result(plan, Ssf, p, zs[good])
+
+    def result(self, plan, Ssf, p, zs):
+        result = {}
+        result['xpos'] = Ssf[0:plan.num_bpms]
+        result['ypos'] = Ssf[plan.num_bpms:]
+        result['zs'] = zs
+        for (i, parameter) in enumerate(PARAMETERS):
+            matches = np.where(plan.parameter_indices == i)[0]
+            result[parameter] = p[matches[0]] if len(matches) > 0 else None
+        return result
+
+    def fit_shots(self, Rs, zs, xs, ys, good, start, end, z0, enabled):
+        """Fit a trajectory to every shot in a set of BPM readings.
+        Shots are grouped by their mask of good BPMs, and each group is fit with one
+        batched solve, so a single factorization is shared by every shot in the group.
+
+        Args:
+            Rs (numpy.ndarray): An Nx6x6 array of R matrices from the fit point to every BPM.
+            zs (numpy.ndarray): The Z position of every BPM.
+            xs, ys (numpy.ndarray): (n_shots x N) arrays of X and Y readings.
+            good (numpy.ndarray): An (n_shots x N) boolean array, True for readings to use.
+                Readings which aren't finite are never used.
+            start (int): The index of the first BPM to include in the fit.
+            end (int): The index of the last BPM to include in the fit.
+            z0 (float): The Z position of the fit point.
+            enabled (tuple of bool): Whether or not to fit each of the parameters in PARAMETERS.
+        Returns:
+            dict: The per-shot fit results (see BaseOrbit.fit_shots).
+        Raises:
+            ValueError: If Rs doesn't have an R matrix for every BPM up to end.
+        """
+        _check_rmats(Rs, end)
+        window = slice(start, end+1)
+        zs = np.asarray(zs)[window]
+        xs = np.atleast_2d(np.asarray(xs, dtype=float))[:, window]
+        ys = np.atleast_2d(np.asarray(ys, dtype=float))[:, window]
+        good = np.atleast_2d(np.asarray(good, dtype=bool))[:, window] & np.isfinite(xs) & np.isfinite(ys)
+        (n_shots, n_bpms) = xs.shape
+        result = {'zs': zs}
+        for key in ('xpos', 'ypos', 'xres', 'yres'):
+            result[key] = np.full((n_shots, n_bpms), np.nan)
+        params = np.full((len(PARAMETERS), n_shots), np.nan)
+        errors = np.full((len(PARAMETERS), n_shots), np.nan)
+        fitted = np.zeros(len(PARAMETERS), dtype=bool)
+        if n_shots > 0:
+            (masks, groups) = np.unique(good, axis=0, return_inverse=True)
+            groups = groups.reshape(-1)
+        else:
+            masks = []
+        for (group, mask) in enumerate(masks):
+            if not mask.any():
+                continue
+            shots = np.where(groups == group)[0]
+            try:
+                plan = self.plan(Rs, zs, z0, enabled, mask, start, end)
+            except (ValueError, np.linalg.LinAlgError):
+                #Too few good BPMs in these shots to fit the enabled parameters.
+                continue
+            cells = np.ix_(shots, mask)
+            S = np.vstack((xs[cells].T, ys[cells].T))
+            (y, dy, R, dR, chisq, V) = plan.solve(S)
+            m = plan.num_bpms
+            result['xpos'][cells] = y[:m].T
+            result['ypos'][cells] = y[m:].T
+            result['xres'][cells] = xs[cells] - y[:m].T
+            result['yres'][cells] = ys[cells] - y[m:].T
+            params[np.ix_(plan.parameter_indices, shots)] = R
+            errors[np.ix_(plan.parameter_indices, shots)] = dR
+            fitted[plan.parameter_indices] = True
+        result['dp'] = {}
+        for (i, parameter) in enumerate(PARAMETERS):
+            result[parameter] = params[i] if fitted[i] else None
+            result['dp'][parameter] = errors[i] if fitted[i] else None
+        return result